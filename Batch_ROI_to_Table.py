@@ -27,11 +27,15 @@ from omero.gateway import BlitzGateway, FileAnnotationWrapper
 import omero
 from omero.rtypes import rlong, rint, rstring, robject, unwrap
 from omero.model import RectangleI, EllipseI, LineI, PolygonI, PolylineI, \
-    MaskI, LabelI, PointI, \
-    OriginalFileI, FileAnnotationI
-from omero.grid import ImageColumn, LongColumn, StringColumn, DoubleColumn
+    MaskI, LabelI, PointI
+from concurrent.futures import ThreadPoolExecutor
 from math import sqrt, pi
 import re
+import threading
+
+from shape_geometry import shape_geometry
+from table_writer import TableWriter, OmeroTableBackend, rows_to_arrays, \
+    save_file_annotation
 
 DEFAULT_FILE_NAME = "Batch_ROI_Export.csv"
 INSIGHT_POINT_LIST_RE = re.compile(r'points\[([^\]]+)\]')
@@ -43,9 +47,12 @@ def log(data):
     print(data)
 
 
-def get_export_data(conn, script_params, image, units=None):
-    """Get pixel data for shapes on image and returns list of dicts."""
-    log("Image ID %s..." % image.id)
+def get_export_data(conn, script_params, image, units=None, rois=None):
+    """
+    Get pixel data for shapes on image and returns list of dicts.
+
+    If rois is None, all the ROIs on the image are loaded.
+    """
 
     # Get pixel size in SAME units for all images
     pixel_size_x = None
@@ -74,11 +81,13 @@ def get_export_data(conn, script_params, image, units=None):
     ch_names = [ch_name.replace(",", ".") for ch_name in ch_names]
     image_name = image.getName().replace(",", ".")
 
-    result = roi_service.findByImage(image.getId(), None)
-
-    rois = result.rois
+    if rois is None:
+        log("Image ID %s..." % image.id)
+        rois = roi_service.findByImage(image.getId(), None).rois
     # Sort by ROI.id (same as in iviewer)
     rois.sort(key=lambda r: r.id.val)
+    # Measure all Polygons and Polylines in one batch
+    geometry = get_points_geometry(rois, pixel_size_x, pixel_size_y)
     export_data = []
 
     for roi in rois:
@@ -125,12 +134,70 @@ def get_export_data(conn, script_params, image, units=None):
                             # "std_dev": stats[0].stdDev[c] if stats else ""
                         }
                         add_shape_coords(shape, row_data,
-                                         pixel_size_x, pixel_size_y)
+                                         pixel_size_x, pixel_size_y,
+                                         geometry)
                         export_data.append(row_data)
 
     return export_data
 
 
+def get_export_pages(conn, script_params, image, units=None, page_size=500):
+    """Page through the ROIs on image, yielding a list of dicts per page."""
+    log("Image ID %s..." % image.id)
+    roi_service = conn.getRoiService()
+    offset = 0
+    load_more = True
+    while load_more:
+        roi_options = omero.api.RoiOptions()
+        roi_options.offset = rint(offset)
+        roi_options.limit = rint(page_size)
+        result = roi_service.findByImage(image.getId(), roi_options)
+        log("offset: %s, found %s ROIs" % (offset, len(result.rois)))
+        load_more = len(result.rois) == page_size
+        offset += page_size
+        yield get_export_data(conn, script_params, image, units, result.rois)
+
+
+def get_export_data_parallel(conn, script_params, images, units, workers,
+                             connect=None):
+    """
+    Get data for images on a pool of threads and returns list of dicts.
+
+    Each thread joins the session with its own client, so ROIs for several
+    images are loaded at once. Rows are returned in Image ID order.
+    connect() can be given to return the connection for each thread
+    instead, e.g. a fake one for testing.
+    """
+    local = threading.local()
+    lock = threading.Lock()
+    clients = []
+
+    if connect is None:
+        def connect():
+            client = conn.c.createClient(secure=True)
+            with lock:
+                clients.append(client)
+            return BlitzGateway(client_obj=client)
+
+    def export_image(image_id):
+        if not hasattr(local, "conn"):
+            local.conn = connect()
+        image = local.conn.getObject("Image", image_id)
+        return get_export_data(local.conn, script_params, image, units)
+
+    image_ids = sorted(image.id for image in images)
+    export_data = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map() returns results in the order of image_ids
+            for rows in executor.map(export_image, image_ids):
+                export_data.extend(rows)
+    finally:
+        for client in clients:
+            client.closeSession()
+    return export_data
+
+
 COLUMN_NAMES = ["image_id",
                 "image_name",
                 "roi_id",
@@ -162,39 +229,61 @@ COLUMN_NAMES = ["image_id",
                 # "Points"
             ]
 
-COLUMN_TYPES = {"image_id": ImageColumn,
-                "image_name": StringColumn,
-                "roi_id": LongColumn,
-                "shape_id": LongColumn,
-                "type": StringColumn,
-                "text": StringColumn,
-                "z": LongColumn,
-                "t": LongColumn,
-                "channel": StringColumn,
-                "area": DoubleColumn,
-                "length": DoubleColumn,
-                "borderLength": DoubleColumn,
+# column kinds for table_writer
+COLUMN_TYPES = {"image_id": "image",
+                "image_name": "string",
+                "roi_id": "long",
+                "shape_id": "long",
+                "type": "string",
+                "text": "string",
+                "z": "long",
+                "t": "long",
+                "channel": "string",
+                "area": "double",
+                "length": "double",
+                "borderLength": "double",
                 # "points",
                 # "min",
                 # "max",
                 # "sum",
                 # "mean",
                 # "std_dev",
-                "X": DoubleColumn,
-                "Y": DoubleColumn,
-                "Width": DoubleColumn,
-                "Height": DoubleColumn,
+                "X": "double",
+                "Y": "double",
+                "Width": "double",
+                "Height": "double",
                 # "RadiusX",
                 # "RadiusY",
                 # "X1",
                 # "Y1",
                 # "X2",
                 # "Y2",
-                "Points": StringColumn}
-
-
-def add_shape_coords(shape, row_data, pixel_size_x, pixel_size_y):
-    """Add shape coordinates and length or area to the row_data dict."""
+                "Points": "string"}
+
+
+def get_points_geometry(rois, pixel_size_x, pixel_size_y):
+    """Measure all Polygons and Polylines in rois, return dicts by shape ID."""
+    shapes = [shape for roi in rois for shape in roi.copyShapes()
+              if isinstance(shape, (PolygonI, PolylineI))]
+    point_lists = [shape.getPoints().getValue() for shape in shapes]
+    closed = [isinstance(shape, PolygonI) for shape in shapes]
+    measured = shape_geometry(point_lists, closed, pixel_size_x, pixel_size_y)
+    measured = {key: values.tolist() for key, values in measured.items()}
+    geometry = {}
+    for i, shape in enumerate(shapes):
+        keys = ["X", "Y", "Width", "Height", "area" if closed[i] else "length"]
+        geometry[shape.id.val] = {key: measured[key][i] for key in keys}
+    return geometry
+
+
+def add_shape_coords(shape, row_data, pixel_size_x, pixel_size_y,
+                     geometry=None):
+    """
+    Add shape coordinates and length or area to the row_data dict.
+
+    If geometry (from get_points_geometry) is given, Polygons and Polylines
+    are looked up by shape ID instead of parsing their points again.
+    """
     if shape.getTextValue():
         row_data['Text'] = shape.getTextValue().getValue()
     if isinstance(shape, (RectangleI, EllipseI, PointI, LabelI, MaskI)):
@@ -225,6 +314,10 @@ def add_shape_coords(shape, row_data, pixel_size_x, pixel_size_y):
             point_list = match.group(1)
         row_data['Points'] = '"%s"' % point_list
         row_data['borderLength'] = len(point_list)
+        if geometry is not None and shape.id.val in geometry:
+            # already scaled by pixel size
+            row_data.update(geometry[shape.id.val])
+            return
         x_coords = []
         y_coords = []
         for xy in point_list.split(", "):
@@ -266,39 +359,34 @@ def add_shape_coords(shape, row_data, pixel_size_x, pixel_size_y):
         row_data['area'] = row_data['area'] * pixel_size_x * pixel_size_y
 
 
-def create_column(name, data=[]):
-    col_type = COLUMN_TYPES[name]
-    if col_type is StringColumn:
-        return StringColumn(name, '', DEFAULT_COLUMN_SIZE, data)
-    else:
-        return col_type(name, '', data)
-
-
 def write_table(conn, export_data, script_params, units_symbol):
     """Write the list of data to an OMERO.table, return a file annotation."""
+    file_ann, row_count = write_table_pages(conn, [export_data],
+                                            script_params, units_symbol)
+    return file_ann
+
+
+def write_table_pages(conn, pages, script_params, units_symbol,
+                      string_widths=None):
+    """
+    Write each page (list of dicts) to an OMERO.table as it comes.
+
+    Only one page (and one batch of the table writer) is held in memory.
+    Returns the file annotation and the number of rows written.
+    """
     table_name = script_params.get("File_Name", "")
     if len(table_name) == 0:
         table_name = DEFAULT_FILE_NAME
     if table_name.endswith('.csv'):
         table_name = table_name.replace('.csv', '')
-    columns = [create_column(name, []) for name in COLUMN_NAMES]
-    resources = conn.c.sf.sharedResources()
-    repository_id = resources.repositories().descriptions[0].getId().getValue()
-    table = resources.newTable(repository_id, table_name)
-    table.initialize(columns)
-
-    data = []
-    for name in COLUMN_NAMES:
-        col_data = [row.get(name) for row in export_data]
-        data.append(create_column(name, col_data))
-    table.addData(data)
-    orig_file = table.getOriginalFile()
-    table.close()
-    orig_file_id = orig_file.id.val
-    file_ann = FileAnnotationI()
-    file_ann.setFile(OriginalFileI(orig_file_id, False))
-    file_ann = conn.getUpdateService().saveAndReturnObject(file_ann)
-    return FileAnnotationWrapper(conn, file_ann)
+    with TableWriter(OmeroTableBackend(conn, table_name),
+                     column_types=COLUMN_TYPES,
+                     string_widths=string_widths) as writer:
+        for page in pages:
+            writer.write(rows_to_arrays(page, COLUMN_NAMES, COLUMN_TYPES))
+    orig_file = writer.result
+    file_ann = save_file_annotation(conn, orig_file)
+    return FileAnnotationWrapper(conn, file_ann), writer.row_count
 
 
 def write_csv(conn, export_data, script_params, units_symbol):
@@ -378,20 +466,43 @@ def batch_roi_export(conn, script_params):
     units = None if any_none else pixel_size_x.getUnit()
     symbol = None if any_none else pixel_size_x.getSymbol()
 
-    # build a list of dicts.
-    export_data = []
-    for image in images:
-        export_data.extend(get_export_data(conn, script_params, image, units))
-
-    # Write to csv
-    # file_ann = write_csv(conn, export_data, script_params, symbol)
-    file_ann = write_table(conn, export_data, script_params, symbol)
+    page_size = script_params.get("Page_Size", 0)
+    if page_size > 0:
+        # stream one page of ROIs at a time into the table
+        pages = (page for image in images
+                 for page in get_export_pages(conn, script_params, image,
+                                              units, page_size))
+        # can't see all the strings before creating the table,
+        # except the image names
+        string_widths = {name: DEFAULT_COLUMN_SIZE
+                         for name, kind in COLUMN_TYPES.items()
+                         if kind == "string"}
+        string_widths["image_name"] = max(
+            len(image.getName().encode("utf-8")) for image in images)
+        file_ann, row_count = write_table_pages(conn, pages, script_params,
+                                                symbol, string_widths)
+    else:
+        # build a list of dicts.
+        workers = script_params.get("Workers", 1)
+        if workers > 1:
+            export_data = get_export_data_parallel(conn, script_params,
+                                                   images, units, workers)
+        else:
+            export_data = []
+            for image in images:
+                export_data.extend(get_export_data(conn, script_params, image,
+                                                   units))
+        row_count = len(export_data)
+
+        # Write to csv
+        # file_ann = write_csv(conn, export_data, script_params, symbol)
+        file_ann = write_table(conn, export_data, script_params, symbol)
     if dtype == "Image":
         link_annotation(images, file_ann)
     else:
         objects = conn.getObjects(dtype, script_params['IDs'])
         link_annotation(objects, file_ann)
-    message = "Exported %s shapes" % len(export_data)
+    message = "Exported %s shapes" % row_count
     return file_ann, message
 
 
@@ -428,6 +539,16 @@ def run_script():
             "File_Name", grouping="5", default=DEFAULT_FILE_NAME,
             description="Name of the exported CSV file"),
 
+        scripts.Int(
+            "Page_Size", grouping="6", default=0, min=0,
+            description=("Load this many ROIs at a time and add them to the "
+                         "table page by page. 0 loads all ROIs at once.")),
+
+        scripts.Int(
+            "Workers", grouping="7", default=1, min=1, max=16,
+            description=("Number of Images to load ROIs for at the same "
+                         "time. Not used with Page_Size.")),
+
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
         contact="ome-users@lists.openmicroscopy.org.uk",
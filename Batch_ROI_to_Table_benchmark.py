@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+Benchmark of get_export_data_parallel() in Batch_ROI_to_Table.py, with no
+server: a fake gateway's RoiService.findByImage() sleeps for `latency_ms`
+like a server round trip. Checks that the rows for every number of
+workers are the same as for 1 worker, in Image ID order.
+
+$ python Batch_ROI_to_Table_benchmark.py [IMAGES] [LATENCY_MS] [MAX_WORKERS]
+"""
+
+import sys
+import time
+from timeit import default_timer
+
+import omero
+from omero.rtypes import rint, rlong, rstring
+
+from Batch_ROI_to_Table import get_export_data_parallel
+
+SCRIPT_PARAMS = {"Export_All_Planes": False, "Channels": [1]}
+
+
+class FakeImage(object):
+    def __init__(self, image_id):
+        self.id = image_id
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return "image_%s" % self.id
+
+    def getSizeC(self):
+        return 1
+
+    def getSizeZ(self):
+        return 1
+
+    def getSizeT(self):
+        return 1
+
+    def getChannelLabels(self):
+        return ["DAPI"]
+
+
+class FakeRoiService(object):
+    def __init__(self, rois_per_image, latency):
+        self.rois_per_image = rois_per_image
+        self.latency = latency
+
+    def findByImage(self, image_id, options, ctx=None):
+        time.sleep(self.latency)
+        rois = []
+        for i in range(self.rois_per_image):
+            roi = omero.model.RoiI()
+            roi.id = rlong(image_id * 1000 + i)
+            polygon = omero.model.PolygonI()
+            polygon.id = rlong(image_id * 1000 + i)
+            polygon.theZ = rint(0)
+            polygon.theT = rint(0)
+            polygon.points = rstring("%s,0 %s,10 0,%s" % (i + 1, i + 1, i + 5))
+            roi.addShape(polygon)
+            rois.append(roi)
+        return omero.api.RoiResult(rois=rois)
+
+
+class FakeGateway(object):
+    """The methods of BlitzGateway used by get_export_data()."""
+
+    def __init__(self, rois_per_image, latency):
+        self.roi_service = FakeRoiService(rois_per_image, latency)
+
+    def getRoiService(self):
+        return self.roi_service
+
+    def getObject(self, obj_type, obj_id):
+        return FakeImage(obj_id)
+
+
+def benchmark(image_count=32, latency_ms=50, max_workers=8, rois_per_image=20):
+    """Time the export with 1, 2, 4... max_workers threads."""
+    latency = latency_ms / 1000.0
+    images = [FakeImage(image_id) for image_id in range(image_count, 0, -1)]
+
+    def connect():
+        return FakeGateway(rois_per_image, latency)
+
+    print("%s images, %s ms per findByImage()" % (image_count, latency_ms))
+    expected = None
+    base_time = None
+    workers = 1
+    while workers <= max_workers:
+        start = default_timer()
+        rows = get_export_data_parallel(None, SCRIPT_PARAMS, images, None, workers,
+                                        connect=connect)
+        duration = default_timer() - start
+        if expected is None:
+            expected = rows
+            base_time = duration
+            assert [row["image_id"] for row in rows] == sorted(row["image_id"] for row in rows)
+        assert rows == expected, "rows differ with %s workers" % workers
+        print("workers: %2d  %.3f s  (%.1fx)" % (workers, duration, base_time / duration))
+        workers *= 2
+
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
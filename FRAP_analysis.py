@@ -6,9 +6,13 @@ from omero.rtypes import rint, rstring
 from skimage import morphology
 from skimage import measure
 
+from contour_encoder import EncodingStats, encode_contour
+from roi_writer import RoiWriter
+
 conn = BlitzGateway('user-3', 'ome', port=4064, host='merge-ci-devspace.openmicroscopy.org')
 conn.connect()
-updateService = conn.getUpdateService()
+writer = RoiWriter(conn)
+stats = EncodingStats()
 
 def rgba_to_int(red, green, blue, alpha=255):
     """ Return the color as an Integer in RGBA encoding """
@@ -23,9 +27,8 @@ def rgba_to_int(red, green, blue, alpha=255):
 
 def add_polygon(contour):
     """ points is 2D list of [[x, y], [x, y]...]"""
-    # format points like "10,20, 50,150, 200,200, 250,75"
-    points = ["%s,%s" % (xy[1], xy[0]) for xy in contour]
-    points = ", ".join(points)
+    # simplify and format points like "10.0,20.0 50.0,150.0 200.0,200.0"
+    points = encode_contour(contour, stats=stats)
 
     polygon = omero.model.PolygonI()
     polygon.strokeColor = rint(rgba_to_int(255, 255, 0))
@@ -33,7 +36,7 @@ def add_polygon(contour):
     roi = omero.model.RoiI()
     roi.setImage(image._obj)
     roi.addShape(polygon)
-    updateService.saveObject(roi)
+    writer.add(roi)
 
 
 dataset_id = 5220
@@ -60,6 +63,9 @@ for image in dataset.listChildren():
         if len(c) > len(longest_contour):
             longest_contour = c
     add_polygon(longest_contour)
+
+writer.close()
+print(stats.report())
             
 
 
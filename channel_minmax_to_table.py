@@ -21,12 +21,13 @@
 # From https://raw.githubusercontent.com/ome/training-scripts/master/maintenance/scripts/channel_minmax_to_table.py
 
 import argparse
+import numpy as np
 import omero
-from omero.rtypes import rstring
-import omero.grid
 from omero.gateway import BlitzGateway
 from random import random
 
+from table_writer import TableWriter, OmeroTableBackend, save_file_annotation
+
 
 NAMESPACE = "openmicroscopy.org/omero/bulk_annotations"
 
@@ -77,44 +78,29 @@ def run(username, password, plate_id, host, port):
         print('wellIds', wellIds)
         print('rowData', rowData)
 
-        # Now we know how many channels, we can make the table
-        col1 = omero.grid.WellColumn('Well', '', [])
-        columns = [col1]
+        # Now we know how many channels, we can name the columns
         colNames = []
         for chIdx in range(chCount):
-            for name in ['Ch%sMin' % chIdx, 'Ch%sMax' % chIdx]:
-                colNames.append(name)
-                columns.append(omero.grid.LongColumn(name, '', []))
+            colNames.extend(['Ch%sMin' % chIdx, 'Ch%sMax' % chIdx])
         # Add some other fake columns
-        for name in fake_cols:
-            colNames.append(name)
-            columns.append(omero.grid.LongColumn(name, '', []))
-
-        table = conn.c.sf.sharedResources().newTable(1, tablename)
-        table.initialize(columns)
+        colNames.extend(fake_cols)
 
-        # Add Data from above
+        # Add Data from above, one array per column
         print("colNames", colNames)
         print("rowData[0]", rowData[0], len(rowData[0]))
-        data1 = omero.grid.WellColumn('Well', '', wellIds)
-        data = [data1]
-        for colIdx in range(len(rowData[0])):
-            colData = [r[colIdx] for r in rowData]
-            print("colData", len(colData))
-            print("colIdx", colIdx, len(colNames))
-            name = colNames[colIdx]
-            data.append(omero.grid.LongColumn(name, '', colData))
+        values = np.array(rowData, dtype=np.int64)
+        data = {'Well': np.array(wellIds, dtype=np.int64)}
+        for colIdx, name in enumerate(colNames):
+            data[name] = values[:, colIdx]
 
         print("Adding data: ", len(data))
-        table.addData(data)
+        writer = TableWriter(OmeroTableBackend(conn, tablename, 1),
+                             column_types={'Well': 'well'})
+        writer.write(data)
+        orig_file = writer.close()
 
         print("table closed...")
-        orig_file = table.getOriginalFile()
-        table.close()
-        fileAnn = omero.model.FileAnnotationI()
-        fileAnn.ns = rstring(NAMESPACE)
-        fileAnn.setFile(omero.model.OriginalFileI(orig_file.id.val, False))
-        fileAnn = conn.getUpdateService().saveAndReturnObject(fileAnn)
+        fileAnn = save_file_annotation(conn, orig_file, ns=NAMESPACE)
         link = omero.model.PlateAnnotationLinkI()
         link.setParent(omero.model.PlateI(plate_id, False))
         link.setChild(omero.model.FileAnnotationI(fileAnn.id.val, False))
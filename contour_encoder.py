@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+Compact Polygon and Polyline points from contours.
+
+Contours from skimage.measure.find_contours() have a sub-pixel point for
+every pixel along the edge of an object. Writing them all as "%s,%s" full
+float strings gives big ROIs that are slow to save and to render. Instead:
+
+ - points are removed with Douglas-Peucker simplification, keeping the
+   shape within `tolerance` pixels of the original contour
+ - the number of points is capped at `max_points`
+ - coordinates are written with a fixed number of decimal places
+
+    stats = EncodingStats()
+    points = encode_contour(contour, x_offset, y_offset, stats=stats)
+    polygon.points = rstring(points)
+    print(stats.report())
+
+Run this file to see the bytes saved for random contours:
+
+$ python contour_encoder.py 1000
+"""
+
+import sys
+from timeit import default_timer
+
+import numpy as np
+
+TOLERANCE = 0.5
+PRECISION = 1
+MAX_POINTS = 500
+
+
+def douglas_peucker(points, tolerance=TOLERANCE):
+    """
+    Simplify an open (N, 2) line, keeping both ends.
+
+    Instead of recursing into each segment, every segment is split at its
+    furthest point in one NumPy pass, until no point is further than the
+    tolerance from its segment.
+    """
+    count = len(points)
+    if count < 3:
+        return points
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    indices = np.arange(count)
+    while True:
+        kept = np.flatnonzero(keep)
+        # the segment (between kept points) that each point is in
+        segment = np.minimum(np.searchsorted(kept, indices, side="right") - 1, len(kept) - 2)
+        start = points[kept[segment]]
+        delta = points[kept[segment + 1]] - start
+        offset = points - start
+        norm = np.hypot(delta[:, 0], delta[:, 1])
+        cross = np.abs(delta[:, 1] * offset[:, 0] - delta[:, 0] * offset[:, 1])
+        # distance from the line, or from the start if the segment has no length
+        distances = np.where(norm > 0, cross / np.where(norm > 0, norm, 1),
+                             np.hypot(offset[:, 0], offset[:, 1]))
+        distances[keep] = 0
+        furthest = np.maximum.reduceat(distances, kept[:-1])
+        split = (distances == furthest[segment]) & (furthest[segment] > tolerance) & ~keep
+        if not split.any():
+            return points[keep]
+        # keep the first furthest point of each segment
+        candidates = np.flatnonzero(split)
+        _, first = np.unique(segment[candidates], return_index=True)
+        keep[candidates[first]] = True
+
+
+def simplify_contour(contour, tolerance=TOLERANCE):
+    """
+    Simplify a contour. A closed contour (where the last point is the same
+    as the first) is returned without the repeated last point.
+    """
+    contour = np.asarray(contour, dtype=np.float64)
+    if len(contour) > 3 and np.array_equal(contour[0], contour[-1]):
+        # split at the point furthest from the start, so each half is open
+        contour = contour[:-1]
+        far = int(np.argmax(np.hypot(*(contour - contour[0]).T)))
+        first = douglas_peucker(contour[:far + 1], tolerance)
+        second = douglas_peucker(np.vstack([contour[far:], contour[:1]]), tolerance)
+        return np.vstack([first, second[1:-1]])
+    return douglas_peucker(contour, tolerance)
+
+
+def format_points(xy, precision=PRECISION):
+    """Format (N, 2) x, y coordinates as "x,y x,y ..." with one % operation."""
+    if len(xy) == 0:
+        return ""
+    point_format = "%.{0}f,%.{0}f".format(precision)
+    return " ".join([point_format] * len(xy)) % tuple(np.asarray(xy).ravel())
+
+
+class EncodingStats(object):
+    """Counts the points and bytes saved by encode_contour()."""
+
+    def __init__(self):
+        self.shapes = 0
+        self.points_in = 0
+        self.points_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self, contour, xy, points):
+        self.shapes += 1
+        self.points_in += len(contour)
+        self.points_out += len(xy)
+        # the size of the points as they were written before
+        self.bytes_in += len(", ".join(["%s,%s" % (p[1], p[0]) for p in contour]))
+        self.bytes_out += len(points)
+
+    def report(self):
+        saved = 100 * (1 - self.bytes_out / self.bytes_in) if self.bytes_in else 0
+        return "%s shapes: %s -> %s points, %s -> %s bytes (%.1f%% saved)" % (
+            self.shapes, self.points_in, self.points_out,
+            self.bytes_in, self.bytes_out, saved)
+
+
+def encode_contour(contour, x_offset=0, y_offset=0, tolerance=TOLERANCE,
+                   precision=PRECISION, max_points=MAX_POINTS, stats=None):
+    """
+    Return the points string for a (row, col) contour from find_contours().
+
+    If there are more than max_points after simplification, the tolerance is
+    doubled until there are not (or every nth point is taken, as a last resort).
+    """
+    contour = np.asarray(contour, dtype=np.float64)
+    simple = simplify_contour(contour, tolerance)
+    for _ in range(10):
+        if len(simple) <= max_points:
+            break
+        tolerance *= 2
+        simple = simplify_contour(contour, tolerance)
+    if len(simple) > max_points:
+        simple = simple[::int(np.ceil(len(simple) / max_points))]
+    xy = simple[:, ::-1] + (x_offset, y_offset)
+    points = format_points(xy, precision)
+    if stats is not None:
+        stats.add(contour, xy, points)
+    return points
+
+
+def random_contours(count, seed=0):
+    """Noisy circles of (row, col) points, like find_contours() of nuclei."""
+    rng = np.random.default_rng(seed)
+    contours = []
+    for _ in range(count):
+        radius = rng.uniform(5, 50)
+        angles = np.linspace(0, 2 * np.pi, int(2 * np.pi * radius))
+        radii = radius + rng.normal(0, 0.3, len(angles))
+        contour = np.column_stack([rng.uniform(0, 10000) + radii * np.sin(angles),
+                                   rng.uniform(0, 10000) + radii * np.cos(angles)])
+        contour[-1] = contour[0]
+        contours.append(contour)
+    return contours
+
+
+def benchmark(count=1000):
+    contours = random_contours(count)
+    start = default_timer()
+    for contour in contours:
+        ", ".join(["%s,%s" % (xy[1], xy[0]) for xy in contour])
+    print("%%s,%%s formatting: %.3f s" % (default_timer() - start))
+    stats = EncodingStats()
+    start = default_timer()
+    for contour in contours:
+        encode_contour(contour, stats=stats)
+    print("encode_contour:    %.3f s (with stats)" % (default_timer() - start))
+    print(stats.report())
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -29,6 +29,11 @@ Copy Dataset or Image to target server, using Dataset:ID or Image:ID
 
 $ python copy_dataset.py username password target.example.org Dataset:123
 
+To sync: copy only what is not already on the target, into the same
+Dataset as last time, using a local record of what has been copied:
+
+$ python copy_dataset.py username password target.example.org Dataset:123 --sync copy_state.db
+
 NB: This needs omero-python-importer to import original files.
 """
 
@@ -46,7 +51,17 @@ from omero.cli import cli_login
 from omero.gateway import BlitzGateway, DatasetWrapper
 from omero.rtypes import rint, rstring
 from omero.model import DatasetI
-import tempfile
+import time
+
+from sync_state import IMPORTED, SyncState
+from tile_reader import PREFETCH
+from tile_writer import copy_pixels
+
+bytes_in_mb = 1048576
+# Size of the blocks downloaded and uploaded
+BLOCK_SIZE = 2 * 1048576
+# Files copied at the same time
+WORKERS = 4
 
 if __name__ == '__main__':
     # Add current dir to sys.path so we can import omero_importer
@@ -54,9 +69,9 @@ if __name__ == '__main__':
     curr_dir = os.path.dirname(os.path.join(os.getcwd(), __file__))
     sys.path.append(os.path.normpath(os.path.join(curr_dir, '..', '..')))
     try:
-        from omero_importer import full_import
+        from omero_importer import stream_import
     except ImportError:
-        full_import = None
+        stream_import = None
         pass
 
 
@@ -67,54 +82,99 @@ def getTargetPath(fsFile, templatePrefix):
         return os.path.join(relPath, fsFile.getName())
 
 
-def copy_fileset(conn2, fileset, new_dataset=None):
-    # Download all the files from fileset, create a new fileset
-    # on target server and re-import into new_dataset
+def read_file_blocks(used_file, block_size=BLOCK_SIZE):
+    """
+    Yield the bytes of an OriginalFile, block_size at a time.
+
+    Not getFileInChunks(), which uses the connection's shared RawFileStore:
+    each call has its own store, so files can be read on several threads.
+    """
+    conn = used_file._conn
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(used_file.getDetails().getGroup().getId())
+    size = used_file.getSize()
+    store = conn.c.sf.createRawFileStore()
+    try:
+        store.setFileId(used_file.getId(), ctx)
+        pos = 0
+        while pos < size:
+            block = store.read(pos, min(block_size, size - pos))
+            if not block:
+                raise IOError("File %s ended at %s of %s bytes" % (used_file.getId(), pos, size))
+            yield block
+            pos += len(block)
+    finally:
+        store.close()
+
+
+def copy_fileset(conn2, fileset, new_dataset=None, block_size=BLOCK_SIZE, workers=WORKERS,
+                 state=None):
+    # Stream all the files from fileset to a new fileset
+    # on target server and re-import into new_dataset.
+    # Each file is downloaded in blocks that are uploaded (and hashed)
+    # as they arrive, workers files at a time, without a local copy.
 
     print("copy_fileset...", fileset.id)
-    bytes_in_mb = 1048576
-    chunk_size = 2 * 1048576
     templatePrefix = fileset.getTemplatePrefix()
+    used_files = list(fileset.listFiles())
+    # client paths are only used to name the files on the target server
+    paths = [os.path.join(os.sep, "fileset_%s" % fileset.id,
+                          getTargetPath(used_file, templatePrefix))
+             for used_file in used_files]
+    total_bytes = sum(used_file.getSize() for used_file in used_files)
+    print("files", len(used_files), "size (MB)", total_bytes / bytes_in_mb)
+
+    def download(i):
+        return read_file_blocks(used_files[i], block_size)
+
+    start = time.time()
     img_ids = []
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        print('created temporary directory', tmpdirname)
-        for used_file in fileset.listFiles():
-            rel_path = getTargetPath(used_file, templatePrefix)
-            file_path = os.path.join(tmpdirname, rel_path)
-            dir_name = os.path.dirname(file_path)
-            file_size = used_file.getSize()
-            print("file_size (bytes)", file_size)
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
-            print('downloading file to', file_path)
-            downloaded_bytes = 0
-            with open(str(file_path), "wb") as f:
-                for chunk in used_file.getFileInChunks(chunk_size):
-                    downloaded_bytes += chunk_size
-                    print(f"download: {(downloaded_bytes/file_size) * 100} %")
-                    f.write(chunk)
-
-        # re-import to target server
-        client = conn2.c
-        rsp = full_import(client, tmpdirname)
-        if rsp:
-            links = []
-            for p in rsp.pixels:
-                print ('Imported Image ID: %d' % p.image.id.val)
-                img_ids.append(p.image.id.val)
-                if new_dataset:
-                    link = omero.model.DatasetImageLinkI()
-                    link.parent = omero.model.DatasetI(new_dataset.id, False)
-                    link.child = omero.model.ImageI(p.image.id.val, False)
-                    links.append(link)
-            if len(links) > 0:
-                conn2.getUpdateService().saveArray(links, conn2.SERVICE_OPTS)
+    # re-import to target server
+    client = conn2.c
+    rsp = stream_import(client, paths, download, workers=workers)
+    duration = time.time() - start
+    print("copied %.1f MB in %.1f s" % (total_bytes / bytes_in_mb, duration))
+    if rsp:
+        for p in rsp.pixels:
+            print ('Imported Image ID: %d' % p.image.id.val)
+            img_ids.append(p.image.id.val)
+        if state is not None:
+            state.set_fileset_images(fileset.id, img_ids)
+        if new_dataset:
+            link_images(conn2, img_ids, new_dataset)
     return img_ids
 
 
-def copy_filesets(conn2, images, new_dataset):
+def link_images(conn2, image_ids, new_dataset):
+    links = []
+    for image_id in image_ids:
+        link = omero.model.DatasetImageLinkI()
+        link.parent = omero.model.DatasetI(new_dataset.id, False)
+        link.child = omero.model.ImageI(image_id, False)
+        links.append(link)
+    if len(links) > 0:
+        conn2.getUpdateService().saveArray(links, conn2.SERVICE_OPTS)
+
+
+def existing_images(conn2, image_ids):
+    """The IDs of the Images on the target server, of image_ids."""
+    if len(image_ids) == 0:
+        return set()
+    return {image.id for image in conn2.getObjects("Image", image_ids)}
+
+
+def file_records(used_files):
+    """(ID, size, hash) of each file, to tell if a copied Fileset has changed."""
+    return [(f.id, f.getSize(), f.getHash() or '')
+            for f in sorted(used_files, key=lambda f: f.id)]
+
+
+def copy_filesets(conn2, images, new_dataset, block_size=BLOCK_SIZE, workers=WORKERS,
+                  state=None):
     # find all filesets for the images
-    if full_import is None:
+    # With a SyncState, filesets that were already imported (and whose files
+    # and target images are unchanged) are only linked to new_dataset.
+    if stream_import is None:
         print(IMPORT_TODO)
         return []
 
@@ -126,38 +186,57 @@ def copy_filesets(conn2, images, new_dataset):
             filesets[fset.id] = fset
 
     img_ids = []
+    linked = {image.id for image in new_dataset.listChildren()} if state else set()
     for fileset in filesets.values():
-        ids = copy_fileset(conn2, fileset, new_dataset)
+        if state is not None:
+            files = file_records(fileset.listFiles())
+            record = state.get_fileset(fileset.id)
+            if (record is not None and record['status'] == IMPORTED and
+                    record['files'] == files):
+                ids = record['image_ids']
+                if len(existing_images(conn2, ids)) == len(ids):
+                    print("Fileset", fileset.id, "already copied to Images", ids)
+                    link_images(conn2, [i for i in ids if i not in linked], new_dataset)
+                    img_ids.extend(ids)
+                    continue
+            state.start_fileset(fileset.id, files)
+        ids = copy_fileset(conn2, fileset, new_dataset, block_size, workers, state)
         img_ids.extend(ids)
 
     return img_ids
 
 
-def copy_image(conn2, image, new_dataset):
-    """Create a copy of image."""
-    image_name = image.getName()
-    size_Z = image.getSizeZ()
-    size_C = image.getSizeC()
-    size_T = image.getSizeT()
-    total_planes = size_Z * size_C * size_T
-    clist = image.getChannelLabels()
-    zct_list = []
-    for z in range(size_Z):
-        for c in range(size_C):
-            for t in range(size_T):
-                zct_list.append( (z,c,t) )
-
-    def planeGen():
-        plane_count = 0
-        planes = image.getPrimaryPixels().getPlanes(zct_list)
-        for p in planes:
-            plane_count += 1
-            print(plane_count, '/', total_planes)
-            yield p
-
-    img = conn2.createImageFromNumpySeq(planeGen(), image_name, sizeZ=size_Z,
-                                       sizeC=size_C, sizeT=size_T,
-                                       channelList=clist, dataset=new_dataset._obj)
+def copy_images(conn2, images, new_dataset, state=None, prefetch=PREFETCH):
+    """Copy the pixels of images, skipping ones already copied to the target."""
+    copied = {}
+    linked = set()
+    if state is not None:
+        for image in images:
+            target_id = state.get_image(image.id)
+            if target_id is not None:
+                copied[image.id] = target_id
+        existing = existing_images(conn2, list(copied.values()))
+        copied = {k: v for k, v in copied.items() if v in existing}
+        linked = {image.id for image in new_dataset.listChildren()}
+    img_ids = []
+    for image in images:
+        print("Image", image.id, image.name)
+        if image.id in copied:
+            print("already copied to Image", copied[image.id])
+            if copied[image.id] not in linked:
+                link_images(conn2, [copied[image.id]], new_dataset)
+            img_ids.append(copied[image.id])
+            continue
+        new_id = copy_image(conn2, image, new_dataset, prefetch)
+        if state is not None:
+            state.set_image(image.id, new_id)
+        img_ids.append(new_id)
+    return img_ids
+
+
+def copy_image(conn2, image, new_dataset, prefetch=PREFETCH):
+    """Create a copy of image, tile by tile."""
+    img = copy_pixels(image, conn2, dataset_id=new_dataset.id, prefetch=prefetch)
     # NB: could also copy rendering settings, annotations etc.
     print("New image", img.id, img.name)
     return img.id
@@ -171,6 +250,15 @@ def main(argv):
     parser.add_argument('--pixels', help='Only copy pixels, not original files',
         action="store_true")
     parser.add_argument('--port', default=4064, help="OMERO server port")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+        help="Number of files to copy at the same time")
+    parser.add_argument('--block_size', type=int, default=BLOCK_SIZE,
+        help="Size in bytes of the blocks to download and upload")
+    parser.add_argument('--prefetch', type=int, default=PREFETCH,
+        help="With --pixels, number of tiles to read ahead of writing")
+    parser.add_argument('--sync', help=(
+        "SQLite file recording what has been copied to the target. "
+        "Objects already copied are skipped, and copied into the same Dataset"))
     parser.add_argument('object', help=(
         'Object to copy, Image:ID or Dataset:ID'))
     args = parser.parse_args(argv)
@@ -204,21 +292,29 @@ def main(argv):
             print("The 'object' needs to be Image:ID or Dataset:ID")
             return
 
-        update_service = conn2.getUpdateService()
-        new_dataset = DatasetWrapper(conn2, DatasetI())
-        new_dataset.setName(dataset_name)
-        new_dataset.save()
+        state = SyncState(args.sync, args.server2) if args.sync else None
+        new_dataset = None
+        if state is not None:
+            dataset_id = state.get_dataset(source_object)
+            if dataset_id is not None:
+                new_dataset = conn2.getObject("Dataset", dataset_id)
+        if new_dataset is None:
+            new_dataset = DatasetWrapper(conn2, DatasetI())
+            new_dataset.setName(dataset_name)
+            new_dataset.save()
+            if state is not None:
+                state.set_dataset(source_object, new_dataset.id)
 
         print('pixels only?', args.pixels)
         if args.pixels:
-            img_ids = []
-            for image in images:
-                print("Image", image.id, image.name)
-                img_ids.append(copy_image(conn2, image, new_dataset))
+            img_ids = copy_images(conn2, images, new_dataset, state, args.prefetch)
         else:
-            img_ids = copy_filesets(conn2, images, new_dataset)
-        
-        print(f'{len(img_ids)} images imported into new Dataset: {new_dataset.id}')
+            img_ids = copy_filesets(conn2, images, new_dataset,
+                                    args.block_size, args.workers, state)
+        if state is not None:
+            state.close()
+
+        print(f'{len(img_ids)} images in Dataset: {new_dataset.id}')
 
     conn2.close()
 
@@ -8,15 +8,18 @@ from skimage import measure
 
 import argparse
 import sys
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 import omero
 import omero.clients
 from omero.rtypes import unwrap, rint, rstring
 from omero.cli import cli_login
-from omero.api import RoiOptions
 from omero.gateway import BlitzGateway
 
+from contour_encoder import EncodingStats, encode_contour
+from roi_replicator import map_images, replicate_rois
+
 
 def mask_to_binim_yx(mask):
     """
@@ -38,16 +41,36 @@ def mask_to_binim_yx(mask):
     w = int(mask.width.val)
     h = int(mask.height.val)
 
-    mask_packed = mask.getBytes()
-    # convert bytearray into something we can use
-    intarray = np.fromstring(mask_packed, dtype=np.uint8)
-    binarray = np.unpackbits(intarray)   #.astype(self.dtype)
-    # truncate and reshape
-    binarray = np.reshape(binarray[: (w * h)], (h, w))
+    binarray = decode_mask(mask.getBytes(), w, h)
 
     return binarray, (t, c, z, y, x, h, w)
 
 
+def decode_mask(mask_packed, w, h):
+    """Unpack the bits of a mask into a (h, w) bool array."""
+    intarray = np.frombuffer(mask_packed, dtype=np.uint8)
+    # truncate and reshape
+    binarray = np.unpackbits(intarray, count=w * h)
+    return binarray.reshape((h, w)).view(bool)
+
+
+def mask_to_contour(task):
+    """
+    Return the longest contour of a mask, in image coordinates, or None.
+    Runs in a worker process.
+
+    task is (mask bytes, x, y, w, h). The contour is found in the mask
+    padded by 1 pixel (so contours at the edge are closed), not in the
+    whole image, so memory depends on the size of the mask.
+    """
+    mask_packed, x, y, w, h = task
+    np_mask = np.pad(decode_mask(mask_packed, w, h), 1)
+    contours = measure.find_contours(np_mask, 0.5)
+    if len(contours) == 0:
+        return None
+    return get_longest_contour(contours) + (y - 1, x - 1)
+
+
 def rgba_to_int(red, green, blue, alpha=255):
     """ Return the color as an Integer in RGBA encoding """
     r = red << 24
@@ -65,23 +88,17 @@ def get_longest_contour(contours):
     for c in contours:
         if len(c) > len(contour):
             contour = c
-    return c
+    return contour
 
 
-def add_polygon(roi, contour, x_offset=0, y_offset=0, z=None, t=None):
+def add_polygon(roi, contour, x_offset=0, y_offset=0, z=None, t=None, stats=None):
     """ points is 2D list of [[x, y], [x, y]...]"""
 
-    stride = 4
-    coords = []
-    # points in contour are adjacent pixels, which is too verbose
-    # take every nth point
-    for count, xy in enumerate(contour):
-        if count%stride == 0:
-            coords.append(xy)
-    if len(coords) < 2:
+    if len(contour) < 3:
         return
-    points = ["%s,%s" % (xy[1] + x_offset, xy[0] + y_offset) for xy in coords]
-    points = ", ".join(points)
+    # points in contour are adjacent pixels, which is too verbose
+    # so we simplify them
+    points = encode_contour(contour, x_offset, y_offset, stats=stats)
 
     polygon = omero.model.PolygonI()
     if z is not None:
@@ -94,80 +111,76 @@ def add_polygon(roi, contour, x_offset=0, y_offset=0, z=None, t=None):
     roi.addShape(polygon)
 
 
+def masks_to_polygons(rois, image_id, executor, stats=None):
+    """
+    New ROIs on the Image image_id, with a Polygon for each Mask of the ROIs.
+    The contours of all the Masks are found in parallel, by the executor.
+    """
+    roi_masks = []
+    tasks = []
+    for roi in rois:
+        masks = [shape for shape in roi.copyShapes()
+                 if isinstance(shape, omero.model.MaskI)]
+        roi_masks.append(masks)
+        for mask in masks:
+            tasks.append((mask.getBytes(), int(mask.x.val), int(mask.y.val),
+                          int(mask.width.val), int(mask.height.val)))
+    contours = executor.map(mask_to_contour, tasks, chunksize=8)
+
+    new_rois = []
+    for masks in roi_masks:
+        if len(masks) == 0:
+            continue
+        new_roi = omero.model.RoiI()
+        new_roi.setImage(omero.model.ImageI(image_id, False))
+        for mask in masks:
+            contour = next(contours)
+            if contour is not None:
+                # Only add 1 Polygon per Mask Shape: the longest contour
+                add_polygon(new_roi, contour, 0, 0,
+                            unwrap(mask.theZ), unwrap(mask.theT), stats)
+        new_rois.append(new_roi)
+    return new_rois
+
+
 def main(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('username2', help='Target server Username')
     parser.add_argument('password2', help='Target server Password')
     parser.add_argument('server2', help='Target server')
     parser.add_argument('imageid', type=int, help=(
-        'Copy ROIs FROM this image'))
+        'Copy ROIs FROM this image (or Dataset/Plate, see --type)'))
     parser.add_argument('imageid2', type=int, help=(
-        'Copy ROIs TO this image'))
+        'Copy ROIs TO this image (or Dataset/Plate, see --type)'))
+    parser.add_argument('--type', default='Image', choices=['Image', 'Dataset', 'Plate'],
+                        help=('Copy all the Images of a Dataset (matched by name) '
+                              'or Plate (matched by Well and Field)'))
+    parser.add_argument('--page_size', type=int, default=50,
+                        help='Number of ROIs to load at a time')
+    parser.add_argument('--workers', type=int, help=(
+        'Number of processes for finding contours'))
     args = parser.parse_args(argv)
 
-    to_image_id = args.imageid2
-
-    PAGE_SIZE = 50
-
     with cli_login() as cli:
         conn = BlitzGateway(client_obj=cli._client)
         conn2 = BlitzGateway(args.username2, args.password2,
                              port=4064, host=args.server2)
         conn2.connect()
 
-        roi_service = conn.getRoiService()
-        update_service = conn2.getUpdateService()
+        conn.SERVICE_OPTS.setOmeroGroup(-1)
+        image_map = map_images(conn, conn2, args.type, args.imageid, args.imageid2)
+        print("Images:", len(image_map))
 
-        opts = RoiOptions()
-        offset = 0
-        opts.offset = rint(offset)
-        opts.limit = rint(PAGE_SIZE)
+        stats = EncodingStats()
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            def transform(rois, image_id):
+                return masks_to_polygons(rois, image_id, executor, stats)
 
-        conn.SERVICE_OPTS.setOmeroGroup(-1)
-        image = conn.getObject('Image', args.imageid)
-        size_x = image.getSizeX()
-        size_y = image.getSizeY()
-        print(image.name)
-
-        # NB: we repeat this query below for each 'page' of ROIs
-        result = roi_service.findByImage(args.imageid, opts, conn.SERVICE_OPTS)
-
-        while len(result.rois) > 0:
-            print("offset", offset)
-            print("Found ROIs:", len(result.rois))
-            for roi in result.rois:
-
-                new_roi = omero.model.RoiI()
-                new_roi.setImage(omero.model.ImageI(to_image_id, False))
-                shapes_added = False
-
-                for shape in roi.copyShapes():
-
-                    if not isinstance(shape, omero.model.MaskI):
-                        continue
-                    # assume shape is a Mask
-                    np_mask, dims = mask_to_binim_yx(shape)
-                    print('shape', np_mask.shape)
-                    t, c, z, y, x, h, w = dims
-                    print('dims', dims)
-                    image = np.zeros((size_y, size_x))
-                    image[y:y+h, x:x+w] = np_mask
-                    contours = measure.find_contours(image, 0.5)
-                    print('Found contours:', len(contours))
-                    if len(contours) > 0:
-                        contour = get_longest_contour(contours)
-                        # Only add 1 Polygon per Mask Shape.
-                        # First is usually the longest
-                        add_polygon(new_roi, contour, 0, 0, z, t)
-                    shapes_added = True
-
-                if shapes_added:
-                    update_service.saveObject(new_roi)
-
-            offset += PAGE_SIZE
-            opts.offset = rint(offset)
-            result = roi_service.findByImage(args.imageid, opts, conn.SERVICE_OPTS)
+            roi_ids = replicate_rois(conn, conn2, image_map, transform=transform,
+                                     page_size=args.page_size)
 
+        print("Saved ROIs:", len(roi_ids))
+        print(stats.report())
         conn2.close()
 
 if __name__ == '__main__':
@@ -1,24 +1,14 @@
 
 import numpy as np
 from omero.gateway import BlitzGateway
-from omero.model import enums as omero_enums
+
+from tile_reader import PIXEL_TYPES, TileReader
 
 conn = BlitzGateway('username', 'password', port=4064, host='localhost')
 conn.connect()
 
 
 
-PIXEL_TYPES = {
-    omero_enums.PixelsTypeint8: np.int8,
-    omero_enums.PixelsTypeuint8: np.uint8,
-    omero_enums.PixelsTypeint16: np.int16,
-    omero_enums.PixelsTypeuint16: np.uint16,
-    omero_enums.PixelsTypeint32: np.int32,
-    omero_enums.PixelsTypeuint32: np.uint32,
-    omero_enums.PixelsTypefloat: np.float32,
-    omero_enums.PixelsTypedouble: np.float64,
-}
-
 IMAGE_ID = 2566
 image = conn.getObject("image", IMAGE_ID)
 print('image', image.name)
@@ -44,8 +34,16 @@ try:
 finally:
     pix.close()
 
-tile = np.frombuffer(tile, dtype=dtype)
+# tiles are big-endian
+tile = np.frombuffer(tile, dtype=np.dtype(dtype).newbyteorder('>'))
 tile = tile.reshape((h, w))
 
 print(tile.shape)
 
+# The same, using TileReader, where level 0 is the biggest
+with TileReader(image) as reader:
+    level = reader.level_count - 1 - 2
+    w, h = reader.get_tile_size(level)
+    tile = reader.get_tile(z, c, t, x, y, w, h, level=level)
+print(tile.shape, tile.dtype)
+
@@ -20,7 +20,7 @@
 """
 This script connects to IDR and copies a Plate to another OMERO server.
 
-It creates new images via getPlane() and createImageFromNumpySeq().
+It creates new images via getTile() and setTile(), see tile_writer.py.
 NB: New images are only a single T and Z.
 Usage: $ python idr_copy_plate.py username password idr_plate_id
 """
@@ -32,24 +32,12 @@ from omero.gateway import BlitzGateway
 from omero.rtypes import rint, rstring
 from omero.model import ProjectI
 
+from tile_writer import copy_pixels
+
 
 def copy_image(conn, idr_image):
-    """Create a copy of image. Single Z and T."""
-    image_name = idr_image.getName()
-    size_C = idr_image.getSizeC()
-    clist = idr_image.getChannelLabels()
-    zct_list = []
-    for c in range(size_C):
-        zct_list.append((0, c, 0))
-
-    def planeGen():
-        planes = idr_image.getPrimaryPixels().getPlanes(zct_list)
-        for p in planes:
-            yield p
-
-    img = conn.createImageFromNumpySeq(planeGen(), image_name, sizeZ=1,
-                                       sizeC=size_C, sizeT=1,
-                                       channelList=clist)
+    """Create a copy of image, tile by tile. Single Z and T."""
+    img = copy_pixels(idr_image, conn, size_z=1, size_t=1)
     print("New image", img.id, img.name)
     return img
 
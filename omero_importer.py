@@ -41,10 +41,13 @@ https://github.com/openmicroscopy/openmicroscopy/blob/develop/components/tools/O
 """
 
 import argparse
+import hashlib
 import locale
 import os
 import platform
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import omero.clients
 from omero.cli import cli_login
@@ -56,6 +59,10 @@ from omero_version import omero_version
 from omero.callbacks import CmdCallbackI
 from omero.gateway import BlitzGateway
 
+BLOCK_SIZE = 1000 * 1000
+# Files uploaded at the same time
+WORKERS = 4
+
 
 def get_files_for_fileset(fs_path):
     if os.path.isfile(fs_path):
@@ -111,32 +118,70 @@ def create_settings():
     return settings
 
 
-def upload_files(proc, files, client):
-    """Upload files to OMERO from local filesystem."""
-    ret_val = []
-    for i, fobj in enumerate(files):
+def upload_blocks(rfs, blocks):
+    """
+    Write the blocks of bytes to the uploader rfs, and return their SHA1.
+    The hash is computed as the blocks are written, not by reading again.
+    """
+    sha1 = hashlib.sha1()
+    offset = 0
+    rfs.write([], offset, 0)  # Touch
+    for block in blocks:
+        rfs.write(block, offset, len(block))
+        sha1.update(block)
+        offset += len(block)
+    return sha1.hexdigest()
+
+
+def read_blocks(path, block_size=BLOCK_SIZE):
+    """Yield the bytes of a local file, block_size at a time."""
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            yield block
+
+
+def upload_streams(proc, names, open_blocks, workers=WORKERS):
+    """
+    Upload files to the import process, workers at a time, and return the
+    SHA1 of each. open_blocks(i) returns an iterable of the bytes of file i.
+    """
+    def upload(i):
         rfs = proc.getUploader(i)
         try:
-            with open(fobj, 'rb') as f:
-                print ('Uploading: %s' % fobj)
-                offset = 0
-                block = []
-                rfs.write(block, offset, len(block))  # Touch
-                while True:
-                    block = f.read(1000 * 1000)
-                    if not block:
-                        break
-                    rfs.write(block, offset, len(block))
-                    offset += len(block)
-                ret_val.append(client.sha1(fobj))
+            start = time.time()
+            print ('Uploading: %s' % names[i])
+            blocks = open_blocks(i)
+            try:
+                sha1 = upload_blocks(rfs, blocks)
+            finally:
+                # e.g. close the store of a generator that was not finished
+                if hasattr(blocks, 'close'):
+                    blocks.close()
+            print ('Uploaded: %s in %.1f s' % (names[i], time.time() - start))
+            return sha1
         finally:
             rfs.close()
-    return ret_val
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(upload, range(len(names))))
+
+
+def upload_files(proc, files, client, block_size=BLOCK_SIZE, workers=WORKERS):
+    """Upload files to OMERO from local filesystem."""
+    return upload_streams(proc, files, lambda i: read_blocks(files[i], block_size), workers)
 
 
 def assert_import(client, proc, files, wait):
     """Wait and check that we imported an image."""
     hashes = upload_files(proc, files, client)
+    return wait_for_import(client, proc, hashes, wait)
+
+
+def wait_for_import(client, proc, hashes, wait):
+    """Verify the uploaded files and wait for the import."""
     print ('Hashes:\n  %s' % '\n  '.join(hashes))
     handle = proc.verifyUpload(hashes)
     cb = CmdCallbackI(client, handle)
@@ -175,6 +220,24 @@ def full_import(client, fs_path, wait=-1):
         proc.close()
 
 
+def stream_import(client, paths, open_blocks, wait=-1, workers=WORKERS):
+    """
+    Import a fileset without local files, e.g. while downloading it from
+    another server. paths are the client paths of the files in the fileset,
+    and open_blocks(i) returns an iterable of the bytes of file i.
+    """
+    mrepo = client.getManagedRepository()
+    fileset = create_fileset(paths)
+    settings = create_settings()
+
+    proc = mrepo.importFileset(fileset, settings)
+    try:
+        hashes = upload_streams(proc, paths, open_blocks, workers)
+        return wait_for_import(client, proc, hashes, wait)
+    finally:
+        proc.close()
+
+
 def main(argv):
     parser = argparse.ArgumentParser()
     # parser.addArgument('--session', type=int, help=(
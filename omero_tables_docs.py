@@ -3,11 +3,13 @@
 
 import argparse
 import sys
+import numpy as np
 from omero.cli import cli_login
 from random import random
 from omero.gateway import BlitzGateway
-from omero.grid import LongColumn, StringColumn, DoubleColumn, ImageColumn
-from omero.model import FileAnnotationI, OriginalFileI, DatasetAnnotationLinkI, DatasetI
+from omero.model import FileAnnotationI, DatasetAnnotationLinkI, DatasetI
+
+from table_writer import TableWriter, OmeroTableBackend, save_file_annotation
 
 
 def create_table(conn, dataset_id):
@@ -25,38 +27,17 @@ def create_table(conn, dataset_id):
                 'random_number': random(),
             }
         )
-    # Determine column definitions
-    n = len(data)
-    cols = []
-    for key, value in data[0].items():
-        if key == 'image':
-            cols.append(ImageColumn(key, '', [0] * n))
-        elif isinstance(value, int):
-            cols.append(LongColumn(key, 'Integer value column', [0] * n))
-        elif isinstance(value, float):
-            cols.append(DoubleColumn(key, '', [0.0] * n))
-        elif isinstance(value, str):
-            cols.append(StringColumn(
-                key, 'String col to store text', 64, ['-'] * n))
-    # initialize table
-    resources = conn.c.sf.sharedResources()
-    repository_id = resources.repositories(
-    ).descriptions[0].getId().getValue()
-    table = resources.newTable(
-        repository_id, "test:%i" % int(random()*1e6))
-    table.initialize(cols)
-    # Populate the columns
-    for col in cols:
-        for row_ind, row in enumerate(data):
-            col.values[row_ind] = row[col.name]
-    # Upload the data
-    table.addData(cols)
-    table_file_id = table.getOriginalFile().id.val
-    table.close()
+    # One array per column. Column types and string widths are
+    # inferred from the data, except for the 'image' ID column
+    columns = {key: np.array([row[key] for row in data])
+               for key in data[0]}
+    # create the table and upload the data
+    backend = OmeroTableBackend(conn, "test:%i" % int(random()*1e6))
+    writer = TableWriter(backend, column_types={'image': 'image'})
+    writer.write(columns)
+    orig_file = writer.close()
     # link the table file to the Dataset
-    annotation = FileAnnotationI()
-    annotation.setFile(OriginalFileI(table_file_id, False))
-    annotation = conn.getUpdateService().saveAndReturnObject(annotation)
+    annotation = save_file_annotation(conn, orig_file)
     link = DatasetAnnotationLinkI()
     link.setParent(DatasetI(dataset.getId(), False))
     link.setChild(FileAnnotationI(annotation.getId().getValue(), False))
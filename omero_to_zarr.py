@@ -11,6 +11,24 @@ import xarray as xr
 import numpy
 import zarr
 
+from tile_reader import TileReader, get_tiles, prefetch_tiles
+
+# image_to_ome_zarr() writes TCZYX OME-Zarr, chunked by tiles of TILE_SIZE.
+# Tiles are read with a TileReader on a background thread, up to
+# PREFETCH tiles ahead of the compression and writing of tiles to zarr.
+TILE_SIZE = 1024
+PREFETCH = 8
+
+# OME-Zarr space units: the lower-case names of OMERO's UnitsLength, except
+# those that aren't valid UDUNITS-2 e.g. PIXEL (see test_cfunits.py)
+NGFF_SPACE_UNITS = {
+    "angstrom", "attometer", "centimeter", "decimeter", "exameter",
+    "femtometer", "foot", "gigameter", "hectometer", "inch", "kilometer",
+    "megameter", "meter", "micrometer", "mile", "millimeter", "nanometer",
+    "parsec", "petameter", "picometer", "terameter", "yard", "yoctometer",
+    "yottameter", "zeptometer", "zettameter",
+}
+
 
 def get_data(img, c=0):
     """
@@ -100,6 +118,90 @@ def image_to_zarr(image):
                 za[c, z, t, :, :] = plane
 
 
+def tiles_to_zarr(reader, za, level=0, prefetch=PREFETCH):
+    """
+    Copy all the pixels of a level from the TileReader to the 5D TCZYX zarr
+    array za. Each tile is the size of a chunk in za.
+    """
+    size_t, size_c, size_z, size_y, size_x = za.shape
+    tile_h, tile_w = za.chunks[-2:]
+    tiles = get_tiles(size_t, size_c, size_z, size_y, size_x, tile_w, tile_h)
+    count = 0
+    for (z, c, t, x, y, w, h), tile in prefetch_tiles(reader, tiles, level, prefetch):
+        za[t, c, z, y:y + h, x:x + w] = tile
+        count += 1
+        if count % 100 == 0 or count == len(tiles):
+            print("written %s / %s tiles" % (count, len(tiles)))
+
+
+def write_multiscales(root, image, factors=(1,)):
+    """
+    Write the OME-Zarr (0.4) multiscales metadata, with pixel sizes if known.
+
+    Each pixel size is in its OMERO unit, which is only given as the axis
+    unit if it is a valid OME-Zarr unit.
+    factors are the downsampling in X and Y of each level, from level 0.
+    """
+    axes = [
+        {"name": "t", "type": "time"},
+        {"name": "c", "type": "channel"},
+        {"name": "z", "type": "space"},
+        {"name": "y", "type": "space"},
+        {"name": "x", "type": "space"},
+    ]
+    scale = [1.0, 1.0]
+    sizes = (image.getPixelSizeZ(units=True), image.getPixelSizeY(units=True),
+             image.getPixelSizeX(units=True))
+    for axis, size in zip(axes[2:], sizes):
+        if size is None or not size.getValue():
+            scale.append(1.0)
+            continue
+        scale.append(float(size.getValue()))
+        unit = str(size.getUnit()).lower()
+        if unit in NGFF_SPACE_UNITS:
+            axis["unit"] = unit
+    datasets = []
+    for level, factor in enumerate(factors):
+        level_scale = scale[:3] + [s * factor for s in scale[3:]]
+        datasets.append({"path": str(level), "coordinateTransformations": [{"type": "scale", "scale": level_scale}]})
+    root.attrs["multiscales"] = [{
+        "version": "0.4",
+        "name": image.getName(),
+        "axes": axes,
+        "datasets": datasets,
+    }]
+
+
+def image_to_ome_zarr(image, tile_size=TILE_SIZE, prefetch=PREFETCH, levels=1, store=None):
+    """
+    Export the image to TCZYX OME-Zarr, with up to `levels` resolutions
+    copied from the server's pyramid (if it has one), not downsampled here.
+    store is an optional RawPixelsStore, e.g. a fake one for testing.
+    """
+
+    size_c = image.getSizeC()
+    size_z = image.getSizeZ()
+    size_t = image.getSizeT()
+
+    name = '%s.ome.zarr' % image.id
+    root = zarr.open_group(name, mode='w')
+
+    with TileReader(image, store) as reader:
+        factors = []
+        for level, (size_x, size_y) in enumerate(reader.resolutions[:levels]):
+            print("level", level, "size", size_x, size_y)
+            za = root.create_dataset(
+                str(level),
+                shape=(size_t, size_c, size_z, size_y, size_x),
+                chunks=(1, 1, 1, min(tile_size, size_y), min(tile_size, size_x)),
+                dtype=reader.dtype,
+                dimension_separator="/",
+            )
+            tiles_to_zarr(reader, za, level, prefetch)
+            factors.append(reader.resolutions[0][0] / size_x)
+    write_multiscales(root, image, factors)
+
+
 def main(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('image_id', help='Image ID')
@@ -108,6 +210,14 @@ def main(argv):
         action="store_true",
         help=("Save as xarray, suitable for xpublish")
     )
+    parser.add_argument(
+        "--ome_zarr",
+        action="store_true",
+        help=("Save as TCZYX OME-Zarr, chunked by tiles")
+    )
+    parser.add_argument('--tile_size', type=int, default=TILE_SIZE, help='Tile (chunk) width and height')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH, help='Number of tiles to read ahead')
+    parser.add_argument('--levels', type=int, default=1, help='Number of resolutions to copy from the server')
     args = parser.parse_args(argv)
 
     with cli_login() as cli:
@@ -115,6 +225,8 @@ def main(argv):
         image = conn.getObject('Image', args.image_id)
         if args.xarray:
             image_to_xarray(image)
+        elif args.ome_zarr:
+            image_to_ome_zarr(image, args.tile_size, args.prefetch, args.levels)
         else:
             image_to_zarr(image)
 
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+put() and get() for bounded queues between threads, that give up when a
+stopped Event is set, so a thread doesn't block forever on a queue that
+the other side has stopped using.
+"""
+
+import queue
+
+
+def put(out_queue, item, stopped):
+    """Put item onto the queue, unless stopped is set while it is full."""
+    while not stopped.is_set():
+        try:
+            out_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def get(in_queue, stopped):
+    """Get an item from the queue, or None if stopped is set while it is empty."""
+    while not stopped.is_set():
+        try:
+            return in_queue.get(timeout=1)
+        except queue.Empty:
+            pass
+    return None
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+Copy ROIs from Images on one OMERO server to Images on another.
+
+The copy is a pipeline of three threads, connected by bounded queues so
+that a slow stage holds back the others instead of filling memory:
+
+    read:  pages of ROIs from the source, with findByImage()
+    clone: new unsaved ROIs for the target Images
+    write: batches of ROIs saved to the target, with a RoiWriter
+
+Shapes are cloned in memory, by copying their fields, not by encoding
+them to JSON and back.
+
+    image_map = map_images(conn, conn2, 'Dataset', dataset_id, dataset_id2)
+    roi_ids = replicate_rois(conn, conn2, image_map)
+
+`conn` and `conn2` only need the few BlitzGateway methods used here, so
+they can be fakes.
+"""
+
+from collections import OrderedDict
+import queue
+import threading
+
+import omero
+import omero.clients
+from omero.api import RoiOptions
+from omero.rtypes import rint
+
+from queue_helpers import get, put
+from roi_writer import DEFAULT_BATCH_SIZE, RoiWriter
+
+PAGE_SIZE = 100
+# Pages of ROIs that may wait between stages
+QUEUE_SIZE = 4
+
+# Fields that belong to the source object or server, not copied by clone_object()
+SKIP_FIELDS = {
+    '_id', '_details', '_version', '_loaded', '_roi', '_pixels',
+    '_annotationLinksSeq', '_annotationLinksLoaded', '_annotationLinksCountPerOwner',
+}
+# Linked objects that are copied with the shape
+CLONE_FIELDS = {'_transform'}
+
+
+def clone_object(obj):
+    """An unsaved copy of an omero.model object, e.g. a Shape."""
+    new_obj = obj.__class__()
+    for name, value in vars(obj).items():
+        if name in SKIP_FIELDS:
+            continue
+        if isinstance(value, omero.model.IObject):
+            if name not in CLONE_FIELDS:
+                continue
+            value = clone_object(value)
+        setattr(new_obj, name, value)
+    return new_obj
+
+
+def clone_rois(rois, image_id):
+    """Unsaved copies of the ROIs and their Shapes, on the Image image_id."""
+    new_rois = []
+    for roi in rois:
+        new_roi = omero.model.RoiI()
+        new_roi.setImage(omero.model.ImageI(image_id, False))
+        new_roi.name = roi.name
+        new_roi.description = roi.description
+        for shape in roi.copyShapes():
+            new_roi.addShape(clone_object(shape))
+        new_rois.append(new_roi)
+    return new_rois
+
+
+def map_dataset_images(conn, conn2, dataset_id, dataset_id2):
+    """
+    Map the IDs of Images in a source Dataset to Images in a target Dataset,
+    by name. Images with the same name are matched in order of ID.
+    """
+    def by_name(c, d_id):
+        dataset = c.getObject('Dataset', d_id)
+        if dataset is None:
+            raise ValueError('Dataset %s not found' % d_id)
+        images = {}
+        for image in sorted(dataset.listChildren(), key=lambda i: i.id):
+            images.setdefault(image.name, []).append(image.id)
+        return images
+
+    targets = by_name(conn2, dataset_id2)
+    image_map = OrderedDict()
+    for name, image_ids in sorted(by_name(conn, dataset_id).items()):
+        target_ids = targets.get(name, [])
+        if len(target_ids) != len(image_ids):
+            print("Image '%s': %s in source, %s in target" % (name, len(image_ids), len(target_ids)))
+        image_map.update(zip(image_ids, target_ids))
+    return image_map
+
+
+def map_plate_images(conn, conn2, plate_id, plate_id2):
+    """
+    Map the IDs of Images in a source Plate to Images in a target Plate,
+    by Well row, column and field.
+    """
+    def by_field(c, p_id):
+        plate = c.getObject('Plate', p_id)
+        if plate is None:
+            raise ValueError('Plate %s not found' % p_id)
+        images = {}
+        for well in plate.listChildren():
+            for index, well_sample in enumerate(well.listChildren()):
+                images[(well.row, well.column, index)] = well_sample.getImage().id
+        return images
+
+    targets = by_field(conn2, plate_id2)
+    image_map = OrderedDict()
+    for key, image_id in sorted(by_field(conn, plate_id).items()):
+        if key not in targets:
+            print("Row %s, Column %s, Field %s: not in target" % key)
+            continue
+        image_map[image_id] = targets[key]
+    return image_map
+
+
+def map_images(conn, conn2, obj_type, obj_id, obj_id2):
+    """
+    {source Image ID: target Image ID} for the Images of the source and
+    target objects, of type 'Image', 'Dataset' or 'Plate'.
+    """
+    if obj_type == 'Dataset':
+        return map_dataset_images(conn, conn2, obj_id, obj_id2)
+    if obj_type == 'Plate':
+        return map_plate_images(conn, conn2, obj_id, obj_id2)
+    return OrderedDict([(obj_id, obj_id2)])
+
+
+def read_rois(conn, image_map, page_size, out_queue, stopped):
+    """
+    Put (target image ID, list of ROIs) for each page of ROIs on the source
+    Images onto out_queue, then None. Exceptions are put onto the queue.
+    """
+    try:
+        roi_service = conn.getRoiService()
+        for image_id, image_id2 in image_map.items():
+            opts = RoiOptions()
+            opts.limit = rint(page_size)
+            offset = 0
+            while not stopped.is_set():
+                opts.offset = rint(offset)
+                result = roi_service.findByImage(image_id, opts, conn.SERVICE_OPTS)
+                if len(result.rois) == 0:
+                    break
+                print("Image %s offset %s found ROIs: %s" % (image_id, offset, len(result.rois)))
+                if not put(out_queue, (image_id2, result.rois), stopped):
+                    return
+                offset += page_size
+        put(out_queue, None, stopped)
+    except Exception as ex:
+        put(out_queue, ex, stopped)
+
+
+def transform_rois(transform, in_queue, out_queue, stopped):
+    """
+    Put the new ROIs from transform(rois, image_id) for each page on in_queue
+    onto out_queue. None and exceptions are passed on.
+    """
+    while True:
+        item = get(in_queue, stopped)
+        if item is None or isinstance(item, Exception):
+            put(out_queue, item, stopped)
+            return
+        try:
+            image_id, rois = item
+            new_rois = transform(rois, image_id)
+        except Exception as ex:
+            put(out_queue, ex, stopped)
+            return
+        if not put(out_queue, new_rois, stopped):
+            return
+
+
+def write_rois(writer, in_queue, result):
+    """Add the pages of new ROIs on in_queue to the RoiWriter."""
+    try:
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            for roi in item:
+                writer.add(roi)
+        result['ids'] = writer.close()
+    except Exception as ex:
+        result['error'] = ex
+
+
+def replicate_rois(conn, conn2, image_map, transform=clone_rois, page_size=PAGE_SIZE,
+                   batch_size=DEFAULT_BATCH_SIZE, queue_size=QUEUE_SIZE):
+    """
+    Copy the ROIs of the Images in image_map {source ID: target ID} from
+    conn to conn2, and return the IDs of the new ROIs.
+
+    transform(rois, image_id) returns the unsaved ROIs to create on the
+    target Image image_id, by default clone_rois().
+    """
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+    result = {}
+    # saves on the write thread, so it doesn't need a background thread
+    writer = RoiWriter(conn2, batch_size=batch_size, background=False)
+    threads = [
+        threading.Thread(target=read_rois, args=(conn, image_map, page_size, read_queue, stopped),
+                         daemon=True),
+        threading.Thread(target=transform_rois, args=(transform, read_queue, write_queue, stopped),
+                         daemon=True),
+        threading.Thread(target=write_rois, args=(writer, write_queue, result), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    threads[-1].join()
+    # if writing failed, the other stages stop at their next put() or get()
+    stopped.set()
+    if 'error' in result:
+        raise result['error']
+    for thread in threads:
+        thread.join()
+    return result['ids']
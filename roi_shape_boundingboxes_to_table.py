@@ -23,18 +23,25 @@
 This script exports Shape bounding boxes to a CSV file and OMERO.table.
 
 It is designed to handle large numbers of shapes by exporting a batch of
-1000 shapes at a time. The script will write the data to a CSV file as it
+1000 ROIs at a time. The script will write the data to a CSV file as it
 goes to avoid losing data if the script crashes.
-To continue after a crash, update the `offset` variable in the script and
-run again.
+After each batch is written, a checkpoint manifest next to the CSV
+(Batch_ROI_Export.csv.checkpoint.json) records the image ID, the offsets
+completed and the number of rows written.
+To continue after a crash, simply run the script again with the same Image ID.
+It will resume from the last completed batch, discarding any partly written
+rows so that nothing is duplicated.
 
-If the script completes successfully, it will write the data to an OMERO.table
-and link the table to the Image.
+When all the ROIs are exported, the CSV is read back in chunks to create an
+OMERO.table and link the table to the Image.
+Delete the CSV and the checkpoint file to start a new export.
 
 Otherwise, you can use omero2pandas to upload the CSV and create an OMERO.table.
 """
 
 import argparse
+import csv
+import json
 import sys
 import os
 from omero.gateway import BlitzGateway, FileAnnotationWrapper
@@ -42,15 +49,18 @@ import omero
 from omero.cli import cli_login
 from omero.rtypes import rlong, rint, rstring, robject, unwrap
 from omero.model import RectangleI, EllipseI, LineI, PolygonI, PolylineI, \
-    MaskI, LabelI, PointI, \
-    OriginalFileI, FileAnnotationI
-from omero.grid import ImageColumn, LongColumn, StringColumn, DoubleColumn
+    MaskI, LabelI, PointI
 from math import sqrt, pi
 import re
 
+from table_writer import TableWriter, OmeroTableBackend, rows_to_arrays, \
+    save_file_annotation
+
 DEFAULT_FILE_NAME = "Batch_ROI_Export.csv"
 INSIGHT_POINT_LIST_RE = re.compile(r'points\[([^\]]+)\]')
 DEFAULT_COLUMN_SIZE = 64
+PAGE_SIZE = 1000
+TABLE_CHUNK_SIZE = 10000
 
 
 def log(data):
@@ -58,18 +68,75 @@ def log(data):
     print(data)
 
 
-def get_export_data(conn, image):
-    """Get pixel data for shapes on image and returns list of dicts."""
+def checkpoint_path(file_name):
+    """The checkpoint manifest is saved next to the CSV file."""
+    return file_name + ".checkpoint.json"
+
+
+def save_checkpoint(checkpoint):
+    """Write the checkpoint to a temp file then rename it into place."""
+    path = checkpoint_path(checkpoint["file_name"])
+    with open(path + ".tmp", 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(file_name, image_id, limit=PAGE_SIZE):
+    """
+    Load the checkpoint for the CSV file or start a new one.
+
+    Any rows written to the CSV after the last completed page are removed.
+    """
+    path = checkpoint_path(file_name)
+    if not os.path.exists(path):
+        if os.path.exists(file_name):
+            raise Exception("%s exists but has no checkpoint %s. Please move "
+                            "it to start a new export." % (file_name, path))
+        checkpoint = {
+            "image_id": image_id,
+            "file_name": file_name,
+            "limit": limit,
+            "pages": [],
+            "csv_size": 0,
+            "complete": False,
+        }
+        # save before writing any rows, so a crash in the first page resumes
+        save_checkpoint(checkpoint)
+        return checkpoint
+
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint["image_id"] != image_id:
+        raise Exception("%s is exporting Image %s. Delete it and %s to "
+                        "export Image %s" % (path, checkpoint["image_id"],
+                                             file_name, image_id))
+    rows = sum(page["rows"] for page in checkpoint["pages"])
+    log("Resuming Image %s: %s pages, %s rows already exported" % (
+        image_id, len(checkpoint["pages"]), rows))
+    # drop any rows from a page that didn't complete
+    if os.path.exists(file_name):
+        with open(file_name, 'r+') as csv_file:
+            csv_file.truncate(checkpoint["csv_size"])
+    return checkpoint
+
+
+def get_export_data(conn, image, checkpoint):
+    """
+    Get data for shapes on image and write them to the CSV in batches.
+
+    Starts after the last page in the checkpoint, which is updated after
+    each page is written. Returns the total number of rows in the CSV.
+    """
     log("Image ID %s..." % image.id)
 
     roi_service = conn.getRoiService()
 
-    load_more = True
-    # offset = 0
-    offset = 129000
-    limit = 1000
-
-    export_data = []
+    limit = checkpoint["limit"]
+    pages = checkpoint["pages"]
+    offset = pages[-1]["offset"] + limit if pages else 0
+    load_more = not checkpoint["complete"]
 
     while load_more:
         roi_options = omero.api.RoiOptions()
@@ -82,8 +149,6 @@ def get_export_data(conn, image):
 
         if len(result.rois) < limit:
             load_more = False
-        else:
-            offset += limit
 
         batch_data = []
 
@@ -107,12 +172,18 @@ def get_export_data(conn, image):
                 }
                 add_shape_coords(shape, row_data)
                 batch_data.append(row_data)
-    
+
         # write each batch to csv as we go... (avoid loss on crash)
-        write_csv(batch_data)
+        csv_size = write_csv(batch_data, checkpoint["file_name"])
 
-        export_data.extend(batch_data)
-    return export_data
+        # ...and only then record that the batch is complete
+        pages.append({"offset": offset, "rows": len(batch_data)})
+        checkpoint["csv_size"] = csv_size
+        checkpoint["complete"] = not load_more
+        save_checkpoint(checkpoint)
+        offset += limit
+
+    return sum(page["rows"] for page in pages)
 
 
 COLUMN_NAMES = ["image_id",
@@ -128,18 +199,19 @@ COLUMN_NAMES = ["image_id",
                 "Y2",
             ]
 
-COLUMN_TYPES = {"image_id": ImageColumn,
-                "roi_id": LongColumn,
-                "shape_id": LongColumn,
-                "type": StringColumn,
-                "z": LongColumn,
-                "t": LongColumn,
-                "X": LongColumn,
-                "Y": LongColumn,
-                "X1": LongColumn,
-                "Y1": LongColumn,
-                "X2": LongColumn,
-                "Y2": LongColumn}
+# column kinds for table_writer
+COLUMN_TYPES = {"image_id": "image",
+                "roi_id": "long",
+                "shape_id": "long",
+                "type": "string",
+                "z": "long",
+                "t": "long",
+                "X": "long",
+                "Y": "long",
+                "X1": "long",
+                "Y1": "long",
+                "X2": "long",
+                "Y2": "long"}
 
 
 def add_shape_coords(shape, row_data):
@@ -199,52 +271,44 @@ def add_shape_coords(shape, row_data):
         row_data['Y1'] = min_y
         row_data['Y2'] = max_y
 
-def create_column(name, data=[]):
-    col_type = COLUMN_TYPES[name]
-    if col_type is StringColumn:
-        return StringColumn(name, '', DEFAULT_COLUMN_SIZE, data)
-    else:
-        if col_type == LongColumn:
-            data = [int(d) for d in data]
-        return col_type(name, '', data)
-
-
-def write_table(conn, export_data):
-    """Write the list of data to an OMERO.table, return a file annotation."""
+def read_csv_chunks(file_name, chunk_size=TABLE_CHUNK_SIZE):
+    """Read the CSV back, yielding lists of up to chunk_size row dicts."""
+    with open(file_name, newline='') as csv_file:
+        chunk = []
+        for row in csv.DictReader(csv_file):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def write_table(conn, chunks):
+    """Write each chunk of data to an OMERO.table, return a file annotation."""
     table_name = DEFAULT_FILE_NAME
     if table_name.endswith('.csv'):
         table_name = table_name.replace('.csv', '')
-    columns = [create_column(name, []) for name in COLUMN_NAMES]
-    resources = conn.c.sf.sharedResources()
-    repository_id = resources.repositories().descriptions[0].getId().getValue()
-    table = resources.newTable(repository_id, table_name)
-    table.initialize(columns)
-
-    data = []
-    for name in COLUMN_NAMES:
-        col_data = [row.get(name) for row in export_data]
-        data.append(create_column(name, col_data))
-    table.addData(data)
-    orig_file = table.getOriginalFile()
-    table.close()
-    orig_file_id = orig_file.id.val
-    file_ann = FileAnnotationI()
-    file_ann.setNs(rstring("omero.shape.boundingbox.coords"))
-    file_ann.setFile(OriginalFileI(orig_file_id, False))
-    file_ann = conn.getUpdateService().saveAndReturnObject(file_ann)
+    # we only see the first chunk before creating the table
+    with TableWriter(OmeroTableBackend(conn, table_name),
+                     batch_size=TABLE_CHUNK_SIZE,
+                     column_types=COLUMN_TYPES,
+                     string_widths={"type": DEFAULT_COLUMN_SIZE}) as writer:
+        for export_data in chunks:
+            # values read from the CSV are strings, e.g. "12.5" for a Long
+            writer.write(rows_to_arrays(export_data, COLUMN_NAMES, COLUMN_TYPES))
+    orig_file = writer.result
+    file_ann = save_file_annotation(conn, orig_file,
+                                    ns="omero.shape.boundingbox.coords")
     return FileAnnotationWrapper(conn, file_ann)
 
 
-def write_csv(export_data):
-    """Write the list of data to a CSV file and create a file annotation."""
-    file_name = DEFAULT_FILE_NAME
-    if not file_name.endswith(".csv"):
-        file_name += ".csv"
-
+def write_csv(export_data, file_name=DEFAULT_FILE_NAME):
+    """Append the list of data to a CSV file, return the new file size."""
     csv_header = ",".join(COLUMN_NAMES)
 
     # If we're starting a new file, write the header
-    if not os.path.exists(file_name):
+    if not os.path.exists(file_name) or os.path.getsize(file_name) == 0:
         csv_rows = [csv_header]
     else:
         csv_rows = []
@@ -254,8 +318,11 @@ def write_csv(export_data):
         csv_rows.append(",".join(cells))
 
     with open(file_name, 'a') as csv_file:
-        csv_file.write("\n")
-        csv_file.write("\n".join(csv_rows))
+        for csv_row in csv_rows:
+            csv_file.write(csv_row + "\n")
+        csv_file.flush()
+        os.fsync(csv_file.fileno())
+        return csv_file.tell()
 
     # return conn.createFileAnnfromLocalFile(file_name, mimetype="text/csv")
 
@@ -279,14 +346,22 @@ def batch_roi_export(conn, image_id):
     """Main entry point. Get images, process them and return result."""
 
     image = conn.getObject("Image", image_id)
-
-    # build a list of dicts.
-    export_data = get_export_data(conn, image)
-
-    # write the data to a table and link to the objects
-    # TODO: we could use the CSV file to create the table here with omero2pandas
-    file_ann = write_table(conn, export_data)
+    file_name = DEFAULT_FILE_NAME
+    checkpoint = load_checkpoint(file_name, image.id)
+    if checkpoint.get("file_ann_id") is not None:
+        log("Table already created: FileAnnotation %s" %
+            checkpoint["file_ann_id"])
+        return
+
+    # write the data to the CSV, one page at a time
+    row_count = get_export_data(conn, image, checkpoint)
+    log("Exported %s rows to %s" % (row_count, file_name))
+
+    # stream the CSV back into a table and link to the objects
+    file_ann = write_table(conn, read_csv_chunks(file_name))
     link_annotation([image], file_ann)
+    checkpoint["file_ann_id"] = file_ann.id
+    save_checkpoint(checkpoint)
 
 
 if __name__ == "__main__":
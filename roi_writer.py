@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+Buffered, batched saving of ROIs.
+
+Saving one RoiI per saveObject() call costs a server round trip for every
+ROI. RoiWriter collects the ROIs and saves them with saveAndReturnIds() in
+batches of `batch_size`, on a background thread so that the caller can
+keep creating ROIs while a batch is saved:
+
+    with RoiWriter(conn) as writer:
+        for contour in contours:
+            writer.add(create_roi(contour))
+    roi_ids = writer.ids
+
+A batch that fails is retried (each save is a single transaction, so a
+failed batch saved nothing). The IDs are in the order the ROIs were added.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+DEFAULT_BATCH_SIZE = 500
+# Batches that may wait to be saved, before add() blocks
+MAX_PENDING = 4
+RETRIES = 3
+
+
+class RoiWriter(object):
+    """Saves RoiI objects in batches, in the background."""
+
+    def __init__(self, conn, batch_size=DEFAULT_BATCH_SIZE, retries=RETRIES,
+                 max_pending=MAX_PENDING, background=True):
+        self.conn = conn
+        self.update_service = conn.getUpdateService()
+        self.batch_size = batch_size
+        self.retries = retries
+        self.max_pending = max_pending
+        self.buffer = []
+        self.pending = []
+        self.batch_ids = []
+        self.count = 0
+        # a single thread, so batches are saved in order
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def add(self, roi):
+        """Add an unsaved RoiI. Returns its index in ids."""
+        self.buffer.append(roi)
+        self.count += 1
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        return self.count - 1
+
+    def flush(self):
+        """Start saving the ROIs that have been added."""
+        if not self.buffer:
+            return
+        batch = self.buffer
+        self.buffer = []
+        if self.executor is None:
+            self.batch_ids.append(self._save(batch))
+            return
+        self.pending.append(self.executor.submit(self._save, batch))
+        # wait for the oldest batches, to limit the ROIs held in memory
+        while len(self.pending) > self.max_pending:
+            self.batch_ids.append(self.pending.pop(0).result())
+
+    def _save(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.update_service.saveAndReturnIds(batch, self.conn.SERVICE_OPTS)
+            except Exception as ex:
+                if attempt == self.retries:
+                    raise
+                print("Saving %s ROIs failed (%s), retrying..." % (len(batch), ex))
+                time.sleep(2 ** attempt)
+
+    def close(self):
+        """Save the remaining ROIs, wait for all batches and return the IDs."""
+        self.flush()
+        for future in self.pending:
+            self.batch_ids.append(future.result())
+        self.pending = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        return self.ids
+
+    @property
+    def ids(self):
+        """IDs of the saved ROIs, in the order they were added."""
+        return [roi_id for batch in self.batch_ids for roi_id in batch]
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+Batched geometry for Polygon and Polyline point strings.
+
+Instead of parsing and measuring one shape at a time, a whole page of
+point strings is parsed into a single flat array of coordinates, with
+`offsets` marking where each shape starts and ends:
+
+    coords[offsets[i]:offsets[i + 1]]  # the (x, y) points of shape i
+
+Area, length, bounding box and centroid are then computed for all shapes
+at once with NumPy.
+
+Run this file directly to compare with the per-shape Python path:
+
+$ python shape_geometry.py 100000
+"""
+
+import re
+import sys
+import warnings
+from math import sqrt
+from timeit import default_timer
+
+import numpy as np
+
+INSIGHT_POINT_LIST_RE = re.compile(r'points\[([^\]]+)\]')
+
+
+def strip_insight_points(point_list):
+    """Return the 'x,y x,y' part of an old OMERO.insight point string."""
+    match = INSIGHT_POINT_LIST_RE.search(point_list)
+    if match is not None:
+        return match.group(1)
+    return point_list
+
+
+def parse_points(point_lists):
+    """
+    Parse a list of point strings into one coordinate buffer.
+
+    Accepts points separated by spaces "x,y x,y" or by ", ".
+    Returns (coords, offsets) where coords is an (N, 2) float64 array
+    and offsets has one more entry than point_lists.
+    """
+    # Normalise to "x,y x,y" so that each point has exactly one comma
+    point_lists = [strip_insight_points(p).replace(", ", " ").strip(" ,")
+                   for p in point_lists]
+    counts = [p.count(",") for p in point_lists]
+    # Parse all the numbers in one NumPy call, not float() per number
+    text = " ".join(point_lists).replace(",", " ")
+    with warnings.catch_warnings():
+        # fromstring() warns and stops at text it can't parse
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            coords = np.fromstring(text, dtype=np.float64, sep=" ")
+        except DeprecationWarning:
+            coords = None
+    if coords is None or coords.size != 2 * sum(counts):
+        raise ValueError("Could not parse points")
+    coords = coords.reshape(-1, 2)
+    offsets = np.zeros(len(point_lists) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return coords, offsets
+
+
+def _starts_and_ends(offsets):
+    starts = offsets[:-1]
+    ends = offsets[1:]
+    # reduceat() can't handle empty shapes so we only reduce the others
+    non_empty = ends > starts
+    return starts, ends, non_empty
+
+
+def _reduce(ufunc, values, offsets, empty_value=np.nan):
+    """Apply ufunc.reduceat() per shape, using empty_value for no points."""
+    starts, ends, non_empty = _starts_and_ends(offsets)
+    result = np.full(len(starts), empty_value, dtype=np.float64)
+    if non_empty.any():
+        result[non_empty] = ufunc.reduceat(values, starts[non_empty])
+    return result
+
+
+def bounding_boxes(coords, offsets):
+    """Return min_x, min_y, max_x, max_y arrays, one value per shape."""
+    min_x = _reduce(np.minimum, coords[:, 0], offsets)
+    min_y = _reduce(np.minimum, coords[:, 1], offsets)
+    max_x = _reduce(np.maximum, coords[:, 0], offsets)
+    max_y = _reduce(np.maximum, coords[:, 1], offsets)
+    return min_x, min_y, max_x, max_y
+
+
+def polyline_lengths(coords, offsets, pixel_size_x=None, pixel_size_y=None):
+    """Return the summed segment length of each shape."""
+    dx = np.zeros(len(coords))
+    dy = np.zeros(len(coords))
+    # segment i joins point i to i + 1...
+    dx[:-1] = coords[:-1, 0] - coords[1:, 0]
+    dy[:-1] = coords[:-1, 1] - coords[1:, 1]
+    if pixel_size_x is not None:
+        dx *= pixel_size_x
+    if pixel_size_y is not None:
+        dy *= pixel_size_y
+    segments = np.sqrt((dx * dx) + (dy * dy))
+    # ...except from the last point of a shape to the next shape
+    starts, ends, non_empty = _starts_and_ends(offsets)
+    segments[ends[non_empty] - 1] = 0
+    return _reduce(np.add, segments, offsets, empty_value=0)
+
+
+def _next_indices(coords, offsets):
+    """Index of the next point in the same shape, wrapping to the start."""
+    next_index = np.arange(1, len(coords) + 1)
+    starts, ends, non_empty = _starts_and_ends(offsets)
+    next_index[ends[non_empty] - 1] = starts[non_empty]
+    return next_index
+
+
+def polygon_areas(coords, offsets):
+    """Return the area of each closed polygon (shoelace formula)."""
+    # https://www.mathopenref.com/coordpolygonarea.html
+    x = coords[:, 0]
+    y = coords[:, 1]
+    next_index = _next_indices(coords, offsets)
+    cross = (x * y[next_index]) - (x[next_index] * y)
+    return np.abs(0.5 * _reduce(np.add, cross, offsets, empty_value=0))
+
+
+def polygon_centroids(coords, offsets):
+    """
+    Return centroid x and y arrays for each closed polygon.
+
+    Polygons with zero area use the mean of their points.
+    """
+    x = coords[:, 0]
+    y = coords[:, 1]
+    next_index = _next_indices(coords, offsets)
+    cross = (x * y[next_index]) - (x[next_index] * y)
+    signed_area = 0.5 * _reduce(np.add, cross, offsets, empty_value=0)
+    cx = _reduce(np.add, (x + x[next_index]) * cross, offsets)
+    cy = _reduce(np.add, (y + y[next_index]) * cross, offsets)
+    counts = np.diff(offsets)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cx = cx / (6 * signed_area)
+        cy = cy / (6 * signed_area)
+        mean_x = _reduce(np.add, x, offsets) / counts
+        mean_y = _reduce(np.add, y, offsets) / counts
+    flat = signed_area == 0
+    cx[flat] = mean_x[flat]
+    cy[flat] = mean_y[flat]
+    return cx, cy
+
+
+def shape_geometry(point_lists, closed, pixel_size_x=None,
+                   pixel_size_y=None):
+    """
+    Measure a page of Polygon / Polyline point strings in one go.
+
+    closed is a bool (or list of bools, one per shape): True for Polygons,
+    False for Polylines.
+    Returns a dict of arrays with the same keys that add_shape_coords()
+    in Batch_ROI_to_Table.py sets: X, Y (centre of the bounding box),
+    Width, Height, 'area' for closed shapes and 'length' for open shapes.
+    Also includes 'centroid_x' and 'centroid_y' of polygons.
+    """
+    coords, offsets = parse_points(point_lists)
+    closed = np.broadcast_to(np.asarray(closed, dtype=bool),
+                             (len(point_lists),))
+    min_x, min_y, max_x, max_y = bounding_boxes(coords, offsets)
+    width = max_x - min_x
+    height = max_y - min_y
+    area = polygon_areas(coords, offsets)
+    if pixel_size_x and pixel_size_y:
+        area = area * pixel_size_x * pixel_size_y
+    length = polyline_lengths(coords, offsets, pixel_size_x, pixel_size_y)
+    centroid_x, centroid_y = polygon_centroids(coords, offsets)
+    return {
+        "X": min_x + (width / 2),
+        "Y": min_y + (height / 2),
+        "Width": width,
+        "Height": height,
+        "area": np.where(closed, area, np.nan),
+        "length": np.where(closed, np.nan, length),
+        "centroid_x": np.where(closed, centroid_x, np.nan),
+        "centroid_y": np.where(closed, centroid_y, np.nan),
+    }
+
+
+def _per_shape_geometry(point_list, closed):
+    """Measure a single shape with Python loops, as add_shape_coords() did."""
+    point_list = strip_insight_points(point_list)
+    coords = [[float(x.strip(", ")) for x in coord.split(",", 1)]
+              for coord in point_list.split(" ")]
+    x_coords = [c[0] for c in coords]
+    y_coords = [c[1] for c in coords]
+    width = max(x_coords) - min(x_coords)
+    height = max(y_coords) - min(y_coords)
+    row_data = {
+        "X": min(x_coords) + (width / 2),
+        "Y": min(y_coords) + (height / 2),
+        "Width": width,
+        "Height": height,
+    }
+    if closed:
+        total = 0
+        for c in range(len(coords)):
+            coord = coords[c]
+            next_coord = coords[(c + 1) % len(coords)]
+            total += (coord[0] * next_coord[1]) - (next_coord[0] * coord[1])
+        row_data['area'] = abs(0.5 * total)
+    else:
+        lengths = []
+        for i in range(len(coords) - 1):
+            dx = (coords[i][0] - coords[i + 1][0])
+            dy = (coords[i][1] - coords[i + 1][1])
+            lengths.append(sqrt((dx * dx) + (dy * dy)))
+        row_data['length'] = sum(lengths)
+    return row_data
+
+
+def random_point_lists(shape_count, points_per_shape=50, seed=0, precision=None):
+    """
+    Create point strings for random star-shaped polygons, with `precision`
+    decimal places, or full precision if None.
+    """
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, points_per_shape, endpoint=False)
+    point_lists = []
+    for i in range(shape_count):
+        centre = rng.uniform(0, 10000, 2)
+        radii = rng.uniform(5, 20, points_per_shape)
+        xs = centre[0] + radii * np.cos(angles)
+        ys = centre[1] + radii * np.sin(angles)
+        point_format = "%s,%s" if precision is None else "%.{0}f,%.{0}f".format(precision)
+        point_lists.append(" ".join(
+            point_format % (x, y) for x, y in zip(xs.tolist(), ys.tolist())))
+    return point_lists
+
+
+def benchmark(shape_count=10000, points_per_shape=50, precision=None):
+    """Time the batched and per-shape paths and check they agree."""
+    point_lists = random_point_lists(shape_count, points_per_shape, precision=precision)
+    closed = [i % 2 == 0 for i in range(shape_count)]
+
+    start = default_timer()
+    expected = [_per_shape_geometry(p, c) for p, c in zip(point_lists, closed)]
+    per_shape_time = default_timer() - start
+
+    start = default_timer()
+    result = shape_geometry(point_lists, closed)
+    batch_time = default_timer() - start
+
+    for key in ("X", "Y", "Width", "Height", "area", "length"):
+        values = [row.get(key, np.nan) for row in expected]
+        np.testing.assert_allclose(result[key], values, rtol=1e-9)
+
+    print("%s shapes, %s points each, precision %s" % (shape_count, points_per_shape, precision))
+    print("per-shape: %.3f s" % per_shape_time)
+    speedup = per_shape_time / batch_time
+    print("batched:   %.3f s (%.1fx)" % (batch_time, speedup))
+
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
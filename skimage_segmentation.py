@@ -1,8 +1,15 @@
+import argparse
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
+import numpy as np
 import omero
 from omero.gateway import BlitzGateway
 from omero.rtypes import rint, rstring
 
+from scipy import ndimage
 from skimage import morphology
 from skimage import measure
 from skimage.filters import threshold_otsu
@@ -15,9 +22,31 @@ import matplotlib.pyplot as plt
 # Using threshold = 200 and start_x = 5000, start_y = 5000, cols = 40, rows = 40
 # this will produce about 250,000 shapes.
 
+# Segments the whole image, in tiles of TILE_SIZE. Each tile is read with a
+# MARGIN of overlap on each side. Tiles are read (up to PREFETCH ahead) on a
+# pool of threads and segmented on a pool of processes.
+#
+# The margin means that the segmentation near the edge of each tile is the
+# same as in the neighbouring tile. Objects inside a tile (without margin)
+# are saved as they are. Objects that cross the edges of tiles are cropped
+# to each tile, and the pieces that touch are merged into one object.
+#
+# Usage:
+# $ python skimage_segmentation.py 3165 --channel 2 --threshold 200
+
 from omero.cli import cli_login
 
+from contour_encoder import EncodingStats, encode_contour
+from roi_writer import RoiWriter
+from tile_reader import PixelsStorePool
+
 TILE_SIZE = 1000
+MARGIN = 50
+PREFETCH = 8
+# ROIs are saved in batches of BATCH_SIZE
+BATCH_SIZE = 500
+# merge_pieces() only compares pieces within cells of this size
+MERGE_CELL_SIZE = 64
 
 
 def rgba_to_int(red, green, blue, alpha=255):
@@ -31,11 +60,11 @@ def rgba_to_int(red, green, blue, alpha=255):
         rgba_int = rgba_int - 2**32
     return rgba_int
 
-def add_polygon(contour, x_offset, y_offset):
-    """ points is 2D list of [[x, y], [x, y]...]"""
+def create_polygon(image, contour, x_offset, y_offset, stats=None):
+    """ contour is 2D list of [[y, x], [y, x]...]. Returns an unsaved RoiI"""
 
-    points = ["%s,%s" % (xy[1] + x_offset, xy[0] + y_offset) for xy in contour]
-    points = ", ".join(points)
+    # simplified, with 1 decimal place e.g. "10.5,20.0 50.0,150.5"
+    points = encode_contour(contour, x_offset, y_offset, stats=stats)
 
     polygon = omero.model.PolygonI()
     polygon.theZ = rint(0)
@@ -47,68 +76,252 @@ def add_polygon(contour, x_offset, y_offset):
     # use the omero.model.ImageI that underlies the 'image' wrapper
     roi.setImage(image._obj)
     roi.addShape(polygon)
-    # Save the ROI (saves any linked shapes too)
-    updateService.saveObject(roi)
+    return roi
+
+
+def get_tiles(size_x, size_y, tile_size=TILE_SIZE, margin=MARGIN):
+    """
+    List the tiles that cover the image.
+
+    Each tile is (core, padded), both (x, y, w, h): the padded tile is the
+    core plus the margin on each side, within the image.
+    """
+    tiles = []
+    for y in range(0, size_y, tile_size):
+        for x in range(0, size_x, tile_size):
+            core = (x, y, min(tile_size, size_x - x), min(tile_size, size_y - y))
+            tiles.append((core, get_padded(x, y, size_x, size_y, tile_size, margin)))
+    return tiles
+
+
+def get_padded(x, y, size_x, size_y, tile_size=TILE_SIZE, margin=MARGIN):
+    """The (x, y, w, h) of the tile at x, y plus the margin, within the image."""
+    px = max(0, x - margin)
+    py = max(0, y - margin)
+    pw = min(size_x, x + tile_size + margin) - px
+    ph = min(size_y, y + tile_size + margin) - py
+    return (px, py, pw, ph)
+
+
+def get_mask(tile, threshold):
+    # nuclei are black...
+    tile = invert(tile)
+
+    # threshold = threshold_otsu(tile)
+    # print('Threshold', threshold)
+    mask = tile < threshold
+    mask = morphology.remove_small_objects(mask, min_size=10)
+    mask = morphology.binary_dilation(mask)
+    mask = morphology.binary_dilation(mask)
+    mask = morphology.remove_small_holes(mask)
+
+    # Used this and threshold_otsu above to find a good threshold value
+    # that gives a resonable number of polygons per tile. Then hard-coded it
+    # to be the same for the whole image.
+
+    # while len(contours) > 200:
+    #     threshold += 5
+    #     print('Threshold', threshold)
+    #     mask = tile < threshold
+    #     mask = morphology.remove_small_objects(mask, min_size=10)
+    #     mask = morphology.binary_dilation(mask)
+    #     mask = morphology.binary_dilation(mask)
+    #     mask = morphology.remove_small_holes(mask)
+    #     contours = measure.find_contours(mask, 0)
+    #     print('Found %s contours', len(contours))
+    return mask
+
+
+def get_contours(mask, x, y):
+    """Contours [[y, x], ...] of a mask whose top-left is at x, y."""
+    # pad so that objects at the edge of the mask have closed contours
+    padded = np.pad(mask, 1)
+    return [contour + (y - 1, x - 1) for contour in measure.find_contours(padded, 0.5)]
+
+
+def segment_tile(tile, core, padded, threshold):
+    """
+    Segment a padded tile. Runs in a worker process.
+
+    Returns (contours, pieces): the contours of the objects inside the core
+    of the tile, and (x, y, mask) pieces of the objects that cross the edge
+    of the core, cropped to the core, to be merged with the other tiles.
+    """
+    cx, cy, cw, ch = core
+    px, py = padded[:2]
+    labels = measure.label(get_mask(tile, threshold))
+    contours = []
+    pieces = []
+    for region in measure.regionprops(labels):
+        min_row, min_col, max_row, max_col = region.bbox
+        x1, y1, x2, y2 = px + min_col, py + min_row, px + max_col, py + max_row
+        if x1 >= cx and y1 >= cy and x2 <= cx + cw and y2 <= cy + ch:
+            contours.extend(get_contours(region.image, x1, y1))
+            continue
+        # crop to the core: the margin is for other tiles to segment
+        left, top = max(x1, cx), max(y1, cy)
+        right, bottom = min(x2, cx + cw), min(y2, cy + ch)
+        if left >= right or top >= bottom:
+            continue
+        piece = region.image[top - y1:bottom - y1, left - x1:right - x1]
+        if piece.any():
+            pieces.append((left, top, piece))
+    return contours, pieces
+
 
+def merge_pieces(pieces, cell_size=MERGE_CELL_SIZE):
+    """
+    Merge the (x, y, mask) pieces of objects that touch across the edges of
+    tiles. Returns a list of (x, y, mask) of the whole objects.
+    """
+    # union-find of pieces that touch (8-connected, like measure.label)
+    parents = list(range(len(pieces)))
 
-with cli_login() as cli:
-    conn = BlitzGateway(client_obj=cli._client)
-    updateService = conn.getUpdateService()
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
 
-    image_id = 3165
-    image = conn.getObject("Image", image_id)
-    pixels = image.getPrimaryPixels()
+    # only compare pieces that are in the same cells of a grid
+    cells = {}
+    for i, (x, y, mask) in enumerate(pieces):
+        h, w = mask.shape
+        for row in range((y - 1) // cell_size, (y + h) // cell_size + 1):
+            for col in range((x - 1) // cell_size, (x + w) // cell_size + 1):
+                cells.setdefault((row, col), []).append(i)
 
+    checked = set()
+    grown = {}
+    for indices in cells.values():
+        for a, i in enumerate(indices):
+            x1, y1, mask1 = pieces[i]
+            for j in indices[a + 1:]:
+                if (i, j) in checked or find(i) == find(j):
+                    continue
+                checked.add((i, j))
+                x2, y2, mask2 = pieces[j]
+                # the overlap of piece 2 with piece 1 grown by one pixel
+                left = max(x1 - 1, x2)
+                top = max(y1 - 1, y2)
+                right = min(x1 + mask1.shape[1] + 1, x2 + mask2.shape[1])
+                bottom = min(y1 + mask1.shape[0] + 1, y2 + mask2.shape[0])
+                if left >= right or top >= bottom:
+                    continue
+                if i not in grown:
+                    grown[i] = ndimage.binary_dilation(np.pad(mask1, 1), structure=np.ones((3, 3), dtype=bool))
+                overlap = (grown[i][top - y1 + 1:bottom - y1 + 1, left - x1 + 1:right - x1 + 1] &
+                           mask2[top - y2:bottom - y2, left - x2:right - x2])
+                if overlap.any():
+                    parents[find(i)] = find(j)
+
+    groups = {}
+    for i in range(len(pieces)):
+        groups.setdefault(find(i), []).append(pieces[i])
+    objects = []
+    for group in groups.values():
+        x = min(p[0] for p in group)
+        y = min(p[1] for p in group)
+        w = max(p[0] + p[2].shape[1] for p in group) - x
+        h = max(p[1] + p[2].shape[0] for p in group) - y
+        mask = np.zeros((h, w), dtype=bool)
+        for px, py, piece in group:
+            mask[py - y:py - y + piece.shape[0], px - x:px - x + piece.shape[1]] |= piece
+        objects.append((x, y, mask))
+    return objects
+
+
+class Progress():
+
+    def __init__(self, total_tiles):
+        self.total_tiles = total_tiles
+        self.tiles = 0
+        self.shapes = 0
+        self.start = time.time()
+
+    def report(self):
+        duration = max(time.time() - self.start, 1e-6)
+        print("%s/%s tiles, %s shapes, %.2f tiles/s, %.1f shapes/s" % (
+            self.tiles, self.total_tiles, self.shapes,
+            self.tiles / duration, self.shapes / duration))
+
+
+def segment_image(conn, image, channel, threshold, tile_size=TILE_SIZE, margin=MARGIN,
+                  workers=None, readers=4, prefetch=PREFETCH):
     size_x = image.getSizeX()
     size_y = image.getSizeY()
+    tiles = get_tiles(size_x, size_y, tile_size, margin)
+    print("Segmenting %s x %s in %s tiles" % (size_x, size_y, len(tiles)))
+    progress = Progress(len(tiles))
+    pieces = []
+    writer = RoiWriter(conn, BATCH_SIZE)
+    stats = EncodingStats()
+
+    def read_tile(tile):
+        x, y, w, h = tile[1]
+        with pool.reader(image) as reader:
+            return reader.get_tile(0, channel, 0, x, y, w, h)
+
+    def add_contours(contours):
+        for contour in contours:
+            writer.add(create_polygon(image, contour, 0, 0, stats))
+        progress.shapes += len(contours)
+
+    with PixelsStorePool(conn) as pool, \
+            ThreadPoolExecutor(max_workers=readers) as fetchers, \
+            ProcessPoolExecutor(max_workers=workers) as segmenters:
+        fetching = deque()
+        segmenting = set()
+
+        def collect(futures):
+            for future in futures:
+                contours, tile_pieces = future.result()
+                pieces.extend(tile_pieces)
+                add_contours(contours)
+                progress.tiles += 1
+                if progress.tiles % 20 == 0:
+                    progress.report()
+
+        for index, tile in enumerate(tiles):
+            fetching.append((tile, fetchers.submit(read_tile, tile)))
+            # read up to prefetch tiles ahead of the segmentation
+            while len(fetching) > prefetch or (index == len(tiles) - 1 and fetching):
+                next_tile, future = fetching.popleft()
+                segmenting.add(segmenters.submit(
+                    segment_tile, future.result(), next_tile[0], next_tile[1], threshold))
+            # don't hold more tiles in memory than the workers can use
+            if len(segmenting) > prefetch:
+                done, segmenting = wait(segmenting, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(segmenting)
+
+    objects = merge_pieces(pieces)
+    print("Merged %s pieces into %s objects" % (len(pieces), len(objects)))
+    for x, y, mask in objects:
+        add_contours(get_contours(mask, x, y))
+    writer.close()
+    progress.report()
+    print(stats.report())
+    return progress.shapes
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image_id', type=int, nargs='?', default=3165, help='Image ID')
+    parser.add_argument('--channel', type=int, default=2, help='channel index to segment')
+    parser.add_argument('--threshold', type=int, default=200)
+    parser.add_argument('--tile_size', type=int, default=TILE_SIZE)
+    parser.add_argument('--margin', type=int, default=MARGIN, help='Overlap of tiles on each side')
+    parser.add_argument('--workers', type=int, help='Number of segmentation processes')
+    parser.add_argument('--readers', type=int, default=4, help='Number of threads reading tiles')
+    args = parser.parse_args(argv)
+
+    with cli_login() as cli:
+        conn = BlitzGateway(client_obj=cli._client)
+        image = conn.getObject("Image", args.image_id)
+        segment_image(conn, image, args.channel, args.threshold, args.tile_size,
+                      args.margin, args.workers, args.readers)
+
 
-    # Hard-code some values...
-    # TODO: use size_x and size_y to interate over whole image
-    start_x = 5000
-    start_y = 5000
-    cols = 40
-    rows = 40
-
-    channel = 2
-    threshold = 200
-
-    total = 0
-    tiles = 0
-    for col in range(cols):
-        for row in range(rows):
-            tiles += 1
-            x = start_x + (col * TILE_SIZE)
-            y = start_y + (row * TILE_SIZE)
-            tile = pixels.getTile(theC=channel, tile=(x, y, TILE_SIZE, TILE_SIZE))
-            # nuclei are black...
-            tile = invert(tile)
-
-            # threshold = threshold_otsu(tile)
-            # print('Threshold', threshold)
-            mask = tile < threshold
-            mask = morphology.remove_small_objects(mask, min_size=10)
-            mask = morphology.binary_dilation(mask)
-            mask = morphology.binary_dilation(mask)
-            mask = morphology.remove_small_holes(mask)
-            contours = measure.find_contours(mask, 0)
-            print('Found %s contours', len(contours))
-            total += len(contours)
-
-            # Used this and threshold_otsu above to find a good threshold value
-            # that gives a resonable number of polygons per tile. Then hard-coded it
-            # to be the same for the whole image.
-
-            # while len(contours) > 200:
-            #     threshold += 5
-            #     print('Threshold', threshold)
-            #     mask = tile < threshold
-            #     mask = morphology.remove_small_objects(mask, min_size=10)
-            #     mask = morphology.binary_dilation(mask)
-            #     mask = morphology.binary_dilation(mask)
-            #     mask = morphology.remove_small_holes(mask)
-            #     contours = measure.find_contours(mask, 0)
-            #     print('Found %s contours', len(contours))
-
-            print('total ROIS:', total, 'tiles', tiles)
-            for c in contours:
-                add_polygon(c, x, y)
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -11,6 +11,9 @@ from skimage.filters import threshold_otsu
 from skimage import morphology
 from skimage import measure
 
+from contour_encoder import EncodingStats, encode_contour
+from roi_writer import RoiWriter
+
 # Adapted from https://gist.github.com/stefanv/7c296c26b0c3624746f4317bed6a3540
 
 def rgba_to_int(red, green, blue, alpha=255):
@@ -24,11 +27,10 @@ def rgba_to_int(red, green, blue, alpha=255):
         rgba_int = rgba_int - 2**32
     return rgba_int
 
-def add_polygon(image, updateService, contour, x_offset=0, y_offset=0):
+def add_polygon(image, writer, contour, x_offset=0, y_offset=0, stats=None):
     """ points is 2D list of [[x, y], [x, y]...]"""
 
-    points = ["%s,%s" % (xy[1] + x_offset, xy[0] + y_offset) for xy in contour]
-    points = ", ".join(points)
+    points = encode_contour(contour, x_offset, y_offset, stats=stats)
 
     polygon = omero.model.PolygonI()
     polygon.theZ = rint(0)
@@ -40,8 +42,8 @@ def add_polygon(image, updateService, contour, x_offset=0, y_offset=0):
     # use the omero.model.ImageI that underlies the 'image' wrapper
     roi.setImage(image._obj)
     roi.addShape(polygon)
-    # Save the ROI (saves any linked shapes too)
-    updateService.saveObject(roi)
+    # Save the ROI (saves any linked shapes too), in batches
+    writer.add(roi)
 
 def delete_ROIs(conn, image):
     rois = conn.getObjects('Roi', opts={'image': image.id})
@@ -61,7 +63,8 @@ def main(argv):
 
     with cli_login() as cli:
         conn = BlitzGateway(client_obj=cli._client)
-        updateService = conn.getUpdateService()
+        writer = RoiWriter(conn)
+        stats = EncodingStats()
 
         images = []
         target_type = args.target.split(':')[0]
@@ -100,8 +103,10 @@ def main(argv):
             total += len(contours)
             img_count += 1
             for c in contours:
-                add_polygon(image, updateService, c)
+                add_polygon(image, writer, c, stats=stats)
 
+        writer.close()
+        print(stats.report())
         print('Total shapes:', total, "images:", img_count)
 
 if __name__ == '__main__':
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+A local SQLite record of what copy_dataset.py has copied to a target server.
+
+For each target server it maps:
+- the copied object (e.g. 'Dataset:123') to the target Dataset ID
+- source Image IDs to target Image IDs (for --pixels copies)
+- source Fileset IDs to the target Image IDs imported from them, with the
+  ID, size and hash of each source file, so that a Fileset whose files
+  changed is copied again
+
+Each change is committed straight away, so a sync that fails can be run
+again and carries on from where it stopped.
+
+    state = SyncState('copy_state.db', 'target.example.org')
+    record = state.get_fileset(fileset_id)
+"""
+
+import json
+import sqlite3
+
+STARTED = 'started'
+IMPORTED = 'imported'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    source TEXT, server TEXT, target_id INTEGER,
+    PRIMARY KEY (source, server));
+CREATE TABLE IF NOT EXISTS images (
+    source_id INTEGER, server TEXT, target_id INTEGER,
+    PRIMARY KEY (source_id, server));
+CREATE TABLE IF NOT EXISTS filesets (
+    source_id INTEGER, server TEXT, status TEXT, image_ids TEXT,
+    PRIMARY KEY (source_id, server));
+CREATE TABLE IF NOT EXISTS files (
+    fileset_id INTEGER, server TEXT, file_id INTEGER, size INTEGER, hash TEXT,
+    PRIMARY KEY (fileset_id, server, file_id));
+"""
+
+
+class SyncState(object):
+    """Source to target ID mappings for one target server, in SQLite."""
+
+    def __init__(self, path, server):
+        self.server = server
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_dataset(self, source):
+        """The target Dataset ID for the copied object e.g. 'Dataset:1', or None."""
+        row = self.db.execute(
+            "SELECT target_id FROM datasets WHERE source=? AND server=?",
+            (source, self.server)).fetchone()
+        return row[0] if row else None
+
+    def set_dataset(self, source, target_id):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO datasets VALUES (?, ?, ?)",
+                            (source, self.server, target_id))
+
+    def get_image(self, source_id):
+        """The target Image ID of a source Image copied with --pixels, or None."""
+        row = self.db.execute(
+            "SELECT target_id FROM images WHERE source_id=? AND server=?",
+            (source_id, self.server)).fetchone()
+        return row[0] if row else None
+
+    def set_image(self, source_id, target_id):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?)",
+                            (source_id, self.server, target_id))
+
+    def get_fileset(self, source_id):
+        """
+        Return a dict of the status, target image_ids and files
+        [(file ID, size, hash)] of a source Fileset, or None.
+        """
+        row = self.db.execute(
+            "SELECT status, image_ids FROM filesets WHERE source_id=? AND server=?",
+            (source_id, self.server)).fetchone()
+        if row is None:
+            return None
+        files = self.db.execute(
+            "SELECT file_id, size, hash FROM files WHERE fileset_id=? AND server=? "
+            "ORDER BY file_id", (source_id, self.server)).fetchall()
+        return {'status': row[0], 'image_ids': json.loads(row[1]), 'files': files}
+
+    def start_fileset(self, source_id, files):
+        """Record that copying a Fileset with files [(file ID, size, hash)] started."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO filesets VALUES (?, ?, ?, ?)",
+                            (source_id, self.server, STARTED, '[]'))
+            self.db.execute("DELETE FROM files WHERE fileset_id=? AND server=?",
+                            (source_id, self.server))
+            self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                                [(source_id, self.server) + tuple(f) for f in files])
+
+    def set_fileset_images(self, source_id, image_ids):
+        """Record the target Images imported from a Fileset."""
+        with self.db:
+            self.db.execute("UPDATE filesets SET status=?, image_ids=? WHERE source_id=? AND server=?",
+                            (IMPORTED, json.dumps(image_ids), source_id, self.server))
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+Columnar writer for OMERO.tables.
+
+Data is given as columns: a dict of {name: NumPy array (or list)} or an
+Arrow RecordBatch / Table. Column types and string widths are inferred
+from the data and rows are written in batches of `batch_size`:
+
+    backend = OmeroTableBackend(conn, "my_table")
+    with TableWriter(backend, column_types={"image": "image"}) as writer:
+        writer.write({"image": image_ids, "area": areas})
+    orig_file = writer.result
+
+The same data can be written to a MemoryBackend or HDF5Backend to test
+or benchmark without a server:
+
+$ python table_writer.py 1000000 10000
+"""
+
+from collections import namedtuple
+import os
+import sys
+from timeit import default_timer
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    from omero.grid import BoolColumn, DatasetColumn, DoubleColumn, \
+        ImageColumn, LongColumn, PlateColumn, RoiColumn, StringColumn, \
+        WellColumn
+    from omero.model import FileAnnotationI, OriginalFileI
+    from omero.rtypes import rstring
+except ImportError:
+    # Only the local backends can be used
+    pass
+
+DEFAULT_BATCH_SIZE = 10000
+
+# String columns created before all the rows are seen are at least this
+# wide, and twice the longest string seen, so that longer strings in later
+# batches fit
+MIN_STRING_WIDTH = 64
+
+# kind: numpy dtype used to hold the values
+KIND_DTYPES = {
+    "long": np.int64,
+    "double": np.float64,
+    "bool": np.bool_,
+    "string": np.str_,
+    # ID columns, stored as long
+    "image": np.int64,
+    "well": np.int64,
+    "plate": np.int64,
+    "dataset": np.int64,
+    "roi": np.int64,
+}
+
+# Values used in rows_to_arrays() when a row has no value
+MISSING_VALUES = {
+    "long": -1,
+    "double": np.nan,
+    "bool": False,
+    "string": "",
+}
+
+# width is only used for string columns
+ColumnSpec = namedtuple("ColumnSpec", ["name", "kind", "width"])
+
+
+def infer_kind(values):
+    """Return the column kind for a NumPy array, from its dtype."""
+    if values.dtype.kind == "b":
+        return "bool"
+    if values.dtype.kind in "iu":
+        return "long"
+    if values.dtype.kind == "f":
+        return "double"
+    return "string"
+
+
+def string_width(values):
+    """Return the longest UTF-8 encoded length of the values (at least 1)."""
+    if len(values) == 0:
+        return 1
+    encoded = np.char.encode(values.astype(np.str_), "utf-8")
+    return max(encoded.dtype.itemsize, 1)
+
+
+def to_arrays(data):
+    """
+    Convert data into a dict of {name: NumPy array}.
+
+    data can be a dict of arrays or lists, or an Arrow RecordBatch or Table.
+    """
+    if hasattr(data, "schema") and hasattr(data, "column"):
+        # Arrow: avoid importing pyarrow unless we are given Arrow data
+        return {name: np.asarray(data.column(i).to_numpy(
+                    zero_copy_only=False))
+                for i, name in enumerate(data.schema.names)}
+    return {name: np.asarray(values) for name, values in data.items()}
+
+
+def rows_to_arrays(rows, names, column_types):
+    """
+    Convert a list of dicts into a dict of {name: NumPy array}.
+
+    column_types maps name to kind. Missing values (None or "") are
+    replaced by MISSING_VALUES for the kind, e.g. NaN for "double".
+    """
+    arrays = {}
+    for name in names:
+        kind = column_types.get(name, "string")
+        dtype = KIND_DTYPES[kind]
+        missing = MISSING_VALUES.get(kind, -1)
+        values = [row.get(name) for row in rows]
+        values = [missing if v is None or v == "" else v for v in values]
+        if dtype is np.int64:
+            # values read from a CSV may be strings like "12.5"
+            values = np.asarray(values, dtype=np.float64)
+        arrays[name] = np.asarray(values).astype(dtype)
+    return arrays
+
+
+class TableWriter(object):
+    """Buffer columns of data and write them to a backend in batches."""
+
+    def __init__(self, backend, batch_size=DEFAULT_BATCH_SIZE,
+                 column_types=None, string_widths=None):
+        """
+        Create a writer. Columns are created from the first batch written.
+
+        column_types: {name: kind} for columns that can't be inferred
+            from the dtype, e.g. {"image_id": "image"}
+        string_widths: {name: width} of string columns, e.g. from a scan
+            of all the data. Otherwise the width is the longest string
+            buffered when the first batch is written, with headroom (see
+            MIN_STRING_WIDTH) unless all the rows are buffered by close().
+        """
+        self.backend = backend
+        self.batch_size = batch_size
+        self.column_types = column_types or {}
+        self.string_widths = string_widths or {}
+        self.columns = None
+        self.row_count = 0
+        self.result = None
+        self._buffer = []
+        self._buffered_rows = 0
+        self._names = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        """Add columns of data, writing a batch when enough are buffered."""
+        arrays = to_arrays(data)
+        lengths = set(len(values) for values in arrays.values())
+        if len(lengths) > 1:
+            raise ValueError("Columns have different lengths: %s" % lengths)
+        rows = lengths.pop() if lengths else 0
+        if rows == 0:
+            # remember the columns in case no rows are ever written
+            self._names = arrays
+            return
+        self._buffer.append(arrays)
+        self._buffered_rows += rows
+        while self._buffered_rows >= self.batch_size:
+            self._write_batch(self.batch_size)
+
+    def flush(self):
+        """Write all the buffered rows."""
+        while self._buffered_rows > 0:
+            self._write_batch(min(self.batch_size, self._buffered_rows))
+
+    def close(self):
+        """
+        Flush and close the backend. Returns and sets self.result.
+
+        If the rows can't be written, the backend is aborted instead.
+        """
+        try:
+            if self.columns is None:
+                # all the rows are buffered, so the string widths are known
+                arrays = self._buffered_arrays() if self._buffer else self._names
+                if not arrays:
+                    raise ValueError("No columns to write to the table")
+                self.columns = self.init_columns(arrays, final=True)
+            self.flush()
+        except Exception:
+            self.abort()
+            raise
+        self.result = self.backend.close()
+        return self.result
+
+    def abort(self):
+        """Drop the buffered rows and abort the backend, e.g. after an error."""
+        self._buffer = []
+        self._buffered_rows = 0
+        self.backend.abort()
+
+    def _take_rows(self, count):
+        """Remove count rows from the front of the buffer."""
+        names = list(self._buffer[0].keys())
+        parts = {name: [] for name in names}
+        taken = 0
+        while taken < count:
+            arrays = self._buffer[0]
+            available = len(arrays[names[0]])
+            needed = count - taken
+            for name in names:
+                parts[name].append(arrays[name][:needed])
+            if available > needed:
+                self._buffer[0] = {name: values[needed:]
+                                   for name, values in arrays.items()}
+            else:
+                self._buffer.pop(0)
+            taken += min(available, needed)
+        self._buffered_rows -= count
+        return {name: values[0] if len(values) == 1
+                else np.concatenate(values)
+                for name, values in parts.items()}
+
+    def _buffered_arrays(self):
+        return {name: np.concatenate([a[name] for a in self._buffer])
+                for name in self._buffer[0]}
+
+    def init_columns(self, arrays, final=False):
+        """
+        Work out the ColumnSpecs and initialize the backend.
+
+        final: True if arrays has all the rows, so string columns don't
+            need headroom for longer strings.
+        """
+        columns = []
+        for name, values in arrays.items():
+            kind = self.column_types.get(name, infer_kind(values))
+            width = None
+            if kind == "string":
+                width = string_width(values)
+                if name in self.string_widths:
+                    width = max(self.string_widths[name], width)
+                elif not final:
+                    width = max(2 * width, MIN_STRING_WIDTH)
+            columns.append(ColumnSpec(name, kind, width))
+        self.backend.initialize(columns)
+        return columns
+
+    def _write_batch(self, count):
+        if self.columns is None:
+            # use everything buffered so far to choose the column widths
+            self.columns = self.init_columns(self._buffered_arrays())
+        arrays = self._take_rows(count)
+        batch = []
+        for column in self.columns:
+            values = arrays[column.name].astype(KIND_DTYPES[column.kind])
+            if column.kind == "string":
+                width = string_width(values)
+                if width > column.width:
+                    raise ValueError(
+                        "Column '%s' has a string of %s bytes, longer than "
+                        "its width %s. Use string_widths to set a larger "
+                        "width." % (column.name, width, column.width))
+            batch.append(values)
+        self.backend.add_data(self.columns, batch)
+        self.row_count += count
+
+
+class MemoryBackend(object):
+    """Keep the batches in memory. close() returns a dict of arrays."""
+
+    def __init__(self):
+        self.columns = None
+        self.batches = []
+
+    def initialize(self, columns):
+        self.columns = columns
+
+    def add_data(self, columns, batch):
+        self.batches.append(batch)
+
+    def abort(self):
+        self.batches = []
+
+    def close(self):
+        return {column.name: np.concatenate([b[i] for b in self.batches])
+                if self.batches else np.array([])
+                for i, column in enumerate(self.columns)}
+
+
+class HDF5Backend(object):
+    """Append batches to resizable HDF5 datasets. Needs h5py."""
+
+    def __init__(self, path):
+        if h5py is None:
+            raise ImportError("HDF5Backend needs h5py: pip install h5py")
+        self.path = path
+        self.h5file = h5py.File(path, "w")
+
+    def initialize(self, columns):
+        for column in columns:
+            if column.kind == "string":
+                dtype = "S%s" % column.width
+            else:
+                dtype = KIND_DTYPES[column.kind]
+            self.h5file.create_dataset(column.name, shape=(0,),
+                                       maxshape=(None,), dtype=dtype,
+                                       chunks=True)
+
+    def add_data(self, columns, batch):
+        for column, values in zip(columns, batch):
+            if column.kind == "string":
+                values = np.char.encode(values, "utf-8")
+            dataset = self.h5file[column.name]
+            start = dataset.shape[0]
+            dataset.resize((start + len(values),))
+            dataset[start:] = values
+
+    def abort(self):
+        self.h5file.close()
+        os.remove(self.path)
+
+    def close(self):
+        self.h5file.close()
+        return self.path
+
+
+class OmeroTableBackend(object):
+    """Write batches to a new OMERO.table. close() returns the OriginalFile."""
+
+    def __init__(self, conn, table_name, repository_id=None):
+        resources = conn.c.sf.sharedResources()
+        if repository_id is None:
+            repository_id = resources.repositories().descriptions[0].getId()
+            repository_id = repository_id.getValue()
+        self.table = resources.newTable(repository_id, table_name)
+
+    @staticmethod
+    def create_column(column, values):
+        column_class = {
+            "long": LongColumn,
+            "double": DoubleColumn,
+            "bool": BoolColumn,
+            "string": StringColumn,
+            "image": ImageColumn,
+            "well": WellColumn,
+            "plate": PlateColumn,
+            "dataset": DatasetColumn,
+            "roi": RoiColumn,
+        }[column.kind]
+        if column_class is StringColumn:
+            return StringColumn(column.name, '', column.width, values)
+        return column_class(column.name, '', values)
+
+    def initialize(self, columns):
+        self.table.initialize([self.create_column(column, [])
+                               for column in columns])
+
+    def add_data(self, columns, batch):
+        self.table.addData([self.create_column(column, values.tolist())
+                            for column, values in zip(columns, batch)])
+
+    def abort(self):
+        """Delete the table's file, which may have no columns or only some rows."""
+        try:
+            self.table.delete()
+        finally:
+            self.table.close()
+
+    def close(self):
+        orig_file = self.table.getOriginalFile()
+        self.table.close()
+        return orig_file
+
+
+def save_file_annotation(conn, orig_file, ns=None):
+    """Create a FileAnnotation for the table's OriginalFile."""
+    file_ann = FileAnnotationI()
+    if ns is not None:
+        file_ann.setNs(rstring(ns))
+    file_ann.setFile(OriginalFileI(orig_file.id.val, False))
+    return conn.getUpdateService().saveAndReturnObject(file_ann)
+
+
+def random_columns(row_count, seed=0):
+    """Create columns of random data, like a ROI export."""
+    rng = np.random.default_rng(seed)
+    shape_types = np.array(["polygon", "rectangle", "ellipse", "point"])
+    return {
+        "image_id": rng.integers(1, 1000, row_count),
+        "shape_id": np.arange(row_count),
+        "type": shape_types[rng.integers(0, 4, row_count)],
+        "area": rng.uniform(0, 1000, row_count),
+        "X": rng.uniform(0, 10000, row_count),
+        "Y": rng.uniform(0, 10000, row_count),
+    }
+
+
+def benchmark(row_count=1000000, batch_size=DEFAULT_BATCH_SIZE,
+              path="table_writer_benchmark.h5"):
+    """Time writing random columns to the local backends."""
+    columns = random_columns(row_count)
+    backends = [("memory", MemoryBackend())]
+    if h5py is not None:
+        backends.append(("hdf5", HDF5Backend(path)))
+    for name, backend in backends:
+        start = default_timer()
+        writer = TableWriter(backend, batch_size=batch_size,
+                             column_types={"image_id": "image"})
+        # write in pieces smaller than a batch to exercise the buffer
+        piece = max(batch_size // 3, 1)
+        for i in range(0, row_count, piece):
+            writer.write({key: values[i:i + piece]
+                          for key, values in columns.items()})
+        writer.close()
+        duration = default_timer() - start
+        print("%s: %s rows in %.3f s (%.0f rows/s)" % (
+            name, writer.row_count, duration, writer.row_count / duration))
+
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
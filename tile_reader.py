@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+Read NumPy tiles at any resolution level of an OMERO image.
+
+One RawPixelsStore is opened and reused for all the tiles. Levels are
+numbered like OME-Zarr datasets: 0 is the full resolution, 1 is the next
+(smaller) level of the server's pyramid, and so on.
+
+    with TileReader(image) as reader:
+        print(reader.resolutions)
+        tile = reader.get_tile(z, c, t, x, y, w, h, level=1)
+        tiles = reader.get_tiles([(z, c, t, x, y, w, h), ...], level=1)
+
+Neighbouring tiles in the same row are read from the server with a
+single getTile() call. To read tiles on a background thread, ahead of
+processing them:
+
+    tiles = get_tiles(size_t, size_c, size_z, size_y, size_x, tile_w, tile_h)
+    for (z, c, t, x, y, w, h), tile in prefetch_tiles(reader, tiles):
+        ...
+
+To read tiles from many threads, a PixelsStorePool keeps one store per
+(thread, pixels ID, level) open between calls, and closes idle ones:
+
+    with PixelsStorePool(conn) as pool:
+        # on each thread...
+        with pool.reader(image, level) as reader:
+            tile = reader.get_tile(z, c, t, x, y, w, h, level)
+
+Usage (prints the levels and reads a tile from the smallest level):
+$ python tile_reader.py IMAGE_ID
+"""
+
+import argparse
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import Ice
+import numpy as np
+from omero.cli import cli_login
+from omero.gateway import BlitzGateway
+
+from queue_helpers import put
+
+PIXEL_TYPES = {
+    'int8': np.int8,
+    'uint8': np.uint8,
+    'int16': np.int16,
+    'uint16': np.uint16,
+    'int32': np.int32,
+    'uint32': np.uint32,
+    'float': np.float32,
+    'double': np.float64,
+}
+
+# Upper limit on the size of a single getTile() of neighbouring tiles
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+# Tiles that prefetch_tiles() may read ahead of the caller
+PREFETCH = 8
+
+# PixelsStorePool closes stores that are not used for IDLE_TIMEOUT seconds,
+# and keeps the session alive every KEEPALIVE seconds.
+IDLE_TIMEOUT = 60
+KEEPALIVE = 60
+
+
+def get_dtype(image):
+    """The NumPy dtype of the image pixels."""
+    return np.dtype(PIXEL_TYPES[image.getPrimaryPixels().getPixelsType().value])
+
+
+def group_context(conn, group_id=None):
+    """
+    A copy of the connection's call context, in the group if given, so that
+    stores can open images in any group, not just the session's current one.
+    """
+    ctx = conn.SERVICE_OPTS.copy()
+    if group_id is not None:
+        ctx.setOmeroGroup(group_id)
+    return ctx
+
+
+class TileReader(object):
+    """Reads tiles from one RawPixelsStore, at any resolution level."""
+
+    def __init__(self, image, store=None, max_batch_bytes=MAX_BATCH_BYTES, level=None,
+                 fixed_level=False):
+        """
+        Open a RawPixelsStore for the image, or use store if given e.g.
+        from a pool, which is then not closed by close(). level is the
+        level that the given store is already set to, if known. If
+        fixed_level, the level of the store can't be changed, e.g. because
+        a pool keeps it for that level.
+        """
+        self.dtype = get_dtype(image)
+        # RawPixelsStore tiles are big-endian
+        self.be_dtype = self.dtype.newbyteorder('>')
+        self.max_batch_bytes = max_batch_bytes
+        self.own_store = store is None
+        if store is None:
+            store = open_store(image._conn, image.getPixelsId(),
+                               group_id=image.getDetails().getGroup().getId())
+        self.store = store
+        # sizes of each level, biggest first
+        self.resolutions = [(r.sizeX, r.sizeY) for r in store.getResolutionDescriptions()]
+        if len(self.resolutions) == 0:
+            self.resolutions = [(image.getSizeX(), image.getSizeY())]
+        self.level = level
+        self.fixed_level = fixed_level
+
+    @property
+    def level_count(self):
+        return len(self.resolutions)
+
+    def set_level(self, level):
+        """Set the level (0 is the biggest), if not already set."""
+        if level == self.level:
+            return
+        if self.fixed_level:
+            raise ValueError("This reader's store is fixed at level %s, not %s" % (self.level, level))
+        if level < 0 or level >= self.level_count:
+            raise ValueError("Level %s not in range 0-%s" % (level, self.level_count - 1))
+        if self.level_count > 1:
+            # RawPixelsStore levels are the other way round: 0 is the smallest
+            self.store.setResolutionLevel(self.level_count - 1 - level)
+        self.level = level
+
+    def get_tile_size(self, level=0):
+        """The (width, height) of the server's tiles at the level."""
+        self.set_level(level)
+        return tuple(self.store.getTileSize())
+
+    def get_tile(self, z, c, t, x, y, w, h, level=0):
+        """Return a (h, w) tile, in the native byte order."""
+        self.set_level(level)
+        data = self.store.getTile(z, c, t, x, y, w, h)
+        tile = np.frombuffer(data, dtype=self.be_dtype).reshape((h, w))
+        return tile.astype(self.dtype)
+
+    def get_tiles(self, tiles, level=0):
+        """
+        Return a list of (h, w) arrays for the list of (z, c, t, x, y, w, h).
+
+        Tiles of the same plane and row that are next to each other in X are
+        read together, up to max_batch_bytes per getTile().
+        """
+        results = [None] * len(tiles)
+        order = sorted(range(len(tiles)), key=lambda i: (tiles[i][:3], tiles[i][4], tiles[i][6], tiles[i][3]))
+        batch = []
+
+        def read_batch():
+            z, c, t, x, y, w, h = tiles[batch[0]]
+            width = sum(tiles[i][5] for i in batch)
+            row = self.get_tile(z, c, t, x, y, width, h, level)
+            for i in batch:
+                tile_x = tiles[i][3] - x
+                results[i] = row[:, tile_x:tile_x + tiles[i][5]]
+
+        for i in order:
+            if batch:
+                z, c, t, x, y, w, h = tiles[batch[-1]]
+                width = sum(tiles[j][5] for j in batch) + tiles[i][5]
+                if (tiles[i][:3] == (z, c, t) and tiles[i][4] == y and tiles[i][6] == h and
+                        tiles[i][3] == x + w and width * h * self.dtype.itemsize <= self.max_batch_bytes):
+                    batch.append(i)
+                    continue
+                read_batch()
+            batch = [i]
+        if batch:
+            read_batch()
+        return results
+
+    def close(self):
+        if self.own_store:
+            self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_store(conn, pixels_id, level=0, group_id=None):
+    """
+    Open a RawPixelsStore, set to the level (0 is the biggest). group_id is
+    the group of the pixels, needed if it isn't the session's current group.
+    """
+    store = conn.c.sf.createRawPixelsStore()
+    try:
+        store.setPixelsId(pixels_id, False, group_context(conn, group_id))
+        if level:
+            store.setResolutionLevel(store.getResolutionLevels() - 1 - level)
+    except Exception:
+        store.close()
+        raise
+    return store
+
+
+class PixelsStorePool(object):
+    """
+    Reuses RawPixelsStores across calls, with one per thread for each
+    (pixels ID, level), so that each tile doesn't pay for creating a store.
+
+    Stores that have not been used for idle_timeout seconds are closed, and
+    the session is kept alive, on a background thread.
+    """
+
+    def __init__(self, conn, idle_timeout=IDLE_TIMEOUT, keepalive=KEEPALIVE):
+        self.conn = conn
+        self.idle_timeout = idle_timeout
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        if keepalive:
+            self.thread = threading.Thread(target=self._keepalive, args=(keepalive,), daemon=True)
+            self.thread.start()
+
+    def _keepalive(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.conn.keepAlive()
+                self.evict_idle()
+            except Exception as ex:
+                print("keepAlive failed: %s" % ex)
+
+    @contextmanager
+    def _entry(self, pixels_id, level, group_id=None):
+        key = (threading.get_ident(), pixels_id, level)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                # so that evict_idle() doesn't close it
+                entry["in_use"] = True
+        if entry is None:
+            # only this thread uses this key, so we don't need the lock to open it
+            entry = {"store": open_store(self.conn, pixels_id, level, group_id), "reader": None,
+                     "in_use": True, "last_used": time.time()}
+            with self.lock:
+                self.entries[key] = entry
+        try:
+            yield entry
+        except Ice.Exception:
+            # a store call failed, so the store may be broken: open a new one next time
+            with self.lock:
+                self.entries.pop(key, None)
+            close_quietly(entry["store"])
+            raise
+        finally:
+            with self.lock:
+                entry["last_used"] = time.time()
+                entry["in_use"] = False
+
+    @contextmanager
+    def store(self, pixels_id, level=0, group_id=None):
+        """
+        A RawPixelsStore for pixels_id, set to the level, for this thread.
+        group_id is the group of the pixels, see open_store().
+        """
+        with self._entry(pixels_id, level, group_id) as entry:
+            yield entry["store"]
+
+    @contextmanager
+    def reader(self, image, level=0):
+        """A TileReader of image, with a store set to the level, for this thread."""
+        group_id = image.getDetails().getGroup().getId()
+        with self._entry(image.getPixelsId(), level, group_id) as entry:
+            if entry["reader"] is None:
+                entry["reader"] = TileReader(image, store=entry["store"], level=level,
+                                             fixed_level=True)
+            yield entry["reader"]
+
+    def evict_idle(self):
+        """Close the stores that have not been used for idle_timeout."""
+        now = time.time()
+        with self.lock:
+            idle = [key for key, entry in self.entries.items()
+                    if not entry["in_use"] and now - entry["last_used"] > self.idle_timeout]
+            stores = [self.entries.pop(key)["store"] for key in idle]
+        for store in stores:
+            close_quietly(store)
+        return len(stores)
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            stores = [entry["store"] for entry in self.entries.values()]
+            self.entries = {}
+        for store in stores:
+            close_quietly(store)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def close_quietly(store):
+    try:
+        store.close()
+    except Exception as ex:
+        print("Failed to close store: %s" % ex)
+
+
+def get_tiles(size_t, size_c, size_z, size_y, size_x, tile_w, tile_h):
+    """List (z, c, t, x, y, w, h) of every tile, by T, C, Z, then rows of tiles."""
+    tiles = []
+    for t in range(size_t):
+        for c in range(size_c):
+            for z in range(size_z):
+                for y in range(0, size_y, tile_h):
+                    for x in range(0, size_x, tile_w):
+                        w = min(tile_w, size_x - x)
+                        h = min(tile_h, size_y - y)
+                        tiles.append((z, c, t, x, y, w, h))
+    return tiles
+
+
+def read_tiles(reader, tiles, level, tile_queue, stopped):
+    """
+    Put each tile from the TileReader onto tile_queue, then None when done.
+
+    Runs on a reader thread. Each row of tiles is read with one get_tiles().
+    If reading fails, the exception is put onto the queue instead, so it can
+    be raised by the consumer. Stops early if the stopped Event is set.
+    """
+    try:
+        row = []
+        for tile in tiles:
+            if row and tile[:3] + tile[4:5] != row[0][:3] + row[0][4:5]:
+                for pos, data in zip(row, reader.get_tiles(row, level)):
+                    if not put(tile_queue, (pos, data), stopped):
+                        return
+                row = []
+            row.append(tile)
+        for pos, data in zip(row, reader.get_tiles(row, level)):
+            if not put(tile_queue, (pos, data), stopped):
+                return
+        put(tile_queue, None, stopped)
+    except Exception as ex:
+        put(tile_queue, ex, stopped)
+
+
+def prefetch_tiles(reader, tiles, level=0, prefetch=PREFETCH):
+    """
+    Yield ((z, c, t, x, y, w, h), tile) for the tiles, read by the TileReader
+    on a background thread, up to `prefetch` tiles ahead of the caller.
+    """
+    # bounded, so the reader can't get too far ahead
+    tile_queue = queue.Queue(maxsize=prefetch)
+    # set if the caller stops early, so the reader doesn't block on the queue
+    stopped = threading.Event()
+    thread = threading.Thread(target=read_tiles,
+                              args=(reader, tiles, level, tile_queue, stopped),
+                              daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = tile_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        # don't leave the reader using the store after the caller closes it
+        thread.join()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image_id', type=int, help='Image ID')
+    args = parser.parse_args(argv)
+
+    with cli_login() as cli:
+        conn = BlitzGateway(client_obj=cli._client)
+        image = conn.getObject('Image', args.image_id)
+        print('image', image.name)
+        with TileReader(image) as reader:
+            print('levels', reader.resolutions)
+            level = reader.level_count - 1
+            w, h = reader.get_tile_size(level)
+            size_x, size_y = reader.resolutions[level]
+            tile = reader.get_tile(0, 0, 0, 0, 0, min(w, size_x), min(h, size_y), level)
+            print('level', level, 'tile', tile.shape, tile.dtype)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
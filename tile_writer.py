@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# ------------------------------------------------------------------------------
+
+"""
+Create OMERO images and write their pixels tile by tile.
+
+Unlike createImageFromNumpySeq(), no whole plane is held in memory, so
+images with planes bigger than the server's max plane size can be written.
+
+    image = create_image(conn, name, size_x, size_y, size_z, size_c, size_t, dtype)
+    with TileWriter(image) as writer:
+        writer.set_tile(tile, z, c, t, x, y)
+
+copy_pixels() copies an image, from the same or another server, with
+tiles read by a TileReader up to `prefetch` tiles ahead of the writing.
+
+Usage (copy an image to another server):
+$ python tile_writer.py username password server IMAGE_ID
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import omero
+from omero.cli import cli_login
+from omero.gateway import BlitzGateway
+from omero.rtypes import rstring
+
+from tile_reader import (PIXEL_TYPES, PREFETCH, TileReader, get_dtype, get_tiles,
+                         prefetch_tiles)
+
+# OMERO pixels type of each NumPy dtype
+PIXELS_TYPES = {np.dtype(dtype): name for name, dtype in PIXEL_TYPES.items()}
+
+
+def create_image(conn, name, size_x, size_y, size_z, size_c, size_t, dtype,
+                 description=None, channel_names=None, dataset_id=None):
+    """Create an image with no pixel data yet, and return its ImageWrapper."""
+    dtype = np.dtype(dtype).newbyteorder('=')
+    if dtype == np.float16:
+        # OMERO has no half floats: the tiles are cast to float by set_tile()
+        dtype = np.dtype(np.float32)
+    if dtype not in PIXELS_TYPES:
+        raise ValueError("Cannot create an OMERO image with dtype: %s" % dtype)
+    pixels_type = conn.getQueryService().findByQuery(
+        "from PixelsType as p where p.value='%s'" % PIXELS_TYPES[dtype], None)
+    image_id = conn.getPixelsService().createImage(
+        size_x, size_y, size_z, size_t, list(range(size_c)), pixels_type,
+        name, description, conn.SERVICE_OPTS).getValue()
+    image = conn.getObject("Image", image_id)
+
+    if channel_names:
+        for channel, label in zip(image.getChannels(noRE=True), channel_names):
+            logical_channel = channel.getLogicalChannel()
+            logical_channel.setName(rstring(label))
+            logical_channel.save()
+    if dataset_id is not None:
+        link = omero.model.DatasetImageLinkI()
+        link.parent = omero.model.DatasetI(dataset_id, False)
+        link.child = omero.model.ImageI(image_id, False)
+        conn.getUpdateService().saveObject(link, conn.SERVICE_OPTS)
+    return image
+
+
+class TileWriter(object):
+    """Writes tiles to an image with one RawPixelsStore."""
+
+    def __init__(self, image, store=None):
+        """
+        Open a RawPixelsStore for the image, or use store if given e.g. a
+        fake one for testing.
+        """
+        self.conn = image._conn
+        self.pixels_id = image.getPixelsId()
+        self.dtype = get_dtype(image)
+        # RawPixelsStore tiles are big-endian
+        self.be_dtype = self.dtype.newbyteorder('>')
+        self.own_store = store is None
+        if store is None:
+            store = self.conn.c.sf.createRawPixelsStore()
+            store.setPixelsId(self.pixels_id, True, self.conn.SERVICE_OPTS)
+        self.store = store
+        # {c: [min, max]} of the pixels written
+        self.min_max = {}
+
+    def get_tile_size(self):
+        """The (width, height) of the server's tiles."""
+        return tuple(self.store.getTileSize())
+
+    def set_tile(self, tile, z, c, t, x, y):
+        """Write a (h, w) array at x, y of the plane."""
+        h, w = tile.shape
+        # setTile() needs bytes, not a NumPy array
+        data = np.ascontiguousarray(tile, dtype=self.be_dtype).tobytes()
+        self.store.setTile(data, z, c, t, x, y, w, h)
+        low, high = tile.min(), tile.max()
+        if c in self.min_max:
+            low = min(low, self.min_max[c][0])
+            high = max(high, self.min_max[c][1])
+        self.min_max[c] = [low, high]
+
+    def close(self):
+        """Save the channel min and max of the pixels written, and close the store."""
+        pixels_service = self.conn.getPixelsService()
+        for c, (low, high) in sorted(self.min_max.items()):
+            pixels_service.setChannelGlobalMinMax(
+                self.pixels_id, c, float(low), float(high), self.conn.SERVICE_OPTS)
+        if self.own_store:
+            self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def copy_pixels(image, conn2, name=None, dataset_id=None, tile_size=None,
+                prefetch=PREFETCH, size_z=None, size_t=None):
+    """
+    Create a copy of the image's pixels with conn2 (the same or another
+    server), tile by tile, and return the new ImageWrapper.
+
+    tile_size is the width and height of the tiles, by default the target
+    server's tile size. size_z and size_t can limit the copy to the first
+    Z-sections and timepoints.
+    """
+    size_x = image.getSizeX()
+    size_y = image.getSizeY()
+    size_c = image.getSizeC()
+    size_z = min(size_z or image.getSizeZ(), image.getSizeZ())
+    size_t = min(size_t or image.getSizeT(), image.getSizeT())
+
+    new_image = create_image(conn2, name or image.getName(), size_x, size_y, size_z, size_c, size_t,
+                             get_dtype(image), channel_names=image.getChannelLabels(),
+                             dataset_id=dataset_id)
+    with TileReader(image) as reader, TileWriter(new_image) as writer:
+        tile_w, tile_h = (tile_size, tile_size) if tile_size else writer.get_tile_size()
+        tiles = get_tiles(size_t, size_c, size_z, size_y, size_x, tile_w, tile_h)
+        count = 0
+        for (z, c, t, x, y, w, h), tile in prefetch_tiles(reader, tiles, prefetch=prefetch):
+            writer.set_tile(tile, z, c, t, x, y)
+            count += 1
+            if count % 100 == 0 or count == len(tiles):
+                print("copied %s / %s tiles" % (count, len(tiles)))
+    return new_image
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('username2', help='Target server Username')
+    parser.add_argument('password2', help='Target server Password')
+    parser.add_argument('server2', help='Target server')
+    parser.add_argument('image_id', type=int, help='Image to copy')
+    parser.add_argument('--port', type=int, default=4064, help="OMERO server port")
+    parser.add_argument('--prefetch', type=int, default=PREFETCH, help='Number of tiles to read ahead')
+    args = parser.parse_args(argv)
+
+    with cli_login() as cli:
+        conn = BlitzGateway(client_obj=cli._client)
+        conn.SERVICE_OPTS.setOmeroGroup(-1)
+        conn2 = BlitzGateway(args.username2, args.password2,
+                             port=args.port, host=args.server2)
+        conn2.connect()
+        image = conn.getObject('Image', args.image_id)
+        new_image = copy_pixels(image, conn2, prefetch=args.prefetch)
+        print("New image", new_image.id, new_image.name)
+        conn2.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
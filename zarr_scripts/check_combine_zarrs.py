@@ -0,0 +1,96 @@
+
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import zarr
+
+from combine_zarrs import TRANSFER_MODES, main
+
+"""
+Checks combine_zarrs.py with no real data: builds tiny single C/T zarrs in
+a temp dir, in the 'bioformats2raw' layout, combines them with each --mode
+and checks the output chunk files are the same bytes as the input ones.
+
+$ python check_combine_zarrs.py
+$ python check_combine_zarrs.py copy move
+"""
+
+ZARR_NAME = "fused_tp_<T:1-2>_ch<C:1-1>.zarr"
+SHAPE = (1, 1, 4, 64, 64)
+CHUNKS = (1, 1, 1, 32, 32)
+
+
+def create_input(input_dir, the_t, the_c):
+    """Write a 2-level zarr for one timepoint and channel, and return its data."""
+    name = "fused_tp_%s_ch%s.zarr" % (the_t, the_c)
+    os.makedirs(os.path.join(input_dir, name, "OME"))
+    with open(os.path.join(input_dir, name, "OME", "METADATA.ome.xml"), "w") as f:
+        f.write('<OME><Image><Pixels SizeC="1" SizeT="1"/></Image></OME>')
+    group = zarr.open_group(os.path.join(input_dir, name, "0"), mode="w")
+    group.attrs["multiscales"] = [{"datasets": [{"path": "0"}, {"path": "1"}]}]
+    rng = np.random.default_rng(the_t * 10 + the_c)
+    data = []
+    for level, path in enumerate(["0", "1"]):
+        shape = SHAPE[:3] + (SHAPE[3] // 2 ** level, SHAPE[4] // 2 ** level)
+        pixels = rng.integers(0, 1000, size=shape, dtype=np.uint16)
+        group.create_dataset(path, data=pixels, chunks=CHUNKS, dimension_separator="/")
+        data.append(pixels)
+    return data
+
+
+def read_chunk_files(path):
+    """{relative path: bytes} of every chunk file under path."""
+    chunks = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            with open(os.path.join(dirpath, filename), "rb") as f:
+                chunks[os.path.relpath(os.path.join(dirpath, filename), path)] = f.read()
+    return chunks
+
+
+def check_mode(mode):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        input_dir = os.path.join(tmp_dir, "input")
+        output_zarr = os.path.join(tmp_dir, "output.zarr")
+        inputs = {(t, c): create_input(input_dir, t + 1, c + 1) for t in range(2) for c in range(1)}
+
+        # the chunks of each (dataset, t, c) before the transfer
+        expected = {}
+        for (t, c) in inputs:
+            name = "fused_tp_%s_ch%s.zarr" % (t + 1, c + 1)
+            for dataset in ["0", "1"]:
+                in_path = os.path.join(input_dir, name, "0", dataset, "0", "0")
+                expected[(dataset, t, c)] = (in_path, read_chunk_files(in_path))
+
+        main([input_dir, output_zarr, ZARR_NAME, "--mode", mode, "--workers", "4"])
+
+        for (dataset, t, c), (in_path, chunks) in expected.items():
+            out_path = os.path.join(output_zarr, dataset, str(t), str(c))
+            assert read_chunk_files(out_path) == chunks, "%s: chunks differ at %s" % (mode, out_path)
+            for chunk in chunks:
+                src = os.path.join(in_path, chunk)
+                dst = os.path.join(out_path, chunk)
+                if mode == "move":
+                    assert not os.path.exists(src), "%s: %s not moved" % (mode, src)
+                elif mode == "hardlink":
+                    assert os.path.samefile(src, dst), "%s: %s not linked" % (mode, dst)
+                else:
+                    assert not os.path.samefile(src, dst), "%s: %s not copied" % (mode, dst)
+
+        # and zarr reads the combined image
+        for dataset in ["0", "1"]:
+            arr = zarr.open(os.path.join(output_zarr, dataset), mode="r")
+            for (t, c), data in inputs.items():
+                assert np.array_equal(arr[t, c], data[int(dataset)][0, 0]), "%s: pixels differ" % mode
+        print("%s: OK, %s arrays" % (mode, len(expected)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    for mode in sys.argv[1:] or TRANSFER_MODES:
+        check_mode(mode)
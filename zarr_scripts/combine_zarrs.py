@@ -1,11 +1,15 @@
 
 import argparse
+import fcntl
 import glob
 import os
 import shutil
 import sys
+import threading
+import time
 import zarr
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 
 """
@@ -40,8 +44,23 @@ To check only, use --dry-run:
 
 $ python combine_zarrs.py path/to/input_dir output.zarr "fused_tp_<T:1-123>_ch<C:1-2>.zarr" --dry-run
 
+Chunks are transferred by a pool of threads (--workers, default 8), using --mode:
+ - copy: copy each chunk file (default)
+ - hardlink: hard-link each chunk file (input and output on the same filesystem)
+ - reflink: copy-on-write clone of each chunk (e.g. on btrfs or XFS), else copy
+ - move: move each chunk file (destroying the original zarrs)
+
+$ python combine_zarrs.py path/to/input_dir output.zarr "fused_tp_<T:1-123>_ch<C:1-2>.zarr" --mode hardlink --workers 16
+
+To check each --mode on tiny zarrs in a temp dir, run check_combine_zarrs.py
+
 """
 
+TRANSFER_MODES = ("copy", "hardlink", "reflink", "move")
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
 def get_t_range(zarr_name):
     # E.g. fused_tp_<T:000-055>_ch<C:0-1>.zarr
     # Find the first <T:...> and extract the range
@@ -90,6 +109,89 @@ def get_zarr_name(the_t, the_c, zarr_name):
     return zarr_name
 
 
+def read_array_json(arr_path):
+    """Read the .zarray metadata, which is quicker than zarr.open()."""
+    with open(os.path.join(arr_path, '.zarray'), 'r') as f:
+        return json.load(f)
+
+
+def reflink(src, dst):
+    """Copy-on-write clone of src, or a plain copy if the filesystem can't."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def transfer_file(src, dst, mode):
+    """Copy, link or move a single file. Returns the number of bytes."""
+    size = os.path.getsize(src)
+    if mode == "copy":
+        shutil.copyfile(src, dst)
+    elif mode == "hardlink":
+        os.link(src, dst)
+    elif mode == "reflink":
+        reflink(src, dst)
+    elif mode == "move":
+        shutil.move(src, dst)
+    return size
+
+
+def list_chunk_files(in_path, out_path):
+    """Return (src, dst) of every file in in_path, creating the dirs in out_path."""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(in_path):
+        target_dir = os.path.join(out_path, os.path.relpath(dirpath, in_path))
+        os.makedirs(target_dir, exist_ok=True)
+        for filename in filenames:
+            files.append((os.path.join(dirpath, filename), os.path.join(target_dir, filename)))
+    return files
+
+
+class Progress():
+    """Count files and bytes from many threads, and print the throughput."""
+
+    def __init__(self, total_files, interval=5):
+        self.total_files = total_files
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.last_report = self.start
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            now = time.time()
+            if now - self.last_report >= self.interval or self.files == self.total_files:
+                self.last_report = now
+                self.report()
+
+    def report(self):
+        duration = max(time.time() - self.start, 1e-6)
+        print("%s/%s files, %.1f MB, %.1f files/s, %.1f MB/s" % (
+            self.files, self.total_files, self.bytes / 1e6,
+            self.files / duration, self.bytes / 1e6 / duration))
+
+
+def transfer_files(files, mode="copy", workers=8):
+    """Transfer all the (src, dst) files on a pool of threads."""
+    progress = Progress(len(files))
+
+    def transfer(src_dst):
+        progress.add(transfer_file(src_dst[0], src_dst[1], mode))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() to raise any exceptions from the threads
+        list(executor.map(transfer, files))
+    return progress
+
+
 def main(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('input', help='input dir that contains time*.zarr dirs')
@@ -97,6 +199,8 @@ def main(argv):
     parser.add_argument('zarr_name', help='E.g. fused_tp_<T:000-055>_ch<C:0-1>.zarr')
     parser.add_argument('--dry-run', help='Check only, no action', action="store_true")
     parser.add_argument('--overwrite', help='Overwrite existing output', action="store_true")
+    parser.add_argument('--mode', choices=TRANSFER_MODES, default="copy", help='How to transfer chunks')
+    parser.add_argument('--workers', type=int, default=8, help='Number of threads transferring chunks')
     args = parser.parse_args(argv)
 
     dry_run = args.dry_run
@@ -152,11 +256,8 @@ def main(argv):
             new_shape = (size_t, size_c) + arr.shape[2:]
 
             # Create an empty zarr array for each dataset, using the existing .zarray json (since it matches the chunks)
-            zarray_path = os.path.join(dir_path, '.zarray')
-            with open(zarray_path, 'r') as f:
-                json_text = f.read()
-                print('zarray', dataset, json_text)
-                array_json = json.loads(json_text)
+            array_json = read_array_json(dir_path)
+            print('zarray', dataset, array_json)
             # The only change we make is to update the shape...
             array_json["shape"] = new_shape
             # ...and write the new .zarray file for each dataset e.g. image.zarr/0/.zarray, image.zarr/1/.zarray etc
@@ -178,8 +279,10 @@ def main(argv):
         shutil.copy(group1, os.path.join(output_zarr, '.zgroup'))
 
     pyramid_shapes = []
+    to_transfer = []
 
-    # for each timepoint and channel, copy or move the data
+    # for each timepoint and channel, check the data before we start
+    # (so we don't move half the data and then find a problem)
     for the_t in range(size_t):
         for the_c in range(size_c):
             in_zarr = os.path.join(input_dir, get_zarr_name(the_t + t_range[0], the_c + c_range[0], zarr_name))
@@ -193,29 +296,36 @@ def main(argv):
                 # construct the paths
                 in_path = os.path.join(in_zarr, series, dataset, t, c)
                 out_path = os.path.join(output_zarr, dataset, str(the_t), str(the_c))
-                print('Copy', in_path, "->", out_path)
                 if not os.path.exists(in_path):
                     print(f"MISSING {in_path}")
                     continue
 
                 # check that the shape is the same for all timepoints
                 arr_path = os.path.join(in_zarr, series, dataset)
-                shape = zarr.open(arr_path, mode='r').shape
+                shape = tuple(read_array_json(arr_path)["shape"])
                 if len(pyramid_shapes) <= ds_index:
                     # first time through
                     pyramid_shapes.append(shape)
                 else:
                     assert pyramid_shapes[ds_index] == shape, f"Shape mismatch at timepoint {the_t} dataset {dataset}: {shape} != {pyramid_shapes[ds_index]}"
-
-                if not dry_run:
-                    # Had some issues with creating symlinks...
-                    # os.symlink(in_path, f'{output_zarr}/{dataset}/{the_t}', target_is_directory=True)
-
-                    # Copying instead of symlinking works!
-                    shutil.copytree(in_path, out_path)
-
-                    # Or we can MOVE the data... (destroying the original zarrs)
-                    # shutil.move(in_path, out_path)
+                to_transfer.append((in_path, out_path))
+
+    print(f"Checked {len(to_transfer)} arrays to {args.mode}")
+    if dry_run:
+        return
+
+    # Had some issues with creating symlinks for whole directories...
+    # so we copy, link or move each chunk file, on a pool of threads
+    files = []
+    for in_path, out_path in to_transfer:
+        files.extend(list_chunk_files(in_path, out_path))
+    print(f"Transferring {len(files)} files with {args.workers} threads...")
+    transfer_files(files, args.mode, args.workers)
+
+    if args.mode == "move":
+        # remove the empty dirs left behind
+        for in_path, out_path in to_transfer:
+            shutil.rmtree(in_path)
 
 
 if __name__ == '__main__':
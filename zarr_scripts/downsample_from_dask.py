@@ -1,21 +1,80 @@
 
+import itertools
 import os
+import random
+import numpy as np
 import dask.array as da
+import zarr
 
-from ome_zarr.dask_utils import resize as da_resize
+from downsample_kernels import dask_downsample, get_factors
 
-def downsample_pyramid_on_disk(original_image, group_path, paths):
+# Chunks are written to each level one at a time (each write is atomic in a
+# zarr DirectoryStore) so if a run is interrupted, the next run finds the
+# chunks that are missing and only computes those.
+# Chunks are computed and written in batches of BATCH_SIZE
+BATCH_SIZE = 1000
+
+
+def chunk_key(path, index):
+    # with dimension_separator="/" e.g. "1/0/0/3/4/5"
+    return "/".join([path] + [str(i) for i in index])
+
+
+def chunk_region(index, chunks, shape):
+    return tuple(slice(i * c, min((i + 1) * c, s)) for i, c, s in zip(index, chunks, shape))
+
+
+def get_level(source, method="mean"):
+    """The next (lazy) resolution, with the same chunks as source."""
+    factors = get_factors(source.shape, 2, ndim=3)
+    return dask_downsample(source, factors, out_chunks=source.chunksize, method=method)
+
+
+def missing_chunks(store, path, numblocks):
+    return [index for index in np.ndindex(*numblocks)
+            if chunk_key(path, index) not in store]
+
+
+def dependent_chunks(store, paths, count, index):
+    """
+    The (path, chunk index) of the chunks on disk in the levels after
+    paths[count] that were computed from its chunk at index.
+    """
+    level = zarr.open_array(store, path=paths[count], mode="r")
+    bounds = [(r.start, r.stop) for r in chunk_region(index, level.chunks, level.shape)]
+    shape = level.shape
+    chunks = []
+    for path in paths[count + 1:]:
+        if path + "/.zarray" not in store:
+            break
+        target = zarr.open_array(store, path=path, mode="r")
+        factors = get_factors(shape, 2, ndim=3)
+        # pixel i of this level is made from pixels [i * f, (i + 1) * f) of the previous one
+        bounds = [(start // f, min(-(-stop // f), size))
+                  for (start, stop), f, size in zip(bounds, factors, target.shape)]
+        if any(start >= stop for start, stop in bounds):
+            break
+        ranges = [range(start // c, -(-stop // c)) for (start, stop), c in zip(bounds, target.chunks)]
+        for chunk_index in itertools.product(*ranges):
+            if chunk_key(path, chunk_index) in store:
+                chunks.append((path, chunk_index))
+        shape = target.shape
+    return chunks
+
+
+def downsample_pyramid_on_disk(original_image, group_path, paths, method="mean"):
     """
     Takes a high-resolution Dask array at original_image
     and down-samples it by a factor of 2 for each of the paths
+
+    method is one of downsample_kernels.METHODS e.g. "mode" for labels
+    Levels that are complete are skipped. For other levels, only the
+    chunks that are missing are computed.
     """
 
+    store = zarr.DirectoryStore(group_path)
     for count, path in enumerate(paths):
         print("count", count, "path", path)
-        target_path = os.path.join(group_path, path)
-        if os.path.exists(target_path):
-            print("path exists: %s" % target_path)
-            continue
         # open previous resolution from disk via dask...
         if count == 0:
             dask_image = original_image
@@ -24,24 +83,82 @@ def downsample_pyramid_on_disk(original_image, group_path, paths):
             print("read from", path_to_array)
             dask_image = da.from_zarr(path_to_array)
 
-        # resize in X, Y and Z
-        dims = list(dask_image.shape)
-        dims[-1] = dims[-1] // 2
-        dims[-2] = dims[-2] // 2
-        dims[-3] = dims[-3] // 2
-        output = da_resize(
-            dask_image, tuple(dims), preserve_range=True, anti_aliasing=False
+        # resize in X, Y and Z, keeping the dtype and chunks
+        output = get_level(dask_image, method)
+
+        # write empty chunks too, so that every chunk on disk means "done"
+        target = zarr.open_array(
+            store, path=path, mode="a", shape=output.shape, chunks=output.chunksize,
+            dtype=output.dtype, dimension_separator="/", write_empty_chunks=True
         )
+        if target.shape != output.shape or target.chunks != output.chunksize:
+            raise ValueError("Existing array at %s has shape %s chunks %s, expected %s %s" % (
+                path, target.shape, target.chunks, output.shape, output.chunksize))
 
-        # write to disk
-        print("writing", group_path, path)
-        da.to_zarr(arr=output, url=group_path, component=path, dimension_separator="/")
+        todo = missing_chunks(store, path, output.numblocks)
+        total = int(np.prod(output.numblocks))
+        if not todo:
+            print("path complete: %s" % path)
+            continue
+        print("writing", group_path, path, "%s of %s chunks" % (len(todo), total))
+        for start in range(0, len(todo), BATCH_SIZE):
+            batch = todo[start:start + BATCH_SIZE]
+            da.store(
+                [output.blocks[index] for index in batch],
+                [target] * len(batch),
+                regions=[chunk_region(index, target.chunks, target.shape) for index in batch],
+                lock=False,
+            )
+            print("  written %s / %s chunks" % (total - len(todo) + start + len(batch), total))
 
     return paths
 
-# url = "https://minio-dev.openmicroscopy.org/idr/v0.4/idr0077/9836832_z_dtype_fix.zarr/0"
-url = "9836832_z_dtype_fix.zarr/0"
-original_image = da.from_zarr(url)
 
-downsample_pyramid_on_disk(original_image, "9836832_z_dtype_fix.zarr", ["1", "2", "3", "4", "5"])
+def verify_pyramid(original_image, group_path, paths, samples=10, method="mean", repair=False):
+    """
+    Recompute a random sample of the chunks in each level and compare them
+    with the chunks on disk. If repair, the chunks that differ are deleted,
+    with the chunks of later levels that were computed from them, so that
+    downsample_pyramid_on_disk() will write them all again.
+
+    Returns a list of (path, chunk index) that differ.
+    """
+    store = zarr.DirectoryStore(group_path)
+    bad_chunks = []
+    for count, path in enumerate(paths):
+        if count == 0:
+            dask_image = original_image
+        else:
+            dask_image = da.from_zarr(os.path.join(group_path, paths[count - 1]))
+        output = get_level(dask_image, method)
+        target = zarr.open_array(store, path=path, mode="r")
+
+        written = [index for index in np.ndindex(*output.numblocks)
+                   if chunk_key(path, index) in store]
+        sample = random.sample(written, min(samples, len(written)))
+        for index in sample:
+            expected = output.blocks[index].compute()
+            if not np.array_equal(target[chunk_region(index, target.chunks, target.shape)], expected):
+                print("chunk differs: %s %s" % (path, index))
+                bad_chunks.append((path, index))
+                if repair:
+                    dependents = dependent_chunks(store, paths, count, index)
+                    del store[chunk_key(path, index)]
+                    for dependent in dependents:
+                        del store[chunk_key(*dependent)]
+                    if dependents:
+                        print("  and %s chunks computed from it" % len(dependents))
+        print("verified %s chunks of %s" % (len(sample), path))
+    return bad_chunks
+
+
+if __name__ == "__main__":
+    # url = "https://minio-dev.openmicroscopy.org/idr/v0.4/idr0077/9836832_z_dtype_fix.zarr/0"
+    url = "9836832_z_dtype_fix.zarr/0"
+    original_image = da.from_zarr(url)
 
+    paths = ["1", "2", "3", "4", "5"]
+    downsample_pyramid_on_disk(original_image, "9836832_z_dtype_fix.zarr", paths)
+    if verify_pyramid(original_image, "9836832_z_dtype_fix.zarr", paths, repair=True):
+        # write the chunks that were removed
+        downsample_pyramid_on_disk(original_image, "9836832_z_dtype_fix.zarr", paths)
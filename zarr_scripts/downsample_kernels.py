@@ -0,0 +1,217 @@
+
+# Downsampling of 2D and 3D (or any N-D) NumPy and dask arrays by whole
+# factors, keeping the dtype of the data.
+#
+# skimage and ome_zarr resize() convert to float64 and back, which uses 4x the
+# memory of uint16 data and blurs label images. Here each method is a single
+# reshape-and-reduce of blocks of pixels:
+#
+#  - mean: integer mean, rounded to the nearest value (intensity images)
+#  - max / min: maximum or minimum of each block
+#  - nearest: the first pixel of each block
+#  - mode: the most common value of each block (label images)
+#
+#   small = downsample(data, get_factors(data.shape, 2, ndim=3), "mean")
+#
+# To compare with ome_zarr.dask_utils.resize (if installed):
+# $ python downsample_kernels.py
+
+import argparse
+from timeit import default_timer
+
+import dask.array as da
+import numpy as np
+
+try:
+    from ome_zarr.dask_utils import resize as dask_resize
+except ImportError:
+    dask_resize = None
+
+# Each rechunked dask block is downsampled by one task, so keep the graph
+# small enough for one node, with blocks of about TARGET_BYTES.
+TARGET_BYTES = 64 * 1024 * 1024
+MAX_BLOCKS = 10000
+
+
+def get_factors(shape, factor=2, ndim=2):
+    """Downsample the last ndim axes (e.g. 2 for YX, 3 for ZYX) by factor."""
+    factors = [1] * (len(shape) - ndim) + [factor] * ndim
+    # don't downsample an axis that is already smaller than factor
+    return tuple(f if size >= f else 1 for size, f in zip(shape, factors))
+
+
+def sum_dtype(dtype):
+    """A dtype that can sum a block of dtype values without overflow."""
+    if dtype.kind == 'u':
+        return np.uint32 if dtype.itemsize <= 2 else np.uint64
+    if dtype.kind == 'i':
+        return np.int32 if dtype.itemsize <= 2 else np.int64
+    if dtype.kind == 'b':
+        return np.uint32
+    # floats stay as they are e.g. float32 is not promoted to float64
+    return dtype
+
+
+def split_blocks(data, factors):
+    """
+    A view of data with each axis split into (size // factor, factor).
+
+    Returns the view and the axes of the factors, to reduce over.
+    """
+    split_shape = []
+    for size, f in zip(data.shape, factors):
+        split_shape.extend([size // f, f])
+    return data.reshape(split_shape), tuple(range(1, len(split_shape), 2))
+
+
+def block_mean(data, factors):
+    blocks, axes = split_blocks(data, factors)
+    count = int(np.prod(factors))
+    total = blocks.sum(axis=axes, dtype=sum_dtype(data.dtype))
+    if data.dtype.kind == 'f':
+        total /= count
+        return total
+    # round half up: floor((total + count / 2) / count)
+    total += count // 2
+    total //= count
+    return total.astype(data.dtype)
+
+
+def block_max(data, factors):
+    blocks, axes = split_blocks(data, factors)
+    return blocks.max(axis=axes)
+
+
+def block_min(data, factors):
+    blocks, axes = split_blocks(data, factors)
+    return blocks.min(axis=axes)
+
+
+def block_nearest(data, factors):
+    return data[tuple(slice(None, None, f) for f in factors)].copy()
+
+
+def block_mode(data, factors):
+    """
+    The most common value in each block. Ties go to the smallest value.
+
+    Values of each block are sorted, then counted by comparing with each
+    other, which is quick for the small blocks (e.g. 2x2x2) of a pyramid.
+    """
+    blocks, axes = split_blocks(data, factors)
+    out_axes = tuple(range(0, blocks.ndim, 2))
+    out_shape = tuple(blocks.shape[a] for a in out_axes)
+    count = int(np.prod(factors))
+    values = blocks.transpose(out_axes + axes).reshape(-1, count)
+    values = np.sort(values, axis=1)
+    counts = np.zeros(values.shape, dtype=np.uint8 if count < 256 else np.uint32)
+    for i in range(count):
+        counts[:, i] = (values == values[:, i:i + 1]).sum(axis=1)
+    best = counts.argmax(axis=1)
+    return values[np.arange(len(values)), best].reshape(out_shape)
+
+
+KERNELS = {
+    "mean": block_mean,
+    "max": block_max,
+    "min": block_min,
+    "nearest": block_nearest,
+    "mode": block_mode,
+}
+METHODS = tuple(KERNELS)
+
+
+def downsample(data, factors, method="mean"):
+    """
+    Downsample a NumPy array by the factor of each axis, in the source dtype.
+
+    Trailing pixels that don't fill a whole block are dropped, the same as
+    new_shape = shape // factor.
+    """
+    crop = tuple(slice(0, size - size % f) for size, f in zip(data.shape, factors))
+    return KERNELS[method](data[crop], factors)
+
+
+def plan_chunks(shape, chunks, factors, itemsize, target_bytes=TARGET_BYTES, max_blocks=MAX_BLOCKS):
+    """
+    Choose intermediate chunks that can each be downsampled on their own.
+
+    Along each downsampled axis the chunk size is a multiple of the factor
+    (e.g. Z chunks of 1 become 2). Chunks are then doubled along Z, Y and X
+    (while smaller than the array) until blocks are near target_bytes and
+    there are no more than max_blocks of them.
+    """
+    chunks = [max(f, -(-c // f) * f) for c, f in zip(chunks, factors)]
+    chunks = [min(c, s) for c, s in zip(chunks, shape)]
+
+    def n_blocks():
+        return int(np.prod([-(-s // c) for s, c in zip(shape, chunks)]))
+
+    def block_bytes():
+        return int(np.prod(chunks)) * itemsize
+
+    # grow Z first: that is where (1, 1, y, x) chunks need more planes
+    for axis in (-3, -2, -1):
+        while chunks[axis] < shape[axis] and block_bytes() * 2 <= target_bytes:
+            chunks[axis] = min(chunks[axis] * 2, shape[axis])
+    # if there are still too many blocks, grow them beyond target_bytes
+    for axis in (-1, -2, -3):
+        while chunks[axis] < shape[axis] and n_blocks() > max_blocks:
+            chunks[axis] = min(chunks[axis] * 2, shape[axis])
+    return tuple(int(c) for c in chunks)
+
+
+def dask_downsample(image, factors, out_chunks=None, method="mean"):
+    """
+    Downsample a dask array by factors, in the source dtype.
+
+    The array is rechunked (see plan_chunks) so that every block holds whole
+    multiples of the factors, then each block is reduced with downsample().
+    Trailing pixels that don't fill a block are dropped, like shape // factor.
+    """
+    out_shape = tuple(s // f for s, f in zip(image.shape, factors))
+    image = image[tuple(slice(0, s * f) for s, f in zip(out_shape, factors))]
+    in_chunks = plan_chunks(image.shape, image.chunksize, factors, image.dtype.itemsize)
+    image = image.rechunk(in_chunks)
+    block_chunks = tuple(tuple(c // f for c in dim_chunks)
+                         for dim_chunks, f in zip(image.chunks, factors))
+    output = image.map_blocks(KERNELS[method], factors, dtype=image.dtype,
+                              chunks=block_chunks)
+    if out_chunks is not None:
+        output = output.rechunk(tuple(min(c, s) for c, s in zip(out_chunks, out_shape)))
+    return output
+
+
+def benchmark(shape=(64, 512, 512), dtype="uint16", repeats=3):
+    """Time each method on a ZYX volume, and ome_zarr's dask resize() if installed."""
+    data = np.random.default_rng(0).integers(0, 1000, size=shape).astype(dtype)
+    factors = get_factors(shape, 2, ndim=3)
+    new_shape = tuple(s // f for s, f in zip(shape, factors))
+    print("Downsampling %s %s to %s" % (shape, dtype, new_shape))
+
+    def timed(name, func):
+        times = []
+        for _ in range(repeats):
+            start = default_timer()
+            result = func()
+            times.append(default_timer() - start)
+        print("%-12s %8.3f s  %s" % (name, min(times), result.dtype))
+
+    for method in METHODS:
+        timed(method, lambda: downsample(data, factors, method))
+    dask_data = da.from_array(data, chunks=(1,) + shape[1:])
+    timed("dask mean", lambda: dask_downsample(dask_data, factors).compute())
+    if dask_resize is None:
+        print("ome_zarr not installed: skipping dask_resize")
+    else:
+        timed("dask_resize", lambda: dask_resize(
+            dask_data.rechunk(shape), new_shape, preserve_range=True,
+            anti_aliasing=False).astype(data.dtype).compute())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", type=int, nargs=3, default=[64, 512, 512], help="Z Y X")
+    parser.add_argument("--dtype", default="uint16")
+    args = parser.parse_args()
+    benchmark(tuple(args.shape), args.dtype)
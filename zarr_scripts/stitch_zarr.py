@@ -1,58 +1,77 @@
-
 # See https://forum.image.sc/t/zoom-from-overview-to-detailed-scan-for-imported-czi-files/85002/7
 # Tested with the czi file from that post, converted to OME-NGFF with NGFF converter tool.
 
-# Dependencies are 'omero_zarr' and 'ome-zarr-py'
-# All should be installed with:
-# pip install omero-cli-zarr
+# Dependencies are 'zarr' and 'ome-zarr-py'
+# pip install ome-zarr
+
+# Usage:
+# $ python stitch_zarr.py "TEST 2023_10_10__1046.zarr" --blend feather --workers 8
+
+# To view the stitched image without writing it to disk, see virtual_mosaic.py
 
+import argparse
 import zarr
 import shutil
 import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from ome_zarr.io import parse_url
 
 import numpy as np
-import dask.array as da
 from math import ceil
 
 from ome_zarr.writer import write_multiscales_metadata
-from omero_zarr.raw_pixels import downsample_pyramid_on_disk
 
 import xml.etree.ElementTree as ET
 
 ZARR_PATH = "TEST 2023_10_10__1046.zarr"
 
-RESOLUTION = "0"
-RESOLUTION_SCALE = 1
-# Since the original file is very large, we can choose to use a lower resolution
-# from the OME-Zarr file. Full size is "0" resolution, half size is "1" etc.
-# RESOLUTION = "1"
-# RESOLUTION_SCALE = 2
+# Each resolution of the output is stitched from the same resolution of
+# each scene, instead of downsampling the full-size stitched image.
+# Full size is "0" resolution, half size is "1" etc. We can stop early
+# with --resolutions, since the original file is very large.
 
 SCHEMA = "{http://www.openmicroscopy.org/Schemas/OME/2016-06}"
 IMAGE = f"{SCHEMA}Image"
 STAGELABEL = f"{SCHEMA}StageLabel"
 PIXELS = f"{SCHEMA}Pixels"
 
-scenes = []
-img_index = -1
+# How to combine Scenes where they overlap:
+# "first": the first Scene (in the ome.xml) wins
+# "max": maximum intensity of all Scenes
+# "feather": average weighted by distance from each Scene's edge
+BLEND_MODES = ("first", "max", "feather")
+
+TILE_SIZE = 1024
+AXES = [{"name": "t", "type": "time"},
+        {"name": "c", "type": "channel"},
+        {"name": "z", "type": "space"},
+        {"name": "y", "type": "space"},
+        {"name": "x", "type": "space"}]
+# Used if the scenes' arrays can't tell us
+D_TYPE = np.uint8
 
 
 class Scene():
 
-    def __init__(self, img_index, size_x, size_y, pixsize, offset_x, offset_y):
+    def __init__(self, img_index, x, y, data):
+        """
+        A scene at one resolution.
+
+        x, y are the pixel coordinates in the stitched image at the same
+        resolution and data is the (t, c, z, y, x) zarr array.
+        """
         self.img_index = img_index
-        self.width = int(size_x) // RESOLUTION_SCALE
-        self.height = int(size_y) // RESOLUTION_SCALE
-        self.pixsize = float(pixsize)
-        # we want to work in pixel coordinates, so let's convert offsets
-        self.x = int(float(offset_x) / self.pixsize) // RESOLUTION_SCALE
-        self.y = int(float(offset_y) / self.pixsize) // RESOLUTION_SCALE
-        array_path = f"{ZARR_PATH}/{self.img_index}/{RESOLUTION}"
-        print("array_path", array_path)
-        self.data = da.from_zarr(array_path)
-        print("init width", self.width, "height", self.height, "pix", self.pixsize, "xy", self.x, self.y)
-        print("array.shape", self.data.shape)
+        self.x = x
+        self.y = y
+        # Read chunks straight from the zarr store, without a dask graph
+        self.data = data
+        self.dtype = data.dtype
+        self.size_t, self.size_c, self.size_z, self.height, self.width = data.shape
+
+    def has_plane(self, plane):
+        t, c, z = plane
+        return t < self.size_t and c < self.size_c and z < self.size_z
 
     def intersects(self, x, y, width, height):
         if x > self.x + self.width:
@@ -65,178 +84,408 @@ class Scene():
             return False
         return True
 
-    def get_region(self, ch_index, x, y, width, height):
-        if not self.intersects(x, y, width, height):
+    def overlap(self, x, y, width, height):
+        """
+        Find where the region x, y, width, height overlaps this scene.
+
+        Returns (paste_y, paste_x, img_y, img_x, crop_height, crop_width)
+        where paste_y, paste_x are relative to the region and img_y, img_x
+        are relative to the scene. Returns None if there is no overlap.
+        """
+        x1 = max(x, self.x)
+        y1 = max(y, self.y)
+        x2 = min(x + width, self.x + self.width)
+        y2 = min(y + height, self.y + self.height)
+        if x2 <= x1 or y2 <= y1:
             return None
-
-        print("\nget_region x, y, width, height", x, y, width, height)
-        print("scene --- x, y, width, height", self.x, self.y, self.width, self.height)
-        # find coordinates relative to the image
-        img_x = x - self.x
-        img_y = y - self.y
-        crop_width = width
-        crop_height = height
-
-        paste_x = 0
-        paste_y = 0
-
-        print("img_ximg_ximg_x", img_x)
-        if img_x < 0:
-            crop_width = width + img_x
-            paste_x = -img_x
-            img_x = 0
-        if img_y < 0:
-            crop_height = height + img_y
-            paste_y = -img_y
-            img_y = 0
-        if x + width > self.x + self.width:
-            extra = (x + width) - (self.x + self.width)
-            crop_width = crop_width - extra
-        if y + height > self.y + self.height:
-            extra = (y + height) - (self.y + self.height)
-            crop_height = crop_height - extra
-
-
-        canvas = np.zeros((height, width), dtype=np.int8)
-        print("crop img_x", img_x, 'crop_width', crop_width, 'img_y', img_y, 'crop_height', crop_height)
-        region = self.data[0, ch_index, 0, img_y:(img_y + crop_height), img_x:(img_x + crop_width)]
-        print('region', region.shape)
-        print('paste_x, paste_y', paste_x, paste_y)
-        canvas[paste_y:(crop_height + paste_y), paste_x:(crop_width + paste_x)] = region
+        return (y1 - y, x1 - x, y1 - self.y, x1 - self.x, y2 - y1, x2 - x1)
+
+    def edge_weights(self, img_y, img_x, crop_height, crop_width):
+        """Weights for "feather" blending: distance to the scene's edge."""
+        ys = np.arange(img_y, img_y + crop_height)
+        xs = np.arange(img_x, img_x + crop_width)
+        weight_y = np.minimum(ys + 1, self.height - ys)
+        weight_x = np.minimum(xs + 1, self.width - xs)
+        return np.outer(weight_y, weight_x).astype(np.float32)
+
+    def read(self, plane, img_y, img_x, crop_height, crop_width, out=None):
+        """
+        Read a 2D region of the (t, c, z) plane, loading only the chunks needed.
+
+        If out is given, the data is read directly into it (e.g. a view of
+        a tile buffer), avoiding any temporary array.
+        """
+        t, c, z = plane
+        selection = (t, c, z, slice(img_y, img_y + crop_height), slice(img_x, img_x + crop_width))
+        return self.data.get_basic_selection(selection, out=out)
+
+    def get_region(self, plane, x, y, width, height, out=None):
+        """
+        Get the region x, y, width, height (in stitched coordinates).
+
+        Returns None if the scene doesn't overlap. Uses the dtype of the
+        scene. Areas outside the scene are 0. If out is given, it is used
+        as the canvas instead of allocating a new one.
+        """
+        overlap = self.overlap(x, y, width, height)
+        if overlap is None:
+            return None
+        paste_y, paste_x, img_y, img_x, crop_height, crop_width = overlap
+        if crop_height == height and crop_width == width and out is None:
+            # region is all inside the scene: no canvas needed
+            return self.read(plane, img_y, img_x, height, width)
+        if out is None:
+            canvas = np.zeros((height, width), dtype=self.dtype)
+        else:
+            canvas = out[:height, :width]
+            canvas[:] = 0
+        self.read(plane, img_y, img_x, crop_height, crop_width,
+                  out=canvas[paste_y:(paste_y + crop_height), paste_x:(paste_x + crop_width)])
         return canvas
 
 
-# Start by parsing the ome.xml to get the offsets for each "scene"...
-tree = ET.parse(f"{ZARR_PATH}/OME/METADATA.ome.xml")
-root = tree.getroot()
-for child in root:
-    is_img_tag = child.tag == IMAGE
-    if is_img_tag:
-        img_index += 1
-        size_x = None
-        size_y = None
-        offset_x = None
-        offset_y = None
-        # NB: assume pixels are square
-        pixsize = None
-        for ch_element in child:
-            if ch_element.tag == STAGELABEL:
-                # print("STAGELABEL", img_index, ch_element.attrib)
-                offset_x = ch_element.attrib.get("X")
-                offset_y = ch_element.attrib.get("Y")
-            elif ch_element.tag == PIXELS:
-                pix_attrs = ch_element.attrib
-                size_x = pix_attrs.get("SizeX")
-                size_y = pix_attrs.get("SizeY")
-                # size_z = pix_attrs.get("SizeZ")
-                # size_c = pix_attrs.get("SizeC")
-                # size_t = pix_attrs.get("SizeT")
-                pixsize = pix_attrs.get("PhysicalSizeX")
-        if offset_x is not None and size_x is not None:
-            print("image", img_index, offset_x,size_x)
-            scene = Scene(img_index, size_x, size_y, pixsize, offset_x, offset_y)
-            scenes.append(scene)
-
-if len(scenes) == 0:
-    print("Found no Images with StageLabel coordinates to stitch")
-
-# update offsets to start at 0, 0
-x_offsets = [scene.x for scene in scenes]
-y_offsets = [scene.y for scene in scenes]
-min_x_offset = min(x_offsets)
-min_y_offset = min(y_offsets)
-for scene in scenes:
-    scene.x = scene.x - min_x_offset
-    scene.y = scene.y - min_y_offset
-    print("xy", scene.img_index, scene.x, scene.y)
-
-# find total canvas size needed
-img_width = max([scene.x + scene.width for scene in scenes])
-img_height = max([scene.y + scene.height for scene in scenes])
-print("img_width, img_height", img_width, img_height)
-
-
-# create image...
-target = f"output_{RESOLUTION}.zarr"
-
-# in case we ran the script before, delete the output (useful when testing)
-if os.path.exists(target):
-    shutil.rmtree(target)
-
-store = parse_url(target, mode="w").store
-root = zarr.group(store=store)
-
-# Some values hard-coded
-tile_size = 1024
-channel_count = 3
-d_type = np.uint8
-
-# We only expect & handle 2D, 3-channel images...
-shape = (channel_count, img_height, img_width)
-chunks = (1, tile_size, tile_size)
-
-row_count = ceil(img_height/tile_size)
-col_count = ceil(img_width/tile_size)
-
-# create empty array at root of pyramid
-zarray = root.require_dataset(
-    "0",
-    shape=shape,
-    exact=True,
-    chunks=chunks,
-    dtype=d_type,
-)
-
-
-def get_tile(ch_index, col, row, tile_size):
-    # To get a tile, we check each of the Scenes in turn - returns None if no overlap
-    # NB: We only get a tile from the 1st scence which overlaps our tile.
-    # FIXME: would be better to get data from all scenes and combine them into a tile
-    for scene in scenes:
-        x = (col * tile_size)
-        y = (row * tile_size)
+def parse_images(zarr_path):
+    """
+    Parse the ome.xml to get the offsets and sizes for each "scene".
+
+    Returns a list of dicts, with x, y offsets in full-resolution pixels,
+    starting at 0, 0.
+    """
+    images = []
+    img_index = -1
+    tree = ET.parse(f"{zarr_path}/OME/METADATA.ome.xml")
+    root = tree.getroot()
+    for child in root:
+        is_img_tag = child.tag == IMAGE
+        if is_img_tag:
+            img_index += 1
+            offset_x = None
+            offset_y = None
+            pix_attrs = None
+            for ch_element in child:
+                if ch_element.tag == STAGELABEL:
+                    # print("STAGELABEL", img_index, ch_element.attrib)
+                    offset_x = ch_element.attrib.get("X")
+                    offset_y = ch_element.attrib.get("Y")
+                elif ch_element.tag == PIXELS:
+                    pix_attrs = ch_element.attrib
+            if offset_x is not None and pix_attrs is not None:
+                # NB: assume pixels are square
+                pixsize = float(pix_attrs.get("PhysicalSizeX"))
+                image = {
+                    "img_index": img_index,
+                    "pixsize": pixsize,
+                    # we want to work in pixel coordinates, so let's convert offsets
+                    "x": int(float(offset_x) / pixsize),
+                    "y": int(float(offset_y) / pixsize),
+                    "size_x": int(pix_attrs.get("SizeX")),
+                    "size_y": int(pix_attrs.get("SizeY")),
+                    "size_z": int(pix_attrs.get("SizeZ", 1)),
+                    "size_c": int(pix_attrs.get("SizeC", 1)),
+                    "size_t": int(pix_attrs.get("SizeT", 1)),
+                    "type": pix_attrs.get("Type"),
+                    "paths": get_resolution_paths(zarr_path, img_index),
+                }
+                print("image", img_index, offset_x, image["size_x"])
+                images.append(image)
+
+    if len(images) == 0:
+        return images
+
+    # update offsets to start at 0, 0
+    min_x_offset = min([image["x"] for image in images])
+    min_y_offset = min([image["y"] for image in images])
+    for image in images:
+        image["x"] = image["x"] - min_x_offset
+        image["y"] = image["y"] - min_y_offset
+        print("xy", image["img_index"], image["x"], image["y"])
+    return images
+
+
+def get_resolution_paths(zarr_path, img_index):
+    """Paths to each resolution of the image, from the multiscales metadata."""
+    group = zarr.open_group(f"{zarr_path}/{img_index}", mode="r")
+    multiscales = group.attrs.get("multiscales")
+    if multiscales is None:
+        return ["0"]
+    return [dataset["path"] for dataset in multiscales[0]["datasets"]]
+
+
+def create_scenes(zarr_path, images, level):
+    """Create a Scene for each image at resolution level (half size per level)."""
+    scenes = []
+    factor = 2 ** level
+    for image in images:
+        array_path = f"{zarr_path}/{image['img_index']}/{image['paths'][level]}"
+        data = zarr.open(array_path, mode="r")
+        scene = Scene(image["img_index"], image["x"] // factor, image["y"] // factor, data)
+        scenes.append(scene)
+    return scenes
+
+
+def get_level_shape(scenes):
+    """Return the (t, c, z, y, x) shape and dtype to hold all the scenes."""
+    # find total canvas size needed, and the size of the other dims
+    img_width = max([scene.x + scene.width for scene in scenes])
+    img_height = max([scene.y + scene.height for scene in scenes])
+    size_t = max(scene.size_t for scene in scenes)
+    size_c = max(scene.size_c for scene in scenes)
+    size_z = max(scene.size_z for scene in scenes)
+    # use the source dtype so we don't truncate e.g. uint16 data
+    dtype = np.result_type(*[scene.dtype for scene in scenes])
+    return (size_t, size_c, size_z, img_height, img_width), dtype
+
+
+def get_level_count(images, resolutions=None):
+    """Only stitch the resolutions that every scene has."""
+    level_count = min(len(image["paths"]) for image in images)
+    if resolutions is not None:
+        level_count = min(level_count, resolutions)
+    return level_count
+
+
+def get_transformations(level):
+    """Each level is half the size of the previous one, in X and Y."""
+    factor = float(2 ** level)
+    return [{"type": "scale", "scale": [1.0, 1.0, 1.0, factor, factor]}]
+
+
+def build_tile_index(scenes, tile_size):
+    """
+    Map each (row, col) output tile to the indices of Scenes that overlap it.
+
+    Each Scene is added to the grid of tiles it covers, so we never need to
+    test every Scene against every tile. Tiles not in the index are empty.
+    """
+    tile_index = defaultdict(list)
+    for scene_index, scene in enumerate(scenes):
+        first_row = scene.y // tile_size
+        last_row = (scene.y + scene.height - 1) // tile_size
+        first_col = scene.x // tile_size
+        last_col = (scene.x + scene.width - 1) // tile_size
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                tile_index[(row, col)].append(scene_index)
+    return tile_index
+
+
+def get_tile(scenes, plane, x, y, width, height, blend="first", dtype=D_TYPE, buffers=None):
+    """
+    Combine the data from all the scenes that overlap the tile of the (t, c, z) plane.
+
+    buffers is a dict from create_buffers(), reused for every tile so that
+    no arrays are allocated per tile. The returned tile is a view of
+    buffers["tile"], so it must be used before the next call.
+    """
+    if buffers is None:
+        buffers = create_buffers(max(width, height), dtype, blend)
+    tile = buffers["tile"][:height, :width]
+
+    overlaps = [(scene, scene.overlap(x, y, width, height)) for scene in scenes
+                if scene.has_plane(plane)]
+    overlaps = [(scene, overlap) for scene, overlap in overlaps if overlap is not None]
+
+    if blend in ("first", "max") and len(overlaps) > 0:
+        scene, (paste_y, paste_x, img_y, img_x, crop_height, crop_width) = overlaps[0]
+        if crop_height == height and crop_width == width and (blend == "first" or len(overlaps) == 1):
+            # The first scene covers the whole tile: read straight into it
+            scene.read(plane, img_y, img_x, height, width, out=tile)
+            return tile
+
+    tile[:] = 0
+    if blend == "first":
+        filled = buffers["filled"][:height, :width]
+        filled[:] = False
+    elif blend == "feather":
+        weighted_sum = buffers["weighted_sum"][:height, :width]
+        weights_sum = buffers["weights_sum"][:height, :width]
+        weighted_sum[:] = 0
+        weights_sum[:] = 0
+
+    for scene, overlap in overlaps:
+        paste_y, paste_x, img_y, img_x, crop_height, crop_width = overlap
+        region = buffers["region"][:crop_height, :crop_width]
+        scene.read(plane, img_y, img_x, crop_height, crop_width, out=region)
+        target = (slice(paste_y, paste_y + crop_height), slice(paste_x, paste_x + crop_width))
+        if blend == "first":
+            # only paste where no previous scene has data
+            empty = ~filled[target]
+            tile[target][empty] = region[empty]
+            filled[target] = True
+        elif blend == "max":
+            np.maximum(tile[target], region, out=tile[target])
+        elif blend == "feather":
+            weights = scene.edge_weights(img_y, img_x, crop_height, crop_width)
+            weighted_sum[target] += weights * region
+            weights_sum[target] += weights
+
+    if blend == "feather":
+        covered = weights_sum > 0
+        tile[covered] = np.round(weighted_sum[covered] / weights_sum[covered])
+    return tile
+
+
+def create_buffers(tile_size, dtype, blend):
+    """Allocate the arrays that get_tile() needs, once per worker."""
+    shape = (tile_size, tile_size)
+    buffers = {
+        "tile": np.zeros(shape, dtype=dtype),
+        "region": np.zeros(shape, dtype=dtype),
+    }
+    if blend == "first":
+        buffers["filled"] = np.zeros(shape, dtype=bool)
+    elif blend == "feather":
+        buffers["weighted_sum"] = np.zeros(shape, dtype=np.float64)
+        buffers["weights_sum"] = np.zeros(shape, dtype=np.float64)
+    return buffers
+
+
+# Each worker process gets its own copy of these, via init_worker()
+worker_state = {}
+
+
+def init_worker(zarr_path, images, target, tile_size, blend):
+    worker_state["zarr_path"] = zarr_path
+    worker_state["images"] = images
+    worker_state["target"] = target
+    worker_state["tile_size"] = tile_size
+    worker_state["blend"] = blend
+    # Scenes and output array for each level, opened when first needed
+    worker_state["levels"] = {}
+    worker_state["buffers"] = None
+
+
+def get_level(level):
+    if level not in worker_state["levels"]:
+        scenes = create_scenes(worker_state["zarr_path"], worker_state["images"], level)
+        zarray = zarr.open(os.path.join(worker_state["target"], str(level)), mode="r+")
+        worker_state["levels"][level] = (scenes, zarray)
+        if worker_state["buffers"] is None:
+            worker_state["buffers"] = create_buffers(worker_state["tile_size"], zarray.dtype, worker_state["blend"])
+    return worker_state["levels"][level]
+
+
+def stitch_tiles(tasks):
+    """
+    Stitch a list of (level, plane, row, col, scene_indices) tiles.
+
+    Each tile is one chunk of the output array, so workers never write
+    to the same chunk.
+    """
+    tile_size = worker_state["tile_size"]
+    for level, plane, row, col, scene_indices in tasks:
+        scenes, zarray = get_level(level)
+        img_height, img_width = zarray.shape[-2:]
+        x = col * tile_size
+        y = row * tile_size
         tile_w = min(tile_size, img_width - x)
         tile_h = min(tile_size, img_height - y)
-        tile = scene.get_region(ch_index, x, y, tile_w, tile_h)
-        if tile is not None:
-            return tile
-    
-
-print("row_count", row_count, "col_count", col_count)
-# Go through all tiles and write data to "0" array
-for ch_index in range(channel_count):
-    for row in range(row_count):
-        for col in range(col_count):
-            tile = get_tile(ch_index, col, row, tile_size)
-            if tile is None:
-                # No data - leave empty
-                continue
-            tile_w = tile.shape[-1]
-            tile_h = tile.shape[-2]
-            y1 = row * tile_size
-            y2 = y1 + tile_h
-            x1 = col * tile_size
-            x2 = x1 + tile_w
-            zarray[ch_index, y1:y2, x1:x2] = tile
-
-
-# We down-sample to generate an image pyramid...
-# We could dynamically choose the number of resolutions, but this works for now...
-paths = ["0", "1", "2", "3", "4"]
-axes = [{"name": "c", "type": "channel"}, {"name": "y", "type": "space"}, {"name": "x", "type": "space"}]
-
-# We have "0" array. This downsamples (in X and Y dims only) to create "1" and "2" etc.
-downsample_pyramid_on_disk(root, paths)
-
-transformations = [
-    [{"type": "scale", "scale": [1.0, 1.0, 1.0]}],
-    [{"type": "scale", "scale": [1.0, 2.0, 2.0]}],
-    [{"type": "scale", "scale": [1.0, 4.0, 4.0]}],
-    [{"type": "scale", "scale": [1.0, 8.0, 8.0]}],
-    [{"type": "scale", "scale": [1.0, 16.0, 16.0]}]
-]
-datasets = []
-for p, t in zip(paths, transformations):
-    datasets.append({"path": p, "coordinateTransformations": t})
-
-write_multiscales_metadata(root, datasets, axes=axes)
+        tile_scenes = [scenes[i] for i in scene_indices]
+        tile = get_tile(tile_scenes, plane, x, y, tile_w, tile_h,
+                        worker_state["blend"], zarray.dtype,
+                        worker_state["buffers"])
+        t, c, z = plane
+        zarray[t, c, z, y:(y + tile_h), x:(x + tile_w)] = tile
+    return len(tasks)
+
+
+def get_tasks(scenes, level, shape, tile_size):
+    """One task per row of tiles with data. Empty tiles are skipped."""
+    size_t, size_c, size_z, img_height, img_width = shape
+    tile_index = build_tile_index(scenes, tile_size)
+    row_count = ceil(img_height / tile_size)
+    col_count = ceil(img_width / tile_size)
+    print("level", level, "row_count", row_count, "col_count", col_count)
+    print("Tiles with data: %s of %s" % (len(tile_index), row_count * col_count))
+
+    tasks = []
+    for t in range(size_t):
+        for c in range(size_c):
+            for z in range(size_z):
+                for row in range(row_count):
+                    row_tasks = [(level, (t, c, z), row, col, tile_index[(row, col)])
+                                 for col in range(col_count) if (row, col) in tile_index]
+                    if row_tasks:
+                        tasks.append(row_tasks)
+    return tasks
+
+
+def stitch(zarr_path, images, target, tasks, tile_size=TILE_SIZE, blend="first", workers=1):
+    """Write every non-empty tile in tasks to the output arrays."""
+    init_args = (zarr_path, images, target, tile_size, blend)
+    done = 0
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=init_args) as executor:
+            for count in executor.map(stitch_tiles, tasks):
+                done += count
+                print("tiles done: %s" % done)
+    else:
+        init_worker(*init_args)
+        for row_tasks in tasks:
+            done += stitch_tiles(row_tasks)
+            print("tiles done: %s" % done)
+
+
+def main(zarr_path, blend="first", workers=1, tile_size=TILE_SIZE, target="output.zarr", resolutions=None):
+    images = parse_images(zarr_path)
+    if len(images) == 0:
+        print("Found no Images with StageLabel coordinates to stitch")
+        return
+
+    level_count = get_level_count(images, resolutions)
+    print("Resolutions to stitch:", level_count)
+
+    # in case we ran the script before, delete the output (useful when testing)
+    if os.path.exists(target):
+        shutil.rmtree(target)
+
+    store = parse_url(target, mode="w").store
+    root = zarr.group(store=store)
+
+    tasks = []
+    paths = []
+    transformations = []
+    for level in range(level_count):
+        scenes = create_scenes(zarr_path, images, level)
+        shape, dtype = get_level_shape(scenes)
+        print("level", level, "shape", shape, "dtype", dtype)
+
+        # create empty array for this level of the pyramid
+        path = str(level)
+        root.require_dataset(
+            path,
+            shape=shape,
+            exact=True,
+            chunks=(1, 1, 1, tile_size, tile_size),
+            dtype=dtype,
+        )
+        paths.append(path)
+        transformations.append(get_transformations(level))
+        tasks.extend(get_tasks(scenes, level, shape, tile_size))
+
+    # Go through all tiles with data, at all levels, and write them
+    stitch(zarr_path, images, target, tasks, tile_size, blend, workers)
+
+    datasets = []
+    for p, t in zip(paths, transformations):
+        datasets.append({"path": p, "coordinateTransformations": t})
+
+    write_multiscales_metadata(root, datasets, axes=AXES)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("zarr_path", nargs="?", default=ZARR_PATH,
+                        help="OME-Zarr with one image per scene")
+    parser.add_argument("--blend", choices=BLEND_MODES, default="first",
+                        help="How to combine overlapping scenes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes writing tiles")
+    parser.add_argument("--tile_size", type=int, default=TILE_SIZE)
+    parser.add_argument("--output", default="output.zarr")
+    parser.add_argument("--resolutions", type=int,
+                        help="Maximum number of resolutions to stitch")
+    args = parser.parse_args()
+    main(args.zarr_path, args.blend, args.workers, args.tile_size,
+         args.output, args.resolutions)
@@ -0,0 +1,227 @@
+# A lazy, "virtual" version of stitch_zarr.py
+# Instead of writing a stitched copy of all the scenes to disk, tiles are
+# stitched on demand when they are read, and kept in an LRU cache.
+
+# VirtualMosaic is an array-like object for one resolution, which can be
+# wrapped as a dask array:
+#
+#   mosaic = VirtualMosaic("TEST 2023_10_10__1046.zarr", level=2)
+#   dask_image = mosaic.to_dask()
+#
+# VirtualStore is a read-only zarr store (MutableMapping) for the whole
+# OME-Zarr multiscales image, where each chunk key maps to a stitched tile:
+#
+#   root = zarr.open_group(VirtualStore("TEST 2023_10_10__1046.zarr"), mode="r")
+#
+# Usage (prints the shapes and reads the smallest resolution):
+# $ python virtual_mosaic.py "TEST 2023_10_10__1046.zarr"
+
+import argparse
+import json
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from timeit import default_timer
+
+import dask.array as da
+import numpy as np
+import zarr
+
+from stitch_zarr import AXES, BLEND_MODES, TILE_SIZE, build_tile_index, \
+    create_buffers, create_scenes, get_level_count, get_level_shape, \
+    get_tile, get_transformations, parse_images
+
+CACHE_SIZE = 256
+
+
+class VirtualMosaic(object):
+    """A (t, c, z, y, x) array of one resolution, stitched when read."""
+
+    def __init__(self, zarr_path, level=0, tile_size=TILE_SIZE, blend="first",
+                 cache_size=CACHE_SIZE, images=None):
+        if images is None:
+            images = parse_images(zarr_path)
+        self.name = f"mosaic-{zarr_path}-{level}-{blend}"
+        self.scenes = create_scenes(zarr_path, images, level)
+        self.shape, self.dtype = get_level_shape(self.scenes)
+        self.ndim = len(self.shape)
+        self.tile_size = tile_size
+        self.chunks = (1, 1, 1, tile_size, tile_size)
+        self.blend = blend
+        self.tile_index = build_tile_index(self.scenes, tile_size)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # get_tile() buffers can't be shared between threads
+        self._local = threading.local()
+
+    def get_tile(self, plane, row, col):
+        """Return the stitched (t, c, z) tile, or None if it has no data."""
+        key = (plane, row, col)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        scene_indices = self.tile_index.get((row, col))
+        if scene_indices is None:
+            return None
+        if not hasattr(self._local, "buffers"):
+            self._local.buffers = create_buffers(self.tile_size, self.dtype, self.blend)
+        x = col * self.tile_size
+        y = row * self.tile_size
+        tile_w = min(self.tile_size, self.shape[-1] - x)
+        tile_h = min(self.tile_size, self.shape[-2] - y)
+        scenes = [self.scenes[i] for i in scene_indices]
+        # copy the tile out of the buffer since we keep it in the cache
+        tile = get_tile(scenes, plane, x, y, tile_w, tile_h, self.blend,
+                        self.dtype, self._local.buffers).copy()
+        with self._lock:
+            self._cache[key] = tile
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return tile
+
+    def __getitem__(self, selection):
+        """Support integer and slice (step 1) indexing, like a NumPy array."""
+        if not isinstance(selection, tuple):
+            selection = (selection,)
+        selection = selection + (slice(None),) * (self.ndim - len(selection))
+        ranges = []
+        for index, size in zip(selection, self.shape):
+            if isinstance(index, slice):
+                start, stop, step = index.indices(size)
+                if step != 1:
+                    raise IndexError("Only slices with step 1 are supported")
+                ranges.append((start, max(start, stop)))
+            else:
+                index = int(index) + size if index < 0 else int(index)
+                ranges.append((index, index + 1))
+        (t1, t2), (c1, c2), (z1, z2), (y1, y2), (x1, x2) = ranges
+
+        result = np.zeros([stop - start for start, stop in ranges], dtype=self.dtype)
+        ts = self.tile_size
+        for t in range(t1, t2):
+            for c in range(c1, c2):
+                for z in range(z1, z2):
+                    for row in range(y1 // ts, (y2 - 1) // ts + 1 if y2 > y1 else 0):
+                        for col in range(x1 // ts, (x2 - 1) // ts + 1 if x2 > x1 else 0):
+                            tile = self.get_tile((t, c, z), row, col)
+                            if tile is None:
+                                continue
+                            # the part of the tile inside the selection
+                            ty1 = max(y1, row * ts)
+                            ty2 = min(y2, row * ts + tile.shape[0])
+                            tx1 = max(x1, col * ts)
+                            tx2 = min(x2, col * ts + tile.shape[1])
+                            result[t - t1, c - c1, z - z1, ty1 - y1:ty2 - y1, tx1 - x1:tx2 - x1] = \
+                                tile[ty1 - row * ts:ty2 - row * ts, tx1 - col * ts:tx2 - col * ts]
+        # drop the dimensions that were indexed with an integer
+        squeeze = tuple(i for i, index in enumerate(selection) if not isinstance(index, slice))
+        return result.squeeze(axis=squeeze) if squeeze else result
+
+    def to_dask(self):
+        """A dask array with one chunk per tile, so each chunk is one get_tile()."""
+        return da.from_array(self, chunks=self.chunks, name=self.name,
+                             meta=np.empty((0,) * self.ndim, dtype=self.dtype))
+
+
+class VirtualStore(MutableMapping):
+    """
+    A read-only zarr (v2) store of the stitched OME-Zarr image.
+
+    Chunks are not compressed and map to a tile of a VirtualMosaic. Empty
+    tiles are missing keys, which zarr reads as the fill_value 0.
+    """
+
+    def __init__(self, zarr_path, tile_size=TILE_SIZE, blend="first",
+                 cache_size=CACHE_SIZE, resolutions=None):
+        images = parse_images(zarr_path)
+        level_count = get_level_count(images, resolutions)
+        self.tile_size = tile_size
+        self.mosaics = [VirtualMosaic(zarr_path, level, tile_size, blend, cache_size, images)
+                        for level in range(level_count)]
+        datasets = [{"path": str(level), "coordinateTransformations": get_transformations(level)}
+                    for level in range(level_count)]
+        self.metadata = {
+            ".zgroup": {"zarr_format": 2},
+            ".zattrs": {"multiscales": [{"version": "0.4", "axes": AXES, "datasets": datasets}]},
+        }
+        for level, mosaic in enumerate(self.mosaics):
+            self.metadata[f"{level}/.zarray"] = {
+                "zarr_format": 2,
+                "shape": list(mosaic.shape),
+                "chunks": list(mosaic.chunks),
+                "dtype": mosaic.dtype.str,
+                "compressor": None,
+                "fill_value": 0,
+                "order": "C",
+                "filters": None,
+                "dimension_separator": "/",
+            }
+
+    def __getitem__(self, key):
+        if key in self.metadata:
+            return json.dumps(self.metadata[key]).encode("utf-8")
+        try:
+            level, t, c, z, row, col = [int(k) for k in key.split("/")]
+            mosaic = self.mosaics[level]
+        except (ValueError, IndexError):
+            raise KeyError(key)
+        tile = mosaic.get_tile((t, c, z), row, col)
+        if tile is None:
+            raise KeyError(key)
+        if tile.shape != (self.tile_size, self.tile_size):
+            # chunks at the edge of the image are still full size
+            chunk = np.zeros((self.tile_size, self.tile_size), dtype=tile.dtype)
+            chunk[:tile.shape[0], :tile.shape[1]] = tile
+            tile = chunk
+        return tile.tobytes()
+
+    def __contains__(self, key):
+        if key in self.metadata:
+            return True
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, key, value):
+        raise PermissionError("VirtualStore is read-only")
+
+    def __delitem__(self, key):
+        raise PermissionError("VirtualStore is read-only")
+
+    def __iter__(self):
+        yield from self.metadata
+        for level, mosaic in enumerate(self.mosaics):
+            size_t, size_c, size_z = mosaic.shape[:3]
+            for t in range(size_t):
+                for c in range(size_c):
+                    for z in range(size_z):
+                        for row, col in mosaic.tile_index:
+                            yield f"{level}/{t}/{c}/{z}/{row}/{col}"
+
+    def __len__(self):
+        return len(self.metadata) + sum(
+            int(np.prod(mosaic.shape[:3])) * len(mosaic.tile_index) for mosaic in self.mosaics)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("zarr_path", help="OME-Zarr with one image per scene")
+    parser.add_argument("--blend", choices=BLEND_MODES, default="first")
+    parser.add_argument("--tile_size", type=int, default=TILE_SIZE)
+    parser.add_argument("--resolutions", type=int,
+                        help="Maximum number of resolutions")
+    args = parser.parse_args()
+
+    store = VirtualStore(args.zarr_path, args.tile_size, args.blend,
+                         resolutions=args.resolutions)
+    root = zarr.open_group(store, mode="r")
+    for dataset in root.attrs["multiscales"][0]["datasets"]:
+        print("path", dataset["path"], root[dataset["path"]].shape)
+    smallest = root[str(len(store.mosaics) - 1)]
+    start = default_timer()
+    data = smallest[:]
+    print("Read %s %s in %.3f s" % (data.shape, data.dtype, default_timer() - start))
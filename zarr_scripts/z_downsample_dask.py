@@ -13,23 +13,17 @@ import dask.array.core
 import dask.array as da
 
 from skimage.transform import resize
-from ome_zarr.dask_utils import resize as dask_resize
 from ome_zarr.scale import Scaler
 
+from downsample_kernels import dask_downsample
+
+
 class Zscaler(Scaler):
 
     def resize_image(self, image):
         """
         Resize a numpy array OR a dask array to a smaller array (not pyramid)
         """
-        if isinstance(image, da.Array):
-
-            def _resize(image, out_shape, **kwargs):
-                return dask_resize(image, out_shape, **kwargs)
-
-        else:
-            _resize = resize
-
         print("resize image...", image.shape)
         # down-sample in X, Y and Z dimensions...
         new_shape = list(image.shape)
@@ -40,12 +34,19 @@ class Zscaler(Scaler):
         print('sizeZ', image.shape[-3], self.downscale)
         out_shape = tuple(new_shape)
         print("out_shape", out_shape)
-        # This gives e.g. because each chunk is e.g. 1, 1, y, x
-        # and you can't downscale each chunk in Z (2, 0, 137, 135)
-        # Then this fails on the next iteration image.shape[-3] // self.downscale
+
+        if isinstance(image, da.Array):
+            # dask_resize() works on each chunk, and chunks of e.g. (1, 1, y, x)
+            # can't be downscaled in Z, giving e.g. (2, 0, 137, 135), which then
+            # fails on the next iteration. So we rechunk the array so that each
+            # block can be downsampled (without converting to float) and return
+            # the output with the same chunks as the input.
+            factors = (1,) * (image.ndim - 3) + (self.downscale,) * 3
+            factors = tuple(f if s >= f else 1 for s, f in zip(image.shape, factors))
+            return dask_downsample(image, factors, out_chunks=image.chunksize)
 
         dtype = image.dtype
-        image = _resize(
+        image = resize(
             image.astype(float), out_shape, order=1, mode="reflect", anti_aliasing=False
         )
         return image.astype(dtype)
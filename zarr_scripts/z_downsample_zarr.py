@@ -1,12 +1,19 @@
 
-from skimage.transform import resize
-import zarr
-from ome_zarr.writer import write_multiscale
-from ome_zarr.io import parse_url
+import argparse
+import itertools
 import os
 import shutil
 
-# Fails on large images e.g. (4, 259, 1920, 1920)
+import zarr
+from ome_zarr.io import parse_url
+from ome_zarr.writer import write_multiscales_metadata
+
+from downsample_kernels import METHODS, downsample
+
+# Builds a pyramid that is downsampled in X, Y and Z, without loading any
+# whole resolution into memory.
+#
+# Using skimage resize() on the whole of level 0 fails on large images e.g. (4, 259, 1920, 1920)
 # Traceback (most recent call last):
 #   File "/uod/idr/objectstore/minio/idr/v0.4/idr0077/z_downsample.py", line 49, in <module>
 #     fix_data("9836832.zarr")
@@ -21,46 +28,120 @@ import shutil
 #   File "/lifesci/groups/jrs/wmoore/miniconda3/envs/omero_zarr_export/lib/python3.9/site-packages/skimage/util/dtype.py", line 319, in _convert
 #     image = np.multiply(image, 1. / imax_in,
 # numpy.core._exceptions.MemoryError: Unable to allocate 28.5 GiB for an array with shape (4, 259, 1920, 1920) and data type float64
+#
+# Instead, each level is written one output chunk at a time. Each chunk is
+# downsampled from the matching block of the previous level, read back from
+# disk, in the source dtype. Peak memory is about (downscale ** 3) chunks.
+#
+# Usage:
+# $ python z_downsample_zarr.py path/to/6001240.zarr 6001240_z.zarr --method mean
+#
+# Use --method mode for label images (see downsample_kernels.py for all methods).
 
 downscale = 2
+chunk_sizes = {'x': 125, 'y': 125, 'z': 125, 'c': 1, 't': 1}
+
+
+def get_factors(shape, axes, downsample_z=True):
+    """The downscale factor for each axis: X, Y and (optionally) Z."""
+    factors = []
+    for size, axis in zip(shape, axes):
+        name = axis['name']
+        if name in ('x', 'y') or (name == 'z' and downsample_z):
+            # don't downsample an axis that is already smaller than downscale
+            factors.append(downscale if size >= downscale else 1)
+        else:
+            factors.append(1)
+    return tuple(factors)
+
+
+def iter_chunk_slices(shape, chunks):
+    """Yield the slices of every chunk of an array, in order."""
+    ranges = [range(0, size, chunk) for size, chunk in zip(shape, chunks)]
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(start, min(start + chunk, size))
+                    for start, chunk, size in zip(starts, chunks, shape))
+
+
+def downsample_level(source, target, factors, method="mean"):
+    """
+    Write each chunk of target, downsampled from the matching block of source.
+
+    Any pixels at the end of source that don't fill a whole block (e.g. an odd
+    Z size) are dropped, the same as new_shape = shape // downscale.
+    """
+    for out_slices in iter_chunk_slices(target.shape, target.chunks):
+        in_slices = tuple(slice(s.start * f, s.stop * f) for s, f in zip(out_slices, factors))
+        block = source[in_slices]
+        if max(factors) > 1:
+            block = downsample(block, factors, method)
+        target[out_slices] = block
+
+
+def create_level(root, path, shape, chunks, dtype, compressor):
+    chunks = tuple(min(chunk, size) for chunk, size in zip(chunks, shape))
+    return root.create_dataset(path, shape=shape, chunks=chunks, dtype=dtype,
+                               compressor=compressor, dimension_separator="/",
+                               overwrite=True)
+
+
+def get_scale(transformations):
+    for t in transformations or []:
+        if t.get('type') == 'scale':
+            return list(t['scale'])
+    return None
+
+
+def fix_data(path, out_path, method="mean", downsample_z=True, n_scales=None):
+    source_root = zarr.open(path, mode="r")
+    multiscales = source_root.attrs['multiscales'][0]
+    axes = multiscales['axes']
+    print('axes', axes)
+    downsample_z = downsample_z and axes[-3]['name'] == 'z'
+    print("downsample_z?", downsample_z)
+    if n_scales is None:
+        n_scales = len(multiscales['datasets'])
+
+    data = source_root[multiscales['datasets'][0]['path']]
+    chunks = tuple([chunk_sizes[axis['name']] for axis in axes])
+    print("chunks", chunks)
 
-def fix_data(path):
-    pyramid = []
-    # chunk_list = []
-    with zarr.open(path, "a") as f:
-        print("f.attrs", f.attrs)
-        axes = f.attrs['multiscales'][0]['axes']
-        print('axes', axes)
-        downsample_z = axes[-3]['name'] == 'z'
-        print("downsample_z?", downsample_z)
-        n_scales = len(f)
-
-        data = f["0"]
-        pyramid.append(data)
-
-        # for each existing pyramid level... 
-        for ds_name in range(n_scales - 1):
-
-            dtype = data.dtype
-            new_shape = list(data.shape)
-            new_shape[-1] = data.shape[-1] // downscale
-            new_shape[-2] = data.shape[-2] // downscale
-            new_shape[-3] = data.shape[-3] // downscale
-
-            print('new_shape...', new_shape)
-            data = resize(data, new_shape).astype(dtype)
-            pyramid.append(data)
-
-        chunk_sizes = {'x': 125, 'y': 125, 'z': 125, 'c': 1, 't': 1}
-        chunks = tuple([chunk_sizes[axis['name']] for axis in axes])
-        print("chunks", chunks)
-
-    out_path = "6001240_z.zarr"
     if os.path.isdir(out_path):
         shutil.rmtree(out_path)
-
     store = parse_url(out_path, mode="w").store
     root = zarr.group(store=store)
-    write_multiscale(pyramid, root, axes=axes, chunks=chunks)
 
-fix_data("/Users/wmoore/Desktop/ZARR/data/6001240.zarr")
+    # level 0 is copied (and rechunked) chunk by chunk
+    print('level 0', data.shape)
+    target = create_level(root, "0", data.shape, chunks, data.dtype, data.compressor)
+    downsample_level(data, target, (1,) * data.ndim, method)
+
+    scale = get_scale(multiscales['datasets'][0].get('coordinateTransformations'))
+    if scale is None:
+        scale = [1.0] * data.ndim
+    datasets = [{"path": "0", "coordinateTransformations": [{"type": "scale", "scale": scale}]}]
+
+    # each level is built from the previous level, on disk
+    for level in range(1, n_scales):
+        source = root[str(level - 1)]
+        factors = get_factors(source.shape, axes, downsample_z)
+        new_shape = tuple(size // f for size, f in zip(source.shape, factors))
+        print('level', level, 'new_shape...', new_shape, 'factors', factors)
+        target = create_level(root, str(level), new_shape, chunks, source.dtype, source.compressor)
+        downsample_level(source, target, factors, method)
+        scale = [s * f for s, f in zip(scale, factors)]
+        datasets.append({"path": str(level),
+                         "coordinateTransformations": [{"type": "scale", "scale": scale}]})
+
+    write_multiscales_metadata(root, datasets, axes=axes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", default="/Users/wmoore/Desktop/ZARR/data/6001240.zarr")
+    parser.add_argument("out_path", nargs="?", default="6001240_z.zarr")
+    parser.add_argument("--method", choices=METHODS, default="mean")
+    parser.add_argument("--no_z", action="store_true", help="Only downsample in X and Y")
+    parser.add_argument("--levels", type=int, help="Number of resolutions (default: same as input)")
+    args = parser.parse_args()
+    fix_data(args.path, args.out_path, args.method, not args.no_z, args.levels)